@@ -0,0 +1,184 @@
+import os
+import glob
+import importlib.util
+
+import pandas as pd
+
+from . import operations
+
+# Tables kept for every month: the filtered Agency Grid (filter_agency_grid) and the FC file (get_fc_file)
+HISTORY_TABLES = ['AG_filtered', 'AG_FC']
+
+# Columns of the filtered Agency Grid read by the delta query, and the keys of the FTEs sums
+DELTA_COLUMNS = ['kpi agency', 'fc code', 'department fc code', 'ftes']
+DELTA_KEYS = ['fc code', 'department fc code']
+
+
+class HistoryStore:
+    """
+    Keeps the filtered Agency Grid and the FC file of every month in a directory of parquet files partitioned by table,
+    year and month (e.g. AG_FC/year=2024/month=03/part.parquet), so that months can be compared without reopening
+    their output files. A query only opens the partitions of the months it compares, and only reads their needed
+    columns. Running a month again replaces its partitions.
+    """
+
+    def __init__(self, history_dir):
+        """
+        :param history_dir:     The directory of the history store.
+        """
+
+        if importlib.util.find_spec('pyarrow') is None and importlib.util.find_spec('fastparquet') is None:
+            print('The history store needs pyarrow or fastparquet to write and read parquet files')
+            exit()
+
+        self.directory = history_dir
+
+    def get_partition_file(self, table, year, month):
+        """
+        :param table:   The name of the table, one of HISTORY_TABLES.
+        :param year:    The year of the partition.
+        :param month:   The month of the partition.
+        :return: The path to the parquet file of the partition
+        """
+
+        return os.path.join(self.directory, table, f'year={year}', f'month={month:02}', 'part.parquet')
+
+    def get_months(self, table='AG_filtered'):
+        """
+        :param table:   The name of the table, one of HISTORY_TABLES.
+        :return: A sorted list with the (year, month) tuples stored in the table
+        """
+
+        months = []
+        for partition_file in glob.glob(os.path.join(self.directory, table, 'year=*', 'month=*', 'part.parquet')):
+            month_dir = os.path.dirname(partition_file)
+            year = int(os.path.basename(os.path.dirname(month_dir)).split('=')[1])
+            month = int(os.path.basename(month_dir).split('=')[1])
+            months.append((year, month))
+
+        return sorted(months)
+
+    def get_previous_month(self, year, month, table='AG_filtered'):
+        """
+        :param year:    The year of the month.
+        :param month:   The month.
+        :param table:   The name of the table, one of HISTORY_TABLES.
+        :return: The last (year, month) tuple stored in the table before the month, or None
+        """
+
+        previous_months = [x for x in self.get_months(table=table) if x < (year, month)]
+
+        return previous_months[-1] if len(previous_months) > 0 else None
+
+    def append(self, year, month, tables):
+        """
+        Writes the tables of a month in their partitions, replacing the ones of a previous run of the month.
+
+        :param year:    The year of the month.
+        :param month:   The month.
+        :param tables:  A dictionary with the table names and their DataFrames.
+        :return: A dictionary with the table names and the paths to their partition files
+        """
+
+        partition_files = {}
+        for table, data in tables.items():
+            # Plain strings instead of categories, so that the schema of a table is the same in every partition
+            categories = [column for column in data.columns if isinstance(data[column].dtype, pd.CategoricalDtype)]
+            if len(categories) > 0:
+                data = data.astype({column: object for column in categories})
+
+            partition_file = self.get_partition_file(table=table, year=year, month=month)
+            os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+            temporary_file = f'{partition_file}.tmp'
+            data.to_parquet(path=temporary_file, index=False)
+            os.replace(temporary_file, partition_file)
+            partition_files[table] = partition_file
+
+        return partition_files
+
+    def read(self, table, year, month, columns=None):
+        """
+        :param table:   The name of the table, one of HISTORY_TABLES.
+        :param year:    The year of the partition.
+        :param month:   The month of the partition.
+        :param columns: (Optional) A list with the columns to read. By default all of them.
+        :return: A DataFrame with the rows of the month
+        """
+
+        partition_file = self.get_partition_file(table=table, year=year, month=month)
+        if not os.path.exists(partition_file):
+            print(f'No {table} data of {year}-{month:02} in the history store {self.directory}')
+            exit()
+
+        return pd.read_parquet(path=partition_file, columns=columns)
+
+
+def get_fte_delta(previous_data, current_data):
+    """
+    Compares the FTEs sums by 'fc code' and 'department fc code' of two months.
+
+    :param previous_data:   The filtered Agency Grid of the previous month.
+    :param current_data:    The filtered Agency Grid of the current month.
+    :return: A DataFrame with the 'fc code', 'department fc code', 'ftes previous', 'ftes current' and 'ftes change'
+    of every combination found in either month, 0 FTEs when the combination is not found in a month
+    """
+
+    previous_ftes = previous_data.groupby(DELTA_KEYS, sort=False)['ftes'].sum()
+    current_ftes = current_data.groupby(DELTA_KEYS, sort=False)['ftes'].sum()
+
+    data = pd.concat([previous_ftes.rename('ftes previous'), current_ftes.rename('ftes current')], axis=1)
+    data.fillna(0.0, inplace=True)
+    data['ftes change'] = data['ftes current'] - data['ftes previous']
+    data.sort_index(inplace=True)
+
+    return data.reset_index()
+
+
+def compare_months(history_dir, current_year, current_month, previous_year=None, previous_month=None):
+    """
+    Compares a month of the history store with a previous one: the change of FTEs of every 'fc code' and 'department
+    fc code', and the agencies which are new or vanished. Only the partitions of the two months are read, and only the
+    columns of DELTA_COLUMNS.
+
+    :param history_dir:     The directory of the history store.
+    :param current_year:    Year of the current month.
+    :param current_month:   The current month.
+    :param previous_year:   (Optional) Year of the month compared with. By default the last month stored before.
+    :param previous_month:  (Optional) The month compared with.
+    :return: A DataFrame with the change of FTEs (see get_fte_delta), and two lists with the new and the vanished
+    agencies
+    """
+
+    store = HistoryStore(history_dir=history_dir)
+
+    if previous_year is None or previous_month is None:
+        previous = store.get_previous_month(year=current_year, month=current_month)
+        if previous is None:
+            print(f'No month before {current_year}-{current_month:02} in the history store {history_dir}')
+            exit()
+        previous_year, previous_month = previous
+
+    previous_data = store.read(table='AG_filtered', year=previous_year, month=previous_month, columns=DELTA_COLUMNS)
+    current_data = store.read(table='AG_filtered', year=current_year, month=current_month, columns=DELTA_COLUMNS)
+
+    delta = get_fte_delta(previous_data=previous_data, current_data=current_data)
+
+    # The agencies of the previous month play the part of the mapping: missing ones vanished, extra ones are new
+    vanished_agencies, new_agencies = operations.get_missing_agencies(country_map=previous_data,
+                                                                      current_month_data=current_data)
+
+    operations.insert_divider_line(message=f'FTES DELTA {previous_year}-{previous_month:02} TO '
+                                           f'{current_year}-{current_month:02}', end=False)
+    print(f"Total FTEs: {delta['ftes previous'].sum():.2f} -> {delta['ftes current'].sum():.2f}")
+    print(f"{(delta['ftes change'] != 0).sum()} of {len(delta)} (fc code, department fc code) combinations changed")
+    print(f'{len(new_agencies)} new agencies')
+    for agency in sorted(new_agencies):
+        print(f'\t - {agency}')
+    print(f'{len(vanished_agencies)} vanished agencies')
+    for agency in sorted(vanished_agencies):
+        print(f'\t - {agency}')
+    operations.insert_divider_line(message=f'FTES DELTA {previous_year}-{previous_month:02} TO '
+                                           f'{current_year}-{current_month:02}', end=True)
+
+    return delta, sorted(new_agencies), sorted(vanished_agencies)
+
@@ -0,0 +1,288 @@
+import os
+import glob
+import json
+import argparse
+import contextlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from . import caching
+from . import errors
+from . import matching
+from . import pipeline
+from . import validating
+
+# Mapping, department matcher and options shared by the months processed in a worker process
+worker_context = {}
+
+
+def get_months(first_month, last_month):
+    """
+    Lists the months of a range.
+
+    :param first_month:     The first month of the range, as 'YYYY-MM'.
+    :param last_month:      The last month of the range (included), as 'YYYY-MM'.
+    :return: A list of (year, month) tuples
+    """
+
+    first_year, first_month = [int(x) for x in first_month.split('-')]
+    last_year, last_month = [int(x) for x in last_month.split('-')]
+
+    months = []
+    for index in range(first_year * 12 + first_month - 1, last_year * 12 + last_month):
+        months.append((index // 12, index % 12 + 1))
+
+    return months
+
+
+def get_batch_jobs(manifest_file=None, months=None, input_template=None, missing_agency_template=None):
+    """
+    Lists the months to process with their grid file and single agency files, either from a JSON manifest or from a
+    range of months and file name templates.
+
+    :param manifest_file:               (Optional) Path to a JSON file with a list of months, each one with 'year',
+                                        'month', 'input_file' and optionally 'missing_agency_files'.
+    :param months:                      (Optional) A list of (year, month) tuples.
+    :param input_template:              Template of the grid file of a month, e.g. 'data/{year}_{month:02}_grid.csv'.
+    :param missing_agency_template:     (Optional) Glob template of the single agency files of a month, e.g.
+                                        'data/{year}_{month:02}/*.xlsx'.
+    :return: A list of dictionaries with the arguments of pipeline.run_month for every month
+    """
+
+    jobs = []
+
+    if manifest_file is not None:
+        with open(manifest_file, 'r', encoding='utf-8') as file:
+            for entry in json.load(file):
+                jobs.append({'current_year': int(entry['year']),
+                             'current_month': int(entry['month']),
+                             'current_month_file': entry['input_file'],
+                             'missing_agency_files': entry.get('missing_agency_files') or None})
+        return jobs
+
+    for year, month in months:
+        missing_agency_files = None
+        if missing_agency_template is not None:
+            missing_agency_files = sorted(glob.glob(missing_agency_template.format(year=year, month=month))) or None
+        jobs.append({'current_year': year,
+                     'current_month': month,
+                     'current_month_file': input_template.format(year=year, month=month),
+                     'missing_agency_files': missing_agency_files})
+
+    return jobs
+
+
+def init_worker(df_map, department_matcher, options):
+    """
+    Keeps the prepared mapping, the department matcher and the options in a worker process.
+
+    :param df_map:              A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param department_matcher:  DepartmentMatcher built from the department mapping.
+    :param options:             A dictionary with the other arguments of pipeline.run_month.
+    :return: None
+    """
+
+    worker_context.update(df_map=df_map, department_matcher=department_matcher, options=options)
+    if options.get('memory_budget') is not None:
+        # Shallow copies in the low memory mode (see transforming.copy_frame), for the worker process only
+        pd.set_option('mode.copy_on_write', True)
+
+    return None
+
+
+def run_job_in_worker(job):
+    """
+    Runs the pipeline for one month in a worker process. The console output of the month goes to a log file next to
+    its output files.
+
+    :param job:     A dictionary with the month arguments of pipeline.run_month.
+    :return: A tuple with the output files of the month and the department matches decided in the worker
+    """
+
+    options = worker_context['options']
+    log_file = os.path.join(options['output_dir'], f"{job['current_year']}_{job['current_month']:02}_AG_log.txt")
+    with open(log_file, 'w', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        output_files = pipeline.run_month(df_map=worker_context['df_map'],
+                                          department_matcher=worker_context['department_matcher'],
+                                          **job, **options)
+
+    return output_files, worker_context['department_matcher'].decisions
+
+
+def run_batch(jobs, df_map, department_matcher, batch_workers=1, **options):
+    """
+    Runs the pipeline for several months with the same prepared mapping, one month after the other or in a pool of
+    worker processes. The results are given in the order of the months in both cases.
+
+    :param jobs:                A list of dictionaries with the month arguments of pipeline.run_month.
+    :param df_map:              A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param department_matcher:  DepartmentMatcher built from the department mapping.
+    :param batch_workers:       Number of months processed at the same time.
+    :param options:             The other arguments of pipeline.run_month (output_dir, output_format, ...).
+    :return: A list with the output files of every month
+    """
+
+    if batch_workers <= 1 or len(jobs) <= 1:
+        return [pipeline.run_month(df_map=df_map, department_matcher=department_matcher, **job, **options)
+                for job in jobs]
+
+    # Each month runs in its own process, its single agency files are processed in that process
+    options = dict(options, workers=1)
+    batch_workers = min(batch_workers, len(jobs))
+    print(f'Processing {len(jobs)} months with {batch_workers} workers')
+
+    results = []
+    with ProcessPoolExecutor(max_workers=batch_workers, initializer=init_worker,
+                             initargs=(df_map, department_matcher, options)) as executor:
+        for job, (output_files, decisions) in zip(jobs, executor.map(run_job_in_worker, jobs)):
+            department_matcher.update(decisions=decisions)
+            results.append(output_files)
+            print(f"\t - {job['current_year']}-{job['current_month']:02}: done")
+
+    return results
+
+
+def get_parser():
+    """
+    :return: The parser of the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Agency Grid - several months in a batch")
+
+    parser.add_argument('--mapping_file', '-mf',
+                        type=Path,
+                        dest='mapping_file',
+                        help='Path to the mapping file provided by the Finance Department',
+                        default=None, required=True)
+
+    parser.add_argument('--manifest_file', '-mnf',
+                        type=Path,
+                        dest='manifest_file',
+                        help='Path to a JSON file listing the months with their input and single agency files',
+                        default=None, required=False)
+
+    parser.add_argument('--months', '-m',
+                        type=str,
+                        nargs=2,
+                        dest='months',
+                        metavar=('FIRST_MONTH', 'LAST_MONTH'),
+                        help='Range of months to process, as YYYY-MM YYYY-MM',
+                        default=None, required=False)
+
+    parser.add_argument('--input_template', '-it',
+                        type=str,
+                        dest='input_template',
+                        help='Template of the path to the data of a month, e.g. data/{year}_{month:02}_grid.csv',
+                        default=None, required=False)
+
+    parser.add_argument('--missing_agency_template', '-mat',
+                        type=str,
+                        dest='missing_agency_template',
+                        help='Glob template of the single agency files of a month, e.g. data/{year}_{month:02}/*.xlsx',
+                        default=None, required=False)
+
+    parser.add_argument('--output_dir', '-o',
+                        type=Path,
+                        dest='output_dir',
+                        help='Path to the output directory',
+                        default=None, required=True)
+
+    parser.add_argument('--cache_dir', '-cd',
+                        type=Path,
+                        dest='cache_dir',
+                        help='Path to the directory of the compiled mapping and the decisions kept between runs',
+                        default=None, required=False)
+
+    parser.add_argument('--batch_workers', '-bw',
+                        type=int,
+                        dest='batch_workers',
+                        help='Number of months processed at the same time',
+                        default=1, required=False)
+
+    parser.add_argument('--output_format', '-of',
+                        type=str,
+                        choices=['xlsx', 'csv', 'parquet'],
+                        dest='output_format',
+                        help='Format of the output files',
+                        default='xlsx', required=False)
+
+    parser.add_argument('--full_output_format', '-fof',
+                        type=str,
+                        choices=['xlsx', 'csv', 'parquet'],
+                        dest='full_output_format',
+                        help='Format of the full Agency Grid output file (default: the format of the output files)',
+                        default=None, required=False)
+
+    parser.add_argument('--validate', '-val',
+                        action='store_true',
+                        dest='validate',
+                        help='Flag to check the structure of the input files of all the months before processing them',
+                        default=False, required=False)
+
+    parser.add_argument('--history_dir', '-hd',
+                        type=Path,
+                        dest='history_dir',
+                        help='Path to the history store the filtered and FC files of every month are appended to',
+                        default=None, required=False)
+
+    parser.add_argument('--memory_budget', '-mb',
+                        type=float,
+                        dest='memory_budget',
+                        help='Peak resident memory allowed to the run in MB: turns on the low memory mode and reports '
+                             'the stages going over it',
+                        default=None, required=False)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs the Agency Grid pipeline for the months given in the command line arguments.
+
+    :param argv:    (Optional) The command line arguments. By default sys.argv.
+    :return: A list with the output files of every month
+    """
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if args.manifest_file is None and (args.months is None or args.input_template is None):
+        parser.error('either --manifest_file or both --months and --input_template are required')
+
+    batch_jobs = get_batch_jobs(manifest_file=args.manifest_file,
+                                months=None if args.months is None else get_months(*args.months),
+                                input_template=args.input_template,
+                                missing_agency_template=args.missing_agency_template)
+
+    if args.validate:
+        single_agency_files = [x for job in batch_jobs for x in job['missing_agency_files'] or []]
+        validating.validate_inputs(current_month_files=[job['current_month_file'] for job in batch_jobs],
+                                   mapping_file=args.mapping_file, missing_agency_files=single_agency_files)
+
+    if args.memory_budget is not None:
+        # Shallow copies in the low memory mode (see transforming.copy_frame), for this program only
+        pd.set_option('mode.copy_on_write', True)
+
+    # The mapping and the department matcher are prepared once for all the months
+    df_mapping = caching.load_mapping(mapping_file=args.mapping_file, cache_dir=args.cache_dir)
+    matches_file = None if args.cache_dir is None else os.path.join(args.cache_dir, 'department_matches.json')
+    matcher = matching.DepartmentMatcher(department_map=df_mapping['departments'], cache_file=matches_file)
+
+    results = run_batch(jobs=batch_jobs, df_map=df_mapping, department_matcher=matcher,
+                        batch_workers=args.batch_workers, output_dir=args.output_dir,
+                        output_format=args.output_format, full_output_format=args.full_output_format,
+                        history_dir=args.history_dir, memory_budget=args.memory_budget)
+    matcher.save()
+
+    return results
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except errors.InputError as error:
+        # Inconsistent inputs are reported without a traceback
+        print(error)
+        exit(1)
@@ -0,0 +1,453 @@
+import io
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from . import loading
+from . import matching
+from . import pipeline
+from . import operations
+from . import processing
+from . import profiling
+from . import transforming
+
+DEPARTMENT_NAMES = ['sales', 'marketing', 'human resources', 'it support', 'finance & control', 'legal',
+                    'operations', 'logistics', 'customer service', 'research & development', 'procurement',
+                    'quality assurance', 'communication', 'security', 'facility management', 'training']
+
+GRAND_TOTAL_TYPES = ["Nb. of trainees (not reported in the FTE's)",
+                     'Nb. with temporary contracts',
+                     'Nb. of FTE in long leave commitment']
+
+
+def get_departments(n_departments):
+    """
+    Generates department names and their department FC codes.
+
+    :param n_departments:   The number of departments.
+    :return: A list of (department name, code) tuples, the code being the one of the grid (without 'x' and '0')
+    """
+
+    departments = []
+    for index in range(n_departments):
+        name = DEPARTMENT_NAMES[index % len(DEPARTMENT_NAMES)]
+        if index >= len(DEPARTMENT_NAMES):
+            name = f'{name} {index // len(DEPARTMENT_NAMES)}'
+        departments.append((name.title(), f'{97000 + index * 10}'))
+
+    return departments
+
+
+def generate_mapping(output_file, agencies, branches, departments, seed=0):
+    """
+    Generates an Agency Grid mapping workbook with its 'Department mapping' and 'Countries mapping' sheets.
+
+    :param output_file:     The path to the Excel file.
+    :param agencies:        A list of agency names.
+    :param branches:        A list of branch names, every agency having all of them.
+    :param departments:     A list of (department name, code) tuples.
+    :param seed:            The seed of the random generator.
+    :return: The path to the Excel file
+    """
+
+    rng = np.random.default_rng(seed)
+    n_rows = len(agencies) * len(branches)
+
+    countries = pd.DataFrame({'Agency Code': np.repeat(np.arange(100, 100 + len(agencies)), len(branches)),
+                              'KPI Agency': np.repeat(agencies, len(branches)),
+                              'FC Code': np.repeat([f'FC{x:05}' for x in range(len(agencies))], len(branches)),
+                              'Branch': np.tile(branches, len(agencies)),
+                              'CEO Region': rng.choice(['Europe', 'Asia', 'Americas', 'Africa', 'Not Assigned'],
+                                                       n_rows, p=[.3, .25, .25, .15, .05]),
+                              'Continent Split': rng.choice(['EMEA', 'APAC', 'AMER'], n_rows),
+                              'Regional Director': rng.choice([f'Director {x}' for x in range(20)], n_rows),
+                              'Currency': np.repeat(rng.choice(['EUR', 'USD', 'GBP', 'CHF'], len(agencies)),
+                                                    len(branches))})
+
+    department_map = pd.DataFrame({'KPI Department': [name for name, _ in departments] + ['Service Center'],
+                                   'Department FC Code': [f'x{code}0' for _, code in departments] + ['x9704000']})
+
+    with pd.ExcelWriter(output_file) as writer:
+        department_map.to_excel(writer, sheet_name='Department mapping', index=False)
+        countries.to_excel(writer, sheet_name='Countries mapping', index=False)
+
+    return output_file
+
+
+def generate_grid(output_file, n_rows, agencies, branches, departments, date, seed=0):
+    """
+    Generates a grid CSV file with the raw look of the Agencies Department data (uppercase names, asterisks, extra
+    spaces, missing values and agencies unknown to the mapping).
+
+    :param output_file:     The path to the CSV file.
+    :param n_rows:          The number of rows.
+    :param agencies:        A list of agency names.
+    :param branches:        A list of branch names.
+    :param departments:     A list of (department name, code) tuples.
+    :param date:            A dictionary with date information.
+    :param seed:            The seed of the random generator.
+    :return: The path to the CSV file
+    """
+
+    rng = np.random.default_rng(seed)
+
+    raw_agencies = np.array([f' {x.upper()}*' if i % 7 == 0 else x for i, x in enumerate(agencies)]
+                            + ['Unknown Agency'])
+    raw_branches = np.array([x.replace(' ', '  ') for x in branches] + ['Unknown Branch'])
+    codes = np.array([code for _, code in departments] + [''])
+
+    ftes = rng.random(n_rows).round(2) * 10
+    grid = pd.DataFrame({'KPI Agency': raw_agencies[np.minimum(rng.integers(0, len(agencies) + 1, n_rows),
+                                                               len(raw_agencies) - 1)],
+                         'Branch': raw_branches[rng.choice(len(raw_branches), n_rows,
+                                                           p=[.97 / len(branches)] * len(branches) + [.03])],
+                         'Department FC Code': codes[rng.choice(len(codes), n_rows,
+                                                                p=[.99 / len(departments)] * len(departments) + [.01])],
+                         'FTEs': np.where(rng.random(n_rows) < .01, np.nan, ftes),
+                         'KPI Year Month': date['date'].strftime('%Y-%m')})
+    grid.to_csv(output_file, index=False)
+
+    return output_file
+
+
+def generate_single_agency_file(output_file, agency, branches, departments, seed=0):
+    """
+    Generates a single agency workbook with the layout expected by loading.load_single_agency_data: the agency name in
+    the first cell, a header row, a sub-header row, one 'Nb of FTEs' and one 'Nb of heads' row per department, the
+    'Service/Documentation Center' row and the grand total rows, with the branches followed by the 'Total for all
+    branches' column.
+
+    :param output_file:     The path to the Excel file.
+    :param agency:          The agency name.
+    :param branches:        A list of branch names.
+    :param departments:     A list of (department name, code) tuples.
+    :param seed:            The seed of the random generator.
+    :return: The path to the Excel file
+    """
+
+    rng = np.random.default_rng(seed)
+
+    header = ['Department', 'FTE type'] + branches + ['Total for all branches', 'Comment']
+    rows = [[agency.title()] + [None] * (len(header) - 1),
+            header,
+            [None, None] + ['FTE'] * len(branches) + [None, None]]
+    for name, _ in departments:
+        values = rng.integers(0, 20, len(branches)).astype(float).tolist()
+        rows.append([name, 'Nb of FTEs'] + values + [sum(values), None])
+        rows.append([name, 'Nb of heads'] + values + [sum(values), None])
+    rows.append(['Service/Documentation Center', 'Nb of FTEs'] + [1.5] * len(branches) + [1.5 * len(branches), None])
+    for fte_type in GRAND_TOTAL_TYPES:
+        values = rng.integers(0, 3, len(branches)).tolist()
+        rows.append([None, fte_type] + values + [sum(values), None])
+
+    pd.DataFrame(rows).to_excel(output_file, header=False, index=False)
+
+    return output_file
+
+
+def generate_inputs(work_dir, n_rows, n_single_agencies=5, n_departments=50, n_branches=4, seed=0):
+    """
+    Generates a consistent set of inputs: a mapping workbook, a grid CSV file and single agency workbooks. The number
+    of agencies grows with the number of rows.
+
+    :param work_dir:            The directory of the generated files.
+    :param n_rows:              The number of rows of the grid.
+    :param n_single_agencies:   The number of single agency workbooks.
+    :param n_departments:       The number of departments.
+    :param n_branches:          The number of branches of every agency.
+    :param seed:                The seed of the random generator.
+    :return: A dictionary with the paths to the 'mapping', 'grid' and 'single agencies' files and the 'date'
+    """
+
+    os.makedirs(work_dir, exist_ok=True)
+    date = operations.get_dates(month=1, year=2024)
+
+    n_agencies = max(10, n_rows // 2000)
+    agencies = [f'Agency {x:05}' for x in range(n_agencies)]
+    single_agencies = [f'Single Agency {x:03}' for x in range(n_single_agencies)]
+    branches = ['Main Branch'] + [f'Branch {x}' for x in range(1, n_branches)]
+    departments = get_departments(n_departments=n_departments)
+
+    inputs = {'date': date,
+              'mapping': generate_mapping(output_file=os.path.join(work_dir, 'mapping.xlsx'),
+                                          agencies=agencies + single_agencies, branches=branches,
+                                          departments=departments, seed=seed),
+              'grid': generate_grid(output_file=os.path.join(work_dir, f'grid_{n_rows}.csv'), n_rows=n_rows,
+                                    agencies=agencies, branches=branches, departments=departments, date=date,
+                                    seed=seed),
+              'single agencies': []}
+
+    for index, agency in enumerate(single_agencies):
+        # Department names with small differences, to exercise the fuzzy matching
+        names = [(name.lower() + (' dept' if i % 5 == 0 else ''), code) for i, (name, code) in enumerate(departments)]
+        inputs['single agencies'].append(
+            generate_single_agency_file(output_file=os.path.join(work_dir, f'single_agency_{index:03}.xlsx'),
+                                        agency=agency, branches=branches, departments=names, seed=seed + index))
+
+    return inputs
+
+
+@contextlib.contextmanager
+def measure(recorder, stage):
+    """
+    Measures a stage with the StageRecorder of the benchmark (see profiling.StageRecorder.stage). The stage output on
+    the console is discarded.
+
+    :param recorder:    The profiling.StageRecorder of the benchmark.
+    :param stage:       The name of the stage.
+    :return: The record of the stage, where the stage can add its rows in and out
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with recorder.stage(name=stage) as record:
+            yield record
+
+
+def get_measures(recorder):
+    """
+    :param recorder:    The profiling.StageRecorder of the benchmark.
+    :return: A dictionary with the wall time in seconds, the peak of memory allocated by Python in MB (when traced)
+    and the rows in and out of every stage
+    """
+
+    measures = {}
+    for record in recorder.stages:
+        measures[record['stage']] = {'rows_in': record['rows_in'], 'rows_out': record['rows_out'],
+                                     'seconds': record['wall_seconds']}
+        if 'traced_peak_mb' in record:
+            measures[record['stage']]['peak_mb'] = record['traced_peak_mb']
+
+    return measures
+
+
+def run_stages(inputs, recorder):
+    """
+    Runs every stage of the pipeline on generated inputs, each one measured by the recorder.
+
+    :param inputs:      A dictionary of inputs as given by generate_inputs.
+    :param recorder:    The profiling.StageRecorder of the benchmark.
+    :return: None
+    """
+
+    with measure(recorder=recorder, stage='load mapping') as record:
+        sheets = loading.load_data(input_file=inputs['mapping'], sheet_name=['Department mapping', 'Countries mapping'],
+                                   columns=loading.MAPPING_COLUMNS)
+        record['rows_out'] = sum(len(x) for x in sheets.values())
+
+    with measure(recorder=recorder, stage='clean mapping') as record:
+        df_map = {'departments': transforming.clean_up_data(data=sheets['Department mapping']),
+                  'countries': transforming.clean_up_data(data=sheets['Countries mapping'])}
+        for key in df_map:
+            df_map[key] = transforming.transform_mapping(data=df_map[key], key=key)
+        department_matcher = matching.DepartmentMatcher(department_map=df_map['departments'])
+        record['rows_out'] = sum(len(x) for x in df_map.values())
+
+    with measure(recorder=recorder, stage='load grid') as record:
+        df_grid = loading.load_data(input_file=inputs['grid'], columns=loading.GRID_COLUMNS)
+        record['rows_out'] = len(df_grid)
+
+    with measure(recorder=recorder, stage='clean grid') as record:
+        record['rows_in'] = len(df_grid)
+        df_grid = transforming.clean_up_data(data=df_grid)
+        record['rows_out'] = len(df_grid)
+
+    with measure(recorder=recorder, stage='transform grid') as record:
+        record['rows_in'] = len(df_grid)
+        df_grid = transforming.transform_data(data=df_grid)
+        record['rows_out'] = len(df_grid)
+
+    df_agency = {}
+    with measure(recorder=recorder, stage='single agencies') as record:
+        for input_file in inputs['single agencies']:
+            agency, data = loading.load_single_agency_data(input_file=input_file)
+            data = transforming.clean_up_data(data=data)
+            fte = transforming.transform_single_data(data=data, agency=agency, country_map=df_map['countries'],
+                                                     department_map=df_map['departments'], date=inputs['date'],
+                                                     department_matcher=department_matcher)
+            df_agency[agency] = {'fte': fte}
+        record['rows_in'] = len(inputs['single agencies'])
+        record['rows_out'] = sum(len(x['fte']) for x in df_agency.values())
+
+    with measure(recorder=recorder, stage='categorize') as record:
+        country_map, df_grid = pipeline.categorize_frames(country_map=df_map['countries'], df_grid=df_grid,
+                                                          df_agency=df_agency)
+        record['rows_in'] = record['rows_out'] = len(df_grid) + sum(len(x['fte']) for x in df_agency.values())
+
+    with measure(recorder=recorder, stage='merge') as record:
+        record['rows_in'] = len(df_grid) + sum(len(x['fte']) for x in df_agency.values())
+        agency_grid = processing.merge_grid_with_single_agency(single_agencies=df_agency, agency_grid=df_grid)
+        record['rows_out'] = len(agency_grid)
+
+    with measure(recorder=recorder, stage='process') as record:
+        record['rows_in'] = len(agency_grid)
+        agency_grid = processing.process_data(data=agency_grid, country_map=country_map)
+        record['rows_out'] = len(agency_grid)
+
+    with measure(recorder=recorder, stage='filter') as record:
+        record['rows_in'] = len(agency_grid)
+        avoided_grid, filtered_grid = processing.filter_agency_grid(data=agency_grid)
+        record['rows_out'] = len(filtered_grid)
+
+    with measure(recorder=recorder, stage='fc file') as record:
+        record['rows_in'] = len(filtered_grid)
+        fc_grid = processing.get_fc_file(data=filtered_grid)
+        record['rows_out'] = len(fc_grid)
+
+    return None
+
+
+def run_benchmark(inputs, trace_memory=True):
+    """
+    Runs every stage of the pipeline on generated inputs and measures them.
+
+    :param inputs:          A dictionary of inputs as given by generate_inputs.
+    :param trace_memory:    Whether to measure the peak of memory of every stage.
+    :return: A dictionary with the measures of every stage
+    """
+
+    recorder = profiling.StageRecorder(trace_memory=trace_memory)
+    try:
+        run_stages(inputs=inputs, recorder=recorder)
+    finally:
+        # The recorder starts tracing the memory, it does not stop when a stage fails
+        if trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    return get_measures(recorder=recorder)
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Compares the wall time of every stage with a previous benchmark and prints the regressions.
+
+    :param results:     The benchmark results, as saved by this module.
+    :param baseline:    The results of a previous benchmark.
+    :param tolerance:   The relative slowdown above which a stage is reported as a regression.
+    :return: A list of (rows, stage, ratio) tuples for the regressions
+    """
+
+    regressions = []
+    previous_runs = {run['rows']: run['stages'] for run in baseline['runs']}
+
+    for run in results['runs']:
+        previous_stages = previous_runs.get(run['rows'])
+        if previous_stages is None:
+            continue
+        for stage, record in run['stages'].items():
+            if stage not in previous_stages or previous_stages[stage]['seconds'] == 0:
+                continue
+            ratio = record['seconds'] / previous_stages[stage]['seconds']
+            print(f"\t - {run['rows']:>10} rows - {stage:<16}: {ratio:6.2f}x the baseline")
+            if ratio > 1 + tolerance:
+                regressions.append((run['rows'], stage, ratio))
+
+    for rows, stage, ratio in regressions:
+        print(f'REGRESSION: {stage} with {rows} rows is {ratio:.2f}x slower than the baseline')
+
+    return regressions
+
+
+def get_parser():
+    """
+    :return: The parser of the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Agency Grid - benchmark of the pipeline stages on synthetic data")
+
+    parser.add_argument('--sizes', '-s',
+                        type=int,
+                        nargs='+',
+                        dest='sizes',
+                        help='Numbers of rows of the generated grids (from 10k to 10M)',
+                        default=[10_000, 100_000, 1_000_000], required=False)
+
+    parser.add_argument('--single_agencies', '-sa',
+                        type=int,
+                        dest='single_agencies',
+                        help='Number of generated single agency files',
+                        default=5, required=False)
+
+    parser.add_argument('--work_dir', '-wd',
+                        type=Path,
+                        dest='work_dir',
+                        help='Directory of the generated files (default: a temporary directory)',
+                        default=None, required=False)
+
+    parser.add_argument('--output_file', '-o',
+                        type=Path,
+                        dest='output_file',
+                        help='Path to the JSON file with the results',
+                        default=Path('benchmark.json'), required=False)
+
+    parser.add_argument('--baseline', '-b',
+                        type=Path,
+                        dest='baseline',
+                        help='Path to the JSON results of a previous benchmark to compare with',
+                        default=None, required=False)
+
+    parser.add_argument('--tolerance', '-t',
+                        type=float,
+                        dest='tolerance',
+                        help='Relative slowdown reported as a regression when comparing with the baseline',
+                        default=0.2, required=False)
+
+    parser.add_argument('--no_memory', '-nm',
+                        action='store_true',
+                        dest='no_memory',
+                        help='Flag to skip the peak memory measure, which slows down the stages',
+                        default=False, required=False)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs the benchmark of the pipeline stages with the sizes given in the command line arguments.
+
+    :param argv:    (Optional) The command line arguments. By default sys.argv.
+    :return: A dictionary with the benchmark results
+    """
+
+    args = get_parser().parse_args(argv)
+
+    benchmark = {'created': datetime.now().isoformat(timespec='seconds'),
+                 'python': sys.version.split()[0],
+                 'pandas': pd.__version__,
+                 'platform': platform.platform(),
+                 'runs': []}
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir or temporary_dir
+        for size in args.sizes:
+            print(f'Benchmark with {size} rows: generating the inputs')
+            generated = generate_inputs(work_dir=work_dir, n_rows=size, n_single_agencies=args.single_agencies)
+            print(f'Benchmark with {size} rows: running the stages')
+            measures = run_benchmark(inputs=generated, trace_memory=not args.no_memory)
+            benchmark['runs'].append({'rows': size, 'stages': measures})
+            for name, measured in measures.items():
+                peak = '' if 'peak_mb' not in measured else f"{measured['peak_mb']:10.2f} MB"
+                print(f"\t - {name:<16}: {measured['seconds']:9.3f} s {peak}")
+
+    with open(args.output_file, 'w', encoding='utf-8') as output:
+        json.dump(benchmark, output, indent=4)
+    print(f'Benchmark results written in {args.output_file}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            compare_results(results=benchmark, baseline=json.load(baseline_file), tolerance=args.tolerance)
+
+    return benchmark
+
+
+if __name__ == '__main__':
+    main()
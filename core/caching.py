@@ -0,0 +1,229 @@
+import os
+import glob
+import json
+import pickle
+import hashlib
+import pandas as pd
+
+from . import loading
+from . import transforming
+
+MAPPING_SHEETS = {'departments': 'Department mapping',
+                  'countries': 'Countries mapping'}
+
+
+def get_file_hash(input_file, chunk_size=1 << 20):
+    """
+    Computes the SHA-256 hash of the content of a file.
+
+    :param input_file:  The path to the file.
+    :param chunk_size:  The number of bytes read at once.
+    :return: The hexadecimal digest of the file content.
+    """
+
+    digest = hashlib.sha256()
+    with open(input_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_code_version(modules=None):
+    """
+    Computes a version of the code preparing the cached artifacts, so that they are invalidated when the code changes.
+
+    :param modules:     (Optional) The modules producing the artifacts. By default the loading and the cleaning.
+    :return: The hexadecimal digest of the modules source code and the pandas version.
+    """
+
+    if modules is None:
+        modules = [loading, transforming]
+
+    digest = hashlib.sha256(pd.__version__.encode('utf-8'))
+    for module in modules:
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+
+def get_frame_hashes(data, key):
+    """
+    Fingerprints the rows of a DataFrame sharing the same value in a key column, e.g. the rows of every agency.
+
+    :param data:    The DataFrame.
+    :param key:     The name of the key column.
+    :return: A dictionary with the values of the key column and the hexadecimal digest of their rows
+    """
+
+    row_hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    columns = '|'.join(str(column) for column in data.columns).encode('utf-8')
+
+    fingerprints = {}
+    for value, positions in data.groupby(key, observed=True, sort=False).indices.items():
+        fingerprints[value] = hashlib.sha256(columns + row_hashes[positions].tobytes()).hexdigest()
+
+    return fingerprints
+
+
+def prepare_mapping(mapping_file):
+    """
+    Loads the sheets of the mapping file in one go, then cleans and transforms them.
+
+    :param mapping_file:    The path to the Agency Grid mapping file.
+    :return: A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    """
+
+    sheets = loading.load_data(input_file=mapping_file, sheet_name=list(MAPPING_SHEETS.values()),
+                                columns=loading.MAPPING_COLUMNS)
+
+    df_map = {}
+    for key, sheet_name in MAPPING_SHEETS.items():
+        df_map[key] = transforming.clean_up_data(data=sheets[sheet_name])
+        df_map[key] = transforming.transform_mapping(data=df_map[key], key=key)
+
+    return df_map
+
+
+def load_mapping(mapping_file, cache_dir=None):
+    """
+    Loads the prepared mapping from the cache directory when the mapping file and the code are unchanged, otherwise
+    prepares it from the mapping file and stores it in the cache directory for the next runs.
+
+    :param mapping_file:    The path to the Agency Grid mapping file.
+    :param cache_dir:       (Optional) The directory of the cached artifacts. Without it nothing is cached.
+    :return: A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    """
+
+    if cache_dir is None:
+        return prepare_mapping(mapping_file=mapping_file)
+
+    key = hashlib.sha256(f'{get_file_hash(mapping_file)}-{get_code_version()}'.encode('utf-8')).hexdigest()[:32]
+    cache_file = os.path.join(cache_dir, f'mapping_{key}.pkl')
+
+    if os.path.exists(cache_file):
+        print(f'Mapping file loading - compiled mapping from cache {cache_file}')
+        with open(cache_file, 'rb') as file:
+            return pickle.load(file)
+
+    df_map = prepare_mapping(mapping_file=mapping_file)
+
+    # Previous versions of the mapping are not needed anymore
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_file in glob.glob(os.path.join(cache_dir, 'mapping_*.pkl')):
+        os.remove(old_file)
+
+    temporary_file = f'{cache_file}.tmp'
+    with open(temporary_file, 'wb') as file:
+        pickle.dump(df_map, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_file, cache_file)
+    print(f'Mapping file loading - compiled mapping stored in cache {cache_file}')
+
+    return df_map
+
+
+class AgencyStore:
+    """
+    Keeps between runs the processed rows of every agency of a month (the output of process_data for that agency),
+    with the fingerprint of the inputs they were computed from. A later run of the same month only recomputes the
+    agencies whose fingerprint changed. The store also remembers the agency of every single agency file, so that
+    unchanged files do not need to be parsed to know their agency.
+    """
+
+    def __init__(self, cache_dir, current_year, current_month):
+        """
+        :param cache_dir:       The directory of the cached artifacts.
+        :param current_year:    Year of the current month file.
+        :param current_month:   Month of the current month file.
+        """
+
+        self.directory = os.path.join(cache_dir, 'agencies', f'{current_year}_{current_month:02}')
+        self.manifest_file = os.path.join(self.directory, 'manifest.json')
+        self.manifest = {'agencies': {}, 'files': {}}
+        self.used_agencies = set()
+
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as file:
+                self.manifest = json.load(file)
+
+    def get_agency_file(self, agency):
+        """
+        :param agency:  The name of the agency.
+        :return: The path to the pickle file with the processed rows of the agency
+        """
+
+        return os.path.join(self.directory, f"{hashlib.sha1(agency.encode('utf-8')).hexdigest()}.pkl")
+
+    def get_file_agency(self, input_file, file_hash):
+        """
+        :param input_file:  The path to a single agency file.
+        :param file_hash:   The hash of the content of the file.
+        :return: The agency of the file found in a previous run, or None if the file is new or changed
+        """
+
+        entry = self.manifest['files'].get(os.path.abspath(input_file))
+        if entry is None or entry['hash'] != file_hash:
+            return None
+
+        return entry['agency']
+
+    def set_file_agency(self, input_file, file_hash, agency):
+        """
+        :param input_file:  The path to a single agency file.
+        :param file_hash:   The hash of the content of the file.
+        :param agency:      The agency of the file.
+        :return: None
+        """
+
+        self.manifest['files'][os.path.abspath(input_file)] = {'hash': file_hash, 'agency': agency}
+
+        return None
+
+    def get(self, agency, fingerprint):
+        """
+        :param agency:          The name of the agency.
+        :param fingerprint:     The fingerprint of the current inputs of the agency.
+        :return: The processed rows of the agency if they were computed from the same inputs, otherwise None
+        """
+
+        self.used_agencies.add(agency)
+        if self.manifest['agencies'].get(agency) != fingerprint or not os.path.exists(self.get_agency_file(agency)):
+            return None
+
+        with open(self.get_agency_file(agency), 'rb') as file:
+            return pickle.load(file)
+
+    def put(self, agency, fingerprint, data):
+        """
+        :param agency:          The name of the agency.
+        :param fingerprint:     The fingerprint of the inputs the rows were computed from.
+        :param data:            The processed rows of the agency.
+        :return: None
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.get_agency_file(agency), 'wb') as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.manifest['agencies'][agency] = fingerprint
+        self.used_agencies.add(agency)
+
+        return None
+
+    def save(self):
+        """
+        Writes the manifest of the store. Agencies which were not part of this run are removed.
+
+        :return: None
+        """
+
+        for agency in set(self.manifest['agencies']) - self.used_agencies:
+            del self.manifest['agencies'][agency]
+            if os.path.exists(self.get_agency_file(agency)):
+                os.remove(self.get_agency_file(agency))
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.manifest_file, 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, indent=4, ensure_ascii=False)
+
+        return None
@@ -0,0 +1,77 @@
+import argparse
+from pathlib import Path
+
+from . import archiving
+from . import writing
+
+
+def get_parser():
+    """
+    :return: The parser of the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Agency Grid - FTEs delta between two months of the history store")
+    parser.add_argument('--history_dir', '-hd',
+                        type=Path,
+                        dest='history_dir',
+                        help='Path to the directory of the history store',
+                        default=None, required=True)
+
+    parser.add_argument('--current_year', '-cy',
+                        type=int,
+                        dest='current_year',
+                        help='Year of the current month',
+                        default=None, required=True)
+
+    parser.add_argument('--current_month', '-cm',
+                        type=int,
+                        dest='current_month',
+                        help='The current month',
+                        default=None, required=True)
+
+    parser.add_argument('--previous_year', '-py',
+                        type=int,
+                        dest='previous_year',
+                        help='Year of the month compared with (default: the last month stored before)',
+                        default=None, required=False)
+
+    parser.add_argument('--previous_month', '-pm',
+                        type=int,
+                        dest='previous_month',
+                        help='The month compared with (default: the last month stored before)',
+                        default=None, required=False)
+
+    parser.add_argument('--output_file', '-o',
+                        type=Path,
+                        dest='output_file',
+                        help='Path to the file of the FTEs delta (.xlsx, .csv or .parquet)',
+                        default=None, required=False)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Compares two months of the history store (see archiving.compare_months) and writes the FTEs delta.
+
+    :param argv:    (Optional) The command line arguments. By default sys.argv.
+    :return: The DataFrame with the FTEs delta
+    """
+
+    args = get_parser().parse_args(argv)
+
+    fte_delta, _, _ = archiving.compare_months(history_dir=args.history_dir, current_year=args.current_year,
+                                               current_month=args.current_month, previous_year=args.previous_year,
+                                               previous_month=args.previous_month)
+
+    if args.output_file is not None:
+        extensions = {extension: output_format for output_format, extension in writing.OUTPUT_FORMATS.items()}
+        writing.write_data(data=fte_delta, output_file=args.output_file,
+                           output_format=extensions.get(args.output_file.suffix, args.output_file.suffix))
+        print(f'FTEs delta written in {args.output_file}')
+
+    return fte_delta
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+class InputError(ValueError):
+    """
+    Raised when the inputs of a run are inconsistent, e.g. an agency without FC code or a department name found in no
+    mapping. The command lines print its message and exit, the service answers the job with it.
+    """
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from . import errors
+
+
+class MappingIndex:
+    """
+    Hash index of the country mapping built once per mapping: the FC codes of every agency and the row of every
+    (agency, branch) pair. Duplicated pairs and agencies with several FC codes are found when the index is built,
+    the lookups afterwards are dictionary lookups instead of scans of the mapping.
+    """
+
+    def __init__(self, country_map, agency_column='kpi agency', branch_column='branch', code_column='fc code'):
+        """
+        :param country_map:     A DataFrame with the cleaned country mapping.
+        :param agency_column:   The name of the agency column.
+        :param branch_column:   The name of the branch column.
+        :param code_column:     The name of the FC code column.
+        """
+
+        self.country_map = country_map
+        self.keys = [agency_column, branch_column]
+
+        agencies = country_map[agency_column].tolist()
+        branches = country_map[branch_column].tolist()
+        codes = country_map[code_column].tolist()
+
+        self.rows = {}
+        self.duplicate_keys = []
+        self.fc_codes = {}
+        for position, (agency, branch, code) in enumerate(zip(agencies, branches, codes)):
+            if (agency, branch) in self.rows:
+                self.duplicate_keys.append((agency, branch))
+            else:
+                self.rows[(agency, branch)] = position
+            self.fc_codes.setdefault(agency, set()).add(code)
+
+        self.agencies = frozenset(self.fc_codes)
+        self.ambiguous_agencies = {agency: sorted(str(x) for x in codes) for agency, codes in self.fc_codes.items()
+                                   if len(codes) > 1}
+        self.is_unique = len(self.duplicate_keys) == 0
+        self.duplicate_positions = np.array(sorted({self.rows[key] for key in self.duplicate_keys}), dtype=np.int64)
+
+    def has_agency(self, agency):
+        """
+        :param agency:  The name of an agency.
+        :return: Whether the agency is in the mapping
+        """
+
+        return agency in self.agencies
+
+    def get_fc_code(self, agency):
+        """
+        :param agency:  The name of an agency.
+        :return: The FC code of the agency. An InputError is raised if the agency has no or several FC codes.
+        """
+
+        fc_codes = self.fc_codes.get(agency, set())
+
+        if len(fc_codes) == 0:
+            raise errors.InputError(f'Impossible to find a FC CODE corresponding to {agency}.')
+        elif len(fc_codes) > 1:
+            raise errors.InputError(f"More than one FC CODE found:\n{', '.join(self.ambiguous_agencies[agency])}\n"
+                                    f"Impossible to decide.")
+
+        return next(iter(fc_codes))
+
+    def get_row(self, agency, branch):
+        """
+        :param agency:  The name of an agency.
+        :param branch:  The name of a branch of the agency.
+        :return: The first mapping row of the agency and the branch as a Series, or None if there is none
+        """
+
+        position = self.rows.get((agency, branch))
+
+        return None if position is None else self.country_map.iloc[position]
+
+    def get_missing_agencies(self, agencies):
+        """
+        :param agencies:    The agencies of the current month data.
+        :return: Two lists: the agencies of the mapping missing in the data, and the agencies of the data missing in the
+        mapping
+        """
+
+        agencies = set(agencies)
+
+        return list(self.agencies - agencies), list(agencies - self.agencies)
+
+    def get_positions(self, data):
+        """
+        Looks up the mapping row of every row of data, each distinct (agency, branch) pair being looked up once.
+
+        :param data:    A DataFrame with the agency and branch columns.
+        :return: An array with the position of the mapping row of every row, -1 when the pair is not in the mapping
+        """
+
+        # The pairs are encoded as integers from the codes of the agencies and the branches (categorical codes when
+        # the columns are categoricals), missing values being a value of their own
+        agency_codes, agencies = pd.factorize(data[self.keys[0]], use_na_sentinel=False)
+        branch_codes, branches = pd.factorize(data[self.keys[1]], use_na_sentinel=False)
+        pair_codes, pairs = pd.factorize(agency_codes.astype(np.int64) * len(branches) + branch_codes)
+
+        agencies = np.asarray(agencies, dtype=object)
+        branches = np.asarray(branches, dtype=object)
+        unique_positions = np.array([self.rows.get((agencies[pair // len(branches)], branches[pair % len(branches)]),
+                                                   -1) for pair in pairs], dtype=np.int64)
+
+        return unique_positions[pair_codes]
+
+    def validate(self, data, positions=None):
+        """
+        Checks that the rows of data have at most one mapping row each (many-to-one join). The pairs of data missing
+        in the mapping are reported, their rows get no mapping values. Pairs of data duplicated in the mapping would
+        give several rows for one row of data: an InputError listing them is raised.
+
+        :param data:        A DataFrame with the agency and branch columns.
+        :param positions:   (Optional) The positions of the mapping rows, as given by get_positions.
+        :return: The positions of the mapping rows of every row of data
+        """
+
+        if positions is None:
+            positions = self.get_positions(data=data)
+
+        is_unmatched = positions < 0
+        if is_unmatched.any():
+            unmatched = data.loc[is_unmatched, self.keys].drop_duplicates()
+            print(f'Processing Data: {is_unmatched.sum()} rows of {len(unmatched)} (agency, branch) pairs not found in '
+                  f'the COUNTRIES mapping')
+
+        if not self.is_unique:
+            is_duplicated = np.isin(positions, self.duplicate_positions)
+            if is_duplicated.any():
+                pairs = data.loc[is_duplicated, self.keys].drop_duplicates().itertuples(index=False)
+                raise errors.InputError('(agency, branch) pairs found more than once in the COUNTRIES mapping:\n'
+                                        + ''.join(f'\t - {agency} / {branch}\n' for agency, branch in pairs)
+                                        + 'Impossible to decide.')
+
+        return positions
+
+    def join(self, data, country_map=None, positions=None):
+        """
+        Adds the mapping columns to data, like a left merge on the agency and the branch. Every row of data gets the
+        first mapping row of its pair, so the pairs of data must not be duplicated in the mapping (see validate).
+
+        :param data:            A DataFrame with the agency and branch columns.
+        :param country_map:     (Optional) The mapping the columns are taken from, with the same rows as the one of the
+                                index, e.g. a categorized copy. By default the mapping of the index.
+        :param positions:       (Optional) The positions of the mapping rows, as given by get_positions or validate.
+        :return: A new DataFrame with the columns of data followed by the other columns of the mapping
+        """
+
+        if country_map is None:
+            country_map = self.country_map
+        if positions is None:
+            positions = self.get_positions(data=data)
+
+        # The columns are gathered and assembled once, without aligning them on an index. Their dtype is given so that
+        # the text columns are not inferred again
+        arrays = {column: data[column].array for column in data.columns}
+        for column in country_map.columns:
+            if column not in self.keys:
+                arrays[column] = country_map[column].array.take(positions, allow_fill=True)
+        columns = {column: pd.Series(array, dtype=array.dtype, copy=False) for column, array in arrays.items()}
+
+        return pd.DataFrame(columns, copy=False)
@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from . import loading
+from . import transforming
+
+# Mapping and date shared by the single agency files processed in a worker process
+worker_context = {}
+
+
+def ingest_single_agency_file(input_file, country_map, department_map, date, department_matcher=None):
+    """
+    Loads, cleans and transforms the data of a single agency file.
+
+    :param input_file:          The path to the single agency file.
+    :param country_map:         DataFrame with the country mapping.
+    :param department_map:      DataFrame with the department mapping.
+    :param date:                A dictionary with date information.
+    :param department_matcher:  (Optional) DepartmentMatcher built from department_map.
+    :return: A tuple with the agency name, its cleaned-up data and its transformed data
+    """
+
+    agency, data = loading.load_single_agency_data(input_file=input_file)
+    print(f'\t - {agency.capitalize()}: Data loaded')
+    data = transforming.clean_up_data(data=data)
+    print(f'\t - {agency.capitalize()}: Data cleaned-up')
+
+    fte = transforming.transform_single_data(data=data, agency=agency, country_map=country_map,
+                                             department_map=department_map, date=date,
+                                             department_matcher=department_matcher)
+
+    return agency, data, fte
+
+
+def init_worker(country_map, department_map, date, department_matcher):
+    """
+    Keeps the mapping and the date in a worker process, so that they are sent once per worker and not once per file.
+
+    :param country_map:         DataFrame with the country mapping.
+    :param department_map:      DataFrame with the department mapping.
+    :param date:                A dictionary with date information.
+    :param department_matcher:  DepartmentMatcher built from department_map, or None.
+    :return: None
+    """
+
+    worker_context.update(country_map=country_map, department_map=department_map, date=date,
+                          department_matcher=department_matcher)
+
+    return None
+
+
+def ingest_in_worker(input_file):
+    """
+    Processes a single agency file with the mapping kept in the worker process.
+
+    :param input_file:  The path to the single agency file.
+    :return: A tuple with the agency name, its cleaned-up data, its transformed data and the department matches
+    decided in the worker
+    """
+
+    agency, data, fte = ingest_single_agency_file(input_file=input_file, **worker_context)
+    matcher = worker_context['department_matcher']
+    decisions = {} if matcher is None else matcher.decisions
+
+    return agency, data, fte, decisions
+
+
+def ingest_single_agency_files(input_files, country_map, department_map, date, department_matcher=None, workers=1,
+                               keep_raw=True):
+    """
+    Loads, cleans and transforms several single agency files, one after the other or in a pool of worker processes.
+    The results are given in the order of the files in both cases, so the outputs do not depend on the number of
+    workers.
+
+    :param input_files:         A list of paths to single agency files.
+    :param country_map:         DataFrame with the country mapping.
+    :param department_map:      DataFrame with the department mapping.
+    :param date:                A dictionary with date information.
+    :param department_matcher:  (Optional) DepartmentMatcher built from department_map. The department matches decided
+                                in the workers are added to it.
+    :param workers:             The number of worker processes. With 1 (or less) the files are processed here.
+    :param keep_raw:            Whether to keep the cleaned-up DataFrame of every file ('raw') once it is transformed.
+    :return: A dictionary with the agency names as keys and their 'raw' (if kept) and 'fte' DataFrames and their
+    'file' as values
+    """
+
+    df_agency = {}
+
+    if workers <= 1 or len(input_files) <= 1:
+        for input_file in input_files:
+            agency, data, fte = ingest_single_agency_file(input_file=input_file, country_map=country_map,
+                                                          department_map=department_map, date=date,
+                                                          department_matcher=department_matcher)
+            df_agency[agency] = {'raw': data, 'fte': fte, 'file': input_file}
+            if not keep_raw:
+                del df_agency[agency]['raw']
+            print('\n')
+        return df_agency
+
+    workers = min(workers, len(input_files))
+    print(f'\t - Processing {len(input_files)} single agency files with {workers} workers')
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(country_map, department_map, date, department_matcher)) as executor:
+        # map gives the results in the order of the files, whatever the order they finish in
+        results = executor.map(ingest_in_worker, input_files)
+        for input_file, (agency, data, fte, decisions) in zip(input_files, results):
+            df_agency[agency] = {'raw': data, 'fte': fte, 'file': input_file}
+            if not keep_raw:
+                del df_agency[agency]['raw']
+            if department_matcher is not None:
+                department_matcher.update(decisions=decisions)
+    print('\n')
+
+    return df_agency
@@ -1,13 +1,80 @@
 import os
+import importlib.util
+from collections import defaultdict
+
 import pandas as pd
 
+from . import errors
+
+# Faster Excel reader, used when it is installed
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') is not None else None
+
+# Columns used by the pipeline, named as after cleaning (see get_column_name)
+GRID_COLUMNS = ['kpi agency', 'branch', 'department fc code', 'ftes', 'kpi year month']
+MAPPING_COLUMNS = ['kpi department', 'department fc code',
+                   'agency code', 'kpi agency', 'fc code', 'branch', 'ceo region', 'continent split',
+                   'regional director', 'currency']
+
+# Strings read as missing FTEs, the default missing values of pandas. The text columns keep them as they are.
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+             'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
 
-def load_data(input_file, sheet_name=None):
+def get_column_name(column):
     """
-    Loads data from a file (CSV or Excel) into a pandas DataFrame.
+    Cleans a column name as transforming.clean_up_data does: stripped, lowercased and without multiple spaces.
+
+    :param column:  The column name in the file.
+    :return: The cleaned column name
+    """
+
+    return ' '.join(str(column).strip().lower().split())
+
+
+def get_usecols(columns=None):
+    """
+    :param columns:     (Optional) The names of the columns to read, as after cleaning.
+    :return: A callable selecting the columns of a file by their cleaned name, or None for all the columns
+    """
+
+    if columns is None:
+        return None
+
+    columns = set(columns)
+
+    return lambda column: get_column_name(column) in columns
+
+
+def read_csv(input_file, usecols=None, chunk_size=None, nrows=None):
+    """
+    Reads a CSV file with every column kept as text, except the FTEs. Only the FTEs have missing values, as with str
+    converters.
+
+    :param input_file:      The path to the CSV file.
+    :param usecols:         (Optional) The columns to read, see get_usecols.
+    :param chunk_size:      (Optional) The number of rows of the chunks. By default the whole file is read.
+    :param nrows:           (Optional) The number of rows to read. By default all of them.
+    :return: A DataFrame, or an iterator of DataFrames when chunk_size is given
+    """
+
+    return pd.read_csv(filepath_or_buffer=input_file,
+                       usecols=usecols,
+                       dtype=defaultdict(lambda: str, {'FTEs': float}),
+                       keep_default_na=False,
+                       na_values={'FTEs': NA_VALUES},
+                       chunksize=chunk_size,
+                       nrows=nrows)
+
+
+def load_data(input_file, sheet_name=None, columns=None):
+    """
+    Loads data from a file (CSV or Excel) into a pandas DataFrame. The file is parsed once, and only the requested
+    columns are read.
 
     :param input_file:      The path to the input file.
     :param sheet_name:      (Optional) The sheet name if the input is an Excel file.
+    :param columns:         (Optional) The names of the columns to read, as after cleaning (e.g. GRID_COLUMNS). By
+                            default all the columns.
     :return: A DataFrame containing the loaded data
     """
 
@@ -16,29 +83,157 @@ def load_data(input_file, sheet_name=None):
     # Check the file extension and handle accordingly
     if file_extension.lower() == '.csv':
         print("Data file loading - CSV file")
-        data = pd.read_csv(filepath_or_buffer=input_file,
-                           dtype={'FTEs': float},
-                           converters={col: str for col in pd.read_csv(input_file, nrows=1).columns if col != 'FTEs'})
+        data = read_csv(input_file=input_file, usecols=get_usecols(columns=columns))
     elif file_extension.lower() in ['.xlsx', '.xls']:
         print("Mapping file loading - Excel file.")
-        data = pd.read_excel(io=input_file, sheet_name=sheet_name)
+        with WorkbookReader(input_file=input_file) as workbook:
+            data = workbook.read_sheets(sheet_names=sheet_name, columns=columns)
     else:
-        print("Unknown file extension.")
-        exit()
+        raise errors.InputError(f'Unknown file extension: {input_file}')
 
     return data
 
 
+def load_data_chunks(input_file, chunk_size, columns=None):
+    """
+    Loads a CSV file chunk by chunk, with the same types as load_data.
+
+    :param input_file:  The path to the CSV file.
+    :param chunk_size:  The number of rows of the chunks.
+    :param columns:     (Optional) The names of the columns to read, as after cleaning. By default all the columns.
+    :return: An iterator of DataFrames
+    """
+
+    _, file_extension = os.path.splitext(input_file)
+
+    if file_extension.lower() != '.csv':
+        print(f"Only CSV files can be loaded chunk by chunk: {input_file}")
+        exit()
+
+    print(f"Data file loading - CSV file, chunks of {chunk_size} rows")
+
+    return read_csv(input_file=input_file, usecols=get_usecols(columns=columns), chunk_size=chunk_size)
+
+
+def get_header_names(values):
+    """
+    Names the columns of a header row as pandas does when it reads the header of a file: empty cells are named
+    'Unnamed: <position>' and repeated names get a '.<number>' suffix not used by another column, the named columns
+    first.
+
+    :param values:  A list with the cells of the header row.
+    :return: A list with the column names
+    """
+
+    unnamed = [position for position, value in enumerate(values) if pd.isna(value)]
+    names = [f'Unnamed: {position}' if pd.isna(value) else value for position, value in enumerate(values)]
+
+    counts = defaultdict(int)
+    for position in [x for x in range(len(names)) if x not in unnamed] + unnamed:
+        name = names[position]
+        count = counts[name]
+        if count > 0:
+            while count > 0:
+                counts[names[position]] = count + 1
+                name = f'{names[position]}.{count}'
+                count = count + 1 if name in names else counts[name]
+        names[position] = name
+        counts[name] = count + 1
+
+    return names
+
+
+class WorkbookReader:
+    """
+    Reads an Excel workbook opened once: several sheets, or the cells of a sheet parsed once and then split into a
+    title, a header and a body, instead of one parse of the file for every part.
+    """
+
+    def __init__(self, input_file):
+        """
+        :param input_file:  The path to the Excel file.
+        """
+
+        self.input_file = input_file
+        self.workbook = pd.ExcelFile(input_file, engine=EXCEL_ENGINE)
+        self.cells = {}
+
+    @property
+    def sheet_names(self):
+        """
+        :return: A list with the names of the sheets of the workbook
+        """
+
+        return self.workbook.sheet_names
+
+    def read_sheets(self, sheet_names, columns=None):
+        """
+        :param sheet_names:     A list with the names of the sheets to read, one sheet name, or None for all the sheets.
+        :param columns:         (Optional) The names of the columns to read, as after cleaning. By default all the
+                                columns.
+        :return: A dictionary with the sheet names and their DataFrame, the first row of every sheet being its header,
+        or the DataFrame of the sheet when one sheet name is given
+        """
+
+        return self.workbook.parse(sheet_name=sheet_names, usecols=get_usecols(columns=columns))
+
+    def read_cells(self, sheet_name=0):
+        """
+        :param sheet_name:  The name or the position of the sheet.
+        :return: A DataFrame with the cells of the sheet up to its last non-empty row, without header and as they are
+        read (object columns). The sheet is parsed the first time only.
+        """
+
+        if sheet_name not in self.cells:
+            self.cells[sheet_name] = self.workbook.parse(sheet_name=sheet_name, header=None, dtype=object)
+
+        return self.cells[sheet_name]
+
+    def read_table(self, sheet_name=0, header_row=0):
+        """
+        Reads the rows of a sheet below a header row as a table, as DataFrame.read_excel does with skiprows=header_row.
+        The body ends at the last non-empty row of the sheet.
+
+        :param sheet_name:  The name or the position of the sheet.
+        :param header_row:  The position of the header row.
+        :return: A DataFrame with the rows below the header row
+        """
+
+        cells = self.read_cells(sheet_name=sheet_name)
+        data = cells.iloc[header_row + 1:].reset_index(drop=True)
+        data.columns = get_header_names(values=cells.iloc[header_row].tolist())
+
+        # The columns are typed from their body only, as if the title and the header had not been read with them
+        return data.infer_objects()
+
+    def close(self):
+        """
+        :return: None
+        """
+
+        self.workbook.close()
+
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def load_single_agency_data(input_file):
     """
-    Loads data for a single agency from an Excel file.
+    Loads data for a single agency from an Excel file. The sheet is parsed once: the agency name is its first cell, the
+    header is the second row and the body goes to the last non-empty row.
 
     :param input_file:  The path to the input file.
     :return: A tuple with the agency name and its corresponding data as a DataFrame
     """
 
-    kpi_agency = pd.read_excel(io=input_file, header=None).iloc[0, 0].lower()
-    data = pd.read_excel(io=input_file, skiprows=1, nrows=111)
+    with WorkbookReader(input_file=input_file) as workbook:
+        kpi_agency = workbook.read_cells().iloc[0, 0].lower()
+        data = workbook.read_table(header_row=1)
     data = data.iloc[1:, :]
 
     print(f'\t - Single agency file for: {kpi_agency.title()}')
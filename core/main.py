@@ -1,128 +1,242 @@
-import os
 import argparse
 from pathlib import Path
 
-import loading
-import operations
-import processing
-import transforming
-
-parser = argparse.ArgumentParser(description="Agency Grid")
-
-parser.add_argument('--input_file', '-f',
-                    type=Path,
-                    dest='current_month_file',
-                    help='Path to the current month data',
-                    default=None, required=True)
-
-parser.add_argument('--mapping_file', '-mf',
-                    type=Path,
-                    dest='mapping_file',
-                    help='Path to the mapping file provided by the Finance Department',
-                    default=None, required=True)
-
-parser.add_argument('--missing_agency_files', '-maf',
-                    type=str,
-                    nargs='+',  # One or more values
-                    dest='missing_agency_files',
-                    help='A list of file paths to be processed.',
-                    default=None, required=False)
-
-parser.add_argument('--current_year', '-cy',
-                    type=int,
-                    dest='current_year',
-                    help='Year of the current month file',
-                    default=None, required=True)
-
-parser.add_argument('--current_month', '-cm',
-                    type=int,
-                    dest='current_month',
-                    help='Month of the current month file',
-                    default=None, required=True)
-
-parser.add_argument('--output_dir', '-o',
-                    type=Path,
-                    dest='output_dir',
-                    help='Path to the output directory',
-                    default=None, required=True)
-
-parser.add_argument('--debug', '-d',
-                    type=bool,
-                    dest='debug_option',
-                    help='Flag to activate debug mode',
-                    default=False, required=False)
-
-args = parser.parse_args()
+import pandas as pd
+
+from . import errors
+from . import operations
+from . import pipeline
+from . import querying
+from . import streaming
+
+
+def get_parser():
+    """
+    :return: The parser of the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Agency Grid")
+
+    parser.add_argument('--input_file', '-f',
+                        type=Path,
+                        dest='current_month_file',
+                        help='Path to the current month data',
+                        default=None, required=True)
+
+    parser.add_argument('--mapping_file', '-mf',
+                        type=Path,
+                        dest='mapping_file',
+                        help='Path to the mapping file provided by the Finance Department',
+                        default=None, required=True)
+
+    parser.add_argument('--missing_agency_files', '-maf',
+                        type=str,
+                        nargs='+',  # One or more values
+                        dest='missing_agency_files',
+                        help='A list of file paths to be processed.',
+                        default=None, required=False)
+
+    parser.add_argument('--current_year', '-cy',
+                        type=int,
+                        dest='current_year',
+                        help='Year of the current month file',
+                        default=None, required=True)
+
+    parser.add_argument('--current_month', '-cm',
+                        type=int,
+                        dest='current_month',
+                        help='Month of the current month file',
+                        default=None, required=True)
+
+    parser.add_argument('--output_dir', '-o',
+                        type=Path,
+                        dest='output_dir',
+                        help='Path to the output directory',
+                        default=None, required=True)
+
+    parser.add_argument('--cache_dir', '-cd',
+                        type=Path,
+                        dest='cache_dir',
+                        help='Path to the directory of the compiled mapping and the decisions kept between runs',
+                        default=None, required=False)
+
+    parser.add_argument('--workers', '-w',
+                        type=int,
+                        dest='workers',
+                        help='Number of worker processes for the single agency files',
+                        default=1, required=False)
+
+    parser.add_argument('--filter_sentinels', '-fs',
+                        type=str,
+                        nargs='+',  # One or more values
+                        dest='filter_sentinels',
+                        help='Values avoiding a row of the Agency Grid (default: empty, not assigned and not included)',
+                        default=None, required=False)
+
+    parser.add_argument('--filter_rules', '-fr',
+                        action='store_true',
+                        dest='filter_rules',
+                        help='Flag to report in the avoided rows the rule that excluded them',
+                        default=False, required=False)
+
+    parser.add_argument('--fc_sparse', '-fcs',
+                        action='store_true',
+                        dest='fc_sparse',
+                        help='Flag to only write the existing fc code and department fc code combinations',
+                        default=False, required=False)
+
+    parser.add_argument('--output_format', '-of',
+                        type=str,
+                        choices=['xlsx', 'csv', 'parquet'],
+                        dest='output_format',
+                        help='Format of the output files',
+                        default='xlsx', required=False)
+
+    parser.add_argument('--full_output_format', '-fof',
+                        type=str,
+                        choices=['xlsx', 'csv', 'parquet'],
+                        dest='full_output_format',
+                        help='Format of the full Agency Grid output file (default: the format of the output files)',
+                        default=None, required=False)
+
+    parser.add_argument('--writer_workers', '-ww',
+                        type=int,
+                        dest='writer_workers',
+                        help='Number of output files written at the same time',
+                        default=4, required=False)
+
+    parser.add_argument('--incremental', '-inc',
+                        action='store_true',
+                        dest='incremental',
+                        help='Flag to only recompute the agencies whose inputs changed (needs --cache_dir)',
+                        default=False, required=False)
+
+    parser.add_argument('--chunk_size', '-cs',
+                        type=int,
+                        dest='chunk_size',
+                        help='Number of grid rows processed at once, to stream a CSV grid too large for memory',
+                        default=None, required=False)
+
+    parser.add_argument('--engine', '-e',
+                        type=str,
+                        choices=['pandas', 'polars'],
+                        dest='engine',
+                        help='Engine of the clean, transform, process, filter and FC stages (polars needs polars and '
+                             'pyarrow)',
+                        default='pandas', required=False)
+
+    parser.add_argument('--check_engine', '-ce',
+                        action='store_true',
+                        dest='check_engine',
+                        help='Flag to also run the pandas engine and check that the outputs of the engine are the same',
+                        default=False, required=False)
+
+    parser.add_argument('--validate', '-val',
+                        action='store_true',
+                        dest='validate',
+                        help='Flag to check the structure of all the input files before processing them',
+                        default=False, required=False)
+
+    parser.add_argument('--history_dir', '-hd',
+                        type=Path,
+                        dest='history_dir',
+                        help='Path to the history store the filtered and FC files of the month are appended to',
+                        default=None, required=False)
+
+    parser.add_argument('--memory_budget', '-mb',
+                        type=float,
+                        dest='memory_budget',
+                        help='Peak resident memory allowed to the run in MB: turns on the low memory mode and reports '
+                             'the stages going over it',
+                        default=None, required=False)
+
+    parser.add_argument('--trace_memory', '-tm',
+                        action='store_true',
+                        dest='trace_memory',
+                        help='Flag to report the peak of memory allocated by Python in every stage (slower)',
+                        default=False, required=False)
+
+    parser.add_argument('--profile', '-p',
+                        action='store_true',
+                        dest='profile',
+                        help='Flag to write a cProfile dump of every stage in the output directory',
+                        default=False, required=False)
+
+    parser.add_argument('--debug', '-d',
+                        type=bool,
+                        dest='debug_option',
+                        help='Flag to activate debug mode',
+                        default=False, required=False)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs the Agency Grid pipeline for the month given in the command line arguments.
+
+    :param argv:    (Optional) The command line arguments. By default sys.argv.
+    :return: A dictionary with the artifact names and the paths to their output files
+    """
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.chunk_size is not None and (args.engine != 'pandas' or args.check_engine):
+        parser.error('--chunk_size streams the grid with the pandas engine, --engine and --check_engine do not apply')
+
+    if args.memory_budget is not None:
+        # Shallow copies in the low memory mode (see transforming.copy_frame), for this program only
+        pd.set_option('mode.copy_on_write', True)
+
+    profile_dir = None
+    if args.profile:
+        profile_dir = pipeline.get_profile_dir(args.output_dir, args.current_year, args.current_month)
+
+    agency_grid = pipeline.AgencyGridPipeline(current_month_file=args.current_month_file,
+                                              current_year=args.current_year, current_month=args.current_month,
+                                              mapping_file=args.mapping_file,
+                                              missing_agency_files=args.missing_agency_files,
+                                              cache_dir=args.cache_dir, workers=args.workers,
+                                              filter_sentinels=args.filter_sentinels, filter_rules=args.filter_rules,
+                                              fc_sparse=args.fc_sparse, incremental=args.incremental,
+                                              trace_memory=args.trace_memory, profile_dir=profile_dir,
+                                              engine=args.engine, memory_budget=args.memory_budget)
+
+    if args.validate:
+        agency_grid.validate()
+
+    if args.chunk_size is None:
+        output_files = agency_grid.write(output_dir=args.output_dir, output_format=args.output_format,
+                                         full_output_format=args.full_output_format,
+                                         writer_workers=args.writer_workers, history_dir=args.history_dir)
+    else:
+        if args.history_dir is not None:
+            print('The history store is not updated in streaming mode, the filtered grid is not held in memory')
+        output_files = streaming.stream_agency_grid(agency_grid=agency_grid, output_dir=args.output_dir,
+                                                    chunk_size=args.chunk_size, output_format=args.output_format,
+                                                    full_output_format=args.full_output_format)
+    agency_grid.department_matcher.save()
+
+    if args.check_engine:
+        operations.insert_divider_line(message='ENGINE EQUIVALENCE', end=False)
+        reference = agency_grid.for_month(current_month_file=args.current_month_file, current_year=args.current_year,
+                                          current_month=args.current_month,
+                                          missing_agency_files=args.missing_agency_files, engine='pandas',
+                                          incremental=False)
+        is_equivalent = querying.check_equivalence(agency_grid=agency_grid, reference=reference)
+        operations.insert_divider_line(message='ENGINE EQUIVALENCE', end=True)
+        if not is_equivalent:
+            print(f'The {args.engine} engine gives different outputs from the pandas engine')
+            exit(1)
+
+    return output_files
+
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-
-    cm_file = args.current_month_file
-    mapping_file = args.mapping_file
-    missing_agency_files = args.missing_agency_files
-    current_year = args.current_year
-    current_month = args.current_month
-    output_dir = args.output_dir
-    debug_option = args.debug_option
-
-    # Loading data
-    df_agency = {}
-    df_grid = loading.load_data(input_file=cm_file, sheet_name=None)
-    df_map = {'departments': loading.load_data(input_file=mapping_file, sheet_name='Department mapping'),
-              'countries': loading.load_data(input_file=mapping_file, sheet_name='Countries mapping')}
-    df_date = operations.get_dates(month=current_month, year=current_year)
-
-    # ETL
-    for key, value in df_map.items():
-        df_map[key] = transforming.clean_up_data(data=df_map[key])
-        df_map[key] = transforming.transform_mapping(data=df_map[key], key=key)
-
-    df_grid = transforming.clean_up_data(data=df_grid)
-    df_grid = transforming.transform_data(data=df_grid, country_map=df_map['countries'])
-
-    operations.insert_divider_line(message='INITIAL INFORMATION ABOUT AGENCIES', end=False)
-    missing_agencies, extra_agencies = operations.get_missing_agencies(country_map=df_map['countries'],
-                                                                       current_month_data=df_grid)
-    operations.print_info_about_agencies(missing_agency=missing_agencies, extra_agency=extra_agencies, date=df_date)
-    operations.insert_divider_line(message='INITIAL INFORMATION ABOUT AGENCIES', end=True)
-
-    # TODO:
-    # If missing agencies
-    operations.insert_divider_line(message='SINGLE AGENCIES', end=False)
-    if missing_agency_files is not None:
-        for file in missing_agency_files:
-            agency, data_missing = loading.load_single_agency_data(input_file=file)
-            print(f'\t - {agency.capitalize()}: Data loaded')
-            data_missing = transforming.clean_up_data(data=data_missing)
-            print(f'\t - {agency.capitalize()}: Data cleaned-up')
-            df_agency[agency] = {'raw': data_missing}
-
-            # transform mapping data
-            fte = transforming.transform_single_data(data=df_agency[agency]['raw'], agency=agency,
-                                                     country_map=df_map['countries'],
-                                                     department_map=df_map['departments'], date=df_date)
-            df_agency[agency]['fte'] = fte
-            print('\n')
-
-    # operations.alerting_about_missing_agencies(single_agencies=df_agency, missing_agencies=missing_agencies)
-    operations.insert_divider_line(message='SINGLE AGENCIES', end=True)
-
-    operations.insert_divider_line(message='MERGING GRID WITH SINGLE AGENCIES', end=False)
-    agency_grid = processing.merge_grid_with_single_agency(single_agencies=df_agency, agency_grid=df_grid)
-    print('\n')
-    agency_grid = processing.process_data(data=agency_grid, country_map=df_map['countries'])
-    agency_grid.to_excel(excel_writer=os.path.join(output_dir, f'{current_year}_{current_month:02}_AG_full.xlsx'), index=False)
-    operations.insert_divider_line(message='MERGING GRID WITH SINGLE AGENCIES', end=True)
-
-    operations.insert_divider_line(message='FINAL INFORMATION ABOUT AGENCIES', end=False)
-    missing_agencies, extra_agencies = operations.get_missing_agencies(country_map=df_map['countries'],
-                                                                       current_month_data=agency_grid)
-    operations.print_info_about_agencies(missing_agency=missing_agencies, extra_agency=extra_agencies, date=df_date)
-    operations.insert_divider_line(message='FINAL INFORMATION ABOUT AGENCIES', end=True)
-
-    avoided_grid, filtered_grid = processing.filter_agency_grid(data=agency_grid)
-    avoided_grid.to_excel(excel_writer=os.path.join(output_dir, f'{current_year}_{current_month:02}_AG_avoided.xlsx'), index=False)
-    filtered_grid.to_excel(excel_writer=os.path.join(output_dir, f'{current_year}_{current_month:02}_AG_filtered.xlsx'), index=False)
-
-    fc_grid = processing.get_fc_file(data=filtered_grid)
-    fc_grid.to_excel(excel_writer=os.path.join(output_dir, f'{current_year}_{current_month:02}_AG_FC.xlsx'), index=False)
+    try:
+        main()
+    except errors.InputError as error:
+        # Inconsistent inputs are reported without a traceback
+        print(error)
+        exit(1)
@@ -0,0 +1,235 @@
+import os
+import copy
+import json
+import hashlib
+import difflib
+from collections import defaultdict
+
+from . import errors
+
+
+def normalize_name(name):
+    """
+    Normalizes a department name the same way clean_up_data cleans the cells: no asterisks, single spaces and
+    lowercase.
+
+    :param name:    The department name.
+    :return: The normalized name used as a key for exact matches.
+    """
+
+    return ' '.join(str(name).replace('*', '').split()).lower()
+
+
+def get_ngrams(name, size=3):
+    """
+    Splits a name into its overlapping character n-grams. The name is padded with spaces so that short names still
+    produce n-grams.
+
+    :param name:    The name to be split.
+    :param size:    The length of the n-grams.
+    :return: A set with the n-grams of the name.
+    """
+
+    padded = f' {name} '
+    return {padded[i:i + size] for i in range(max(len(padded) - size + 1, 1))}
+
+
+class DepartmentMatcher:
+    """
+    Resolves the department names found in the single agency files to the department FC codes of the department
+    mapping. It is built once per mapping and gives the same answer as difflib.get_close_matches over the whole
+    mapping, but:
+    - Names equal to a department of the mapping once normalized are resolved with a hash lookup
+    - Fuzzy matches only score the departments sharing n-grams with the name first, the remaining departments are
+      only scored when difflib's upper bounds show they could still beat the best candidate
+    - Every decision (name, department, code and score) is kept and can be persisted in a JSON file, so that the next
+      monthly runs skip the fuzzy matching and the fuzzy decisions can be reviewed
+    """
+
+    def __init__(self, department_map, cutoff=0.6, ngram_size=3, cache_file=None):
+        """
+        Builds the exact and n-gram indexes from the department mapping and loads the persisted decisions.
+
+        :param department_map:  DataFrame with the department mapping ('department' and 'department fc code').
+        :param cutoff:          The minimum similarity score accepted for a fuzzy match.
+        :param ngram_size:      The length of the n-grams used to select the fuzzy candidates.
+        :param cache_file:      (Optional) Path to the JSON file where the decisions are persisted.
+        """
+
+        self.cutoff = cutoff
+        self.ngram_size = ngram_size
+        self.cache_file = cache_file
+
+        self.departments = []
+        self.codes = {}
+        self.exact = {}
+        self.ngrams = defaultdict(set)
+
+        for department, code in zip(department_map['department'], department_map['department fc code']):
+            # As in the boolean scan of the mapping, the first row of a department gives its code
+            if department in self.codes:
+                continue
+            position = len(self.departments)
+            self.departments.append(department)
+            self.codes[department] = code
+            self.exact.setdefault(normalize_name(department), department)
+            for ngram in get_ngrams(department, size=ngram_size):
+                self.ngrams[ngram].add(position)
+
+        self.fingerprint = hashlib.sha1(json.dumps(list(self.codes.items())).encode('utf-8')).hexdigest()
+        self.decisions = {}
+        self.is_modified = False
+        self.load()
+
+    def load(self):
+        """
+        Loads the decisions persisted in the cache file. They are discarded when they were taken with another mapping
+        or another cutoff.
+
+        :return: None
+        """
+
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return None
+
+        with open(self.cache_file, 'r', encoding='utf-8') as file:
+            cache = json.load(file)
+
+        if cache.get('mapping') == self.fingerprint and cache.get('cutoff') == self.cutoff:
+            self.decisions = cache.get('matches', {})
+            print(f'\t - Department matches: {len(self.decisions)} decisions loaded from {self.cache_file}')
+        else:
+            print(f'\t - Department matches: the mapping changed, previous decisions in {self.cache_file} discarded')
+
+        return None
+
+    def save(self):
+        """
+        Persists the decisions in the cache file if new ones were taken.
+
+        :return: None
+        """
+
+        if self.cache_file is None or not self.is_modified:
+            return None
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        cache = {'mapping': self.fingerprint,
+                 'cutoff': self.cutoff,
+                 'matches': dict(sorted(self.decisions.items()))}
+        with open(self.cache_file, 'w', encoding='utf-8') as file:
+            json.dump(cache, file, indent=4, ensure_ascii=False)
+        self.is_modified = False
+
+        return None
+
+    def copy(self):
+        """
+        Gives a matcher sharing the indexes of this one, with its own copy of the decisions and no cache file, e.g. for
+        a job running next to others. Its new decisions are added back with update.
+
+        :return: The DepartmentMatcher copy
+        """
+
+        matcher = copy.copy(self)
+        matcher.cache_file = None
+        matcher.decisions = dict(self.decisions)
+        matcher.is_modified = False
+
+        return matcher
+
+    def update(self, decisions):
+        """
+        Adds decisions taken by another matcher built from the same mapping, e.g. in a worker process.
+
+        :param decisions:   A dictionary of decisions as in the decisions attribute.
+        :return: None
+        """
+
+        for name, decision in decisions.items():
+            if name not in self.decisions:
+                self.decisions[name] = decision
+                self.is_modified = True
+
+        return None
+
+    def get_fuzzy_match(self, name):
+        """
+        Finds the department of the mapping closest to a name, as difflib.get_close_matches(name, departments, n=1)
+        would do.
+
+        :param name:    The department name to be matched.
+        :return: A tuple with the matched department and its score, or (None, 0.0) if no department reaches the cutoff.
+        """
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(name)
+        best = (self.cutoff, None)
+        found = False
+
+        def score(position):
+            nonlocal best, found
+            department = self.departments[position]
+            matcher.set_seq1(department)
+            bound = best[0]
+            if matcher.real_quick_ratio() < bound or matcher.quick_ratio() < bound:
+                return None
+            ratio = matcher.ratio()
+            if ratio >= bound and (not found or (ratio, department) > best):
+                best = (ratio, department)
+                found = True
+            return None
+
+        # Departments sharing the most n-grams with the name are scored first
+        overlap = defaultdict(int)
+        for ngram in get_ngrams(name, size=self.ngram_size):
+            for position in self.ngrams.get(ngram, ()):
+                overlap[position] += 1
+        for position in sorted(overlap, key=lambda x: (-overlap[x], x)):
+            score(position)
+
+        # The other departments can only win if their upper bounds reach the best score found so far
+        for position in range(len(self.departments)):
+            if position not in overlap:
+                score(position)
+
+        return (best[1], best[0]) if found else (None, 0.0)
+
+    def get_code(self, name):
+        """
+        Resolves a department name to its department FC code.
+
+        :param name:    The department name of the single agency file.
+        :return: The department FC code. An InputError is raised if no department is close enough to the name.
+        """
+
+        if name in self.decisions:
+            return self.decisions[name]['department fc code']
+
+        department = self.exact.get(normalize_name(name))
+        score = 1.0
+        if department is None:
+            department, score = self.get_fuzzy_match(name)
+
+        if department is None:
+            raise errors.InputError(f'Impossible to find a department in the mapping close to "{name}".')
+
+        if score < 1.0:
+            print(f'\t - Department "{name}" matched to "{department}" (score {score:.2f})')
+
+        self.decisions[name] = {'department': department,
+                                'department fc code': self.codes[department],
+                                'score': round(score, 4)}
+        self.is_modified = True
+
+        return self.codes[department]
+
+    def get_codes(self, names):
+        """
+        Resolves several department names to their department FC codes.
+
+        :param names:   An iterable with department names. Values that are not strings are not resolved.
+        :return: A dictionary with the names and their department FC codes.
+        """
+
+        return {name: self.get_code(name) for name in names if isinstance(name, str)}
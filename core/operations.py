@@ -1,6 +1,8 @@
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
+from . import indexing
+
 
 def insert_divider_line(message, end=False):
     """
@@ -40,15 +42,19 @@ def get_dates(month, year):
     return date_dict
 
 
-def get_missing_agencies(country_map, current_month_data):
+def get_missing_agencies(country_map, current_month_data, mapping_index=None):
     """
     Identifies missing and extra agencies by comparing the country map and current month data.
 
     :param country_map:         A DataFrame with agency data from the mapping.
     :param current_month_data:  A DataFrame with agency data from the current month's data.
+    :param mapping_index:       (Optional) MappingIndex of the country map, with its agencies already known.
     :return: Two lists containing missing and extra agencies.
     """
 
+    if mapping_index is not None:
+        return mapping_index.get_missing_agencies(agencies=current_month_data['kpi agency'].unique())
+
     agencies_in_map = set(sorted(country_map['kpi agency']))
     agencies_in_file = set(sorted(current_month_data['kpi agency']))
 
@@ -127,29 +133,19 @@ def alerting_about_missing_agencies(single_agencies, missing_agencies):
     return None
 
 
-def get_agency_code(country_map, agency):
+def get_agency_code(country_map, agency, mapping_index=None):
     """
     Retrieves the FC code corresponding to a specific agency from the country map. If multiple or no FC codes are found,
     it raises an error.
 
     :param country_map:     A DataFrame containing the mapping of agencies to FC codes.
     :param agency:          The name of the agency for which to find the FC code.
+    :param mapping_index:   (Optional) MappingIndex of the country map. Without it the index is built for this lookup.
     :return: The FC code associated with the agency. If no or multiple codes are found, an error is printed and the
     program exits.
     """
 
-    condition = country_map['kpi_agency'] == agency
-    fc_codes = set(country_map.loc[condition, 'fc_code'].tolist())
-
-    if len(fc_codes) == 0:
-        print(f'Impossible to find a FC CODE corresponding to {agency}.')
-        exit()
-    elif len(fc_codes) > 1:
-        print('More than one FC CODE found:')
-        print(f"{', '.join(fc_codes)}")
-        print('Impossible to decide.')
-        exit()
-    else:
-        entity_fc_code = fc_codes.pop()
+    if mapping_index is None:
+        mapping_index = indexing.MappingIndex(country_map=country_map)
 
-    return entity_fc_code
+    return mapping_index.get_fc_code(agency=agency)
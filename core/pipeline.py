@@ -0,0 +1,741 @@
+import os
+import json
+import hashlib
+import functools
+import pandas as pd
+
+from . import archiving
+from . import caching
+from . import loading
+from . import matching
+from . import indexing
+from . import ingesting
+from . import operations
+from . import processing
+from . import querying
+from . import profiling
+from . import transforming
+from . import validating
+from . import writing
+
+
+def print_info_about_agencies(message, country_map, data, date, mapping_index=None):
+    """
+    Prints between divider lines the missing and extra agencies of data compared with the mapping.
+
+    :param message:         The message of the divider lines.
+    :param country_map:     A DataFrame with the country mapping.
+    :param data:            A DataFrame with the agencies of the current month.
+    :param date:            A dictionary with date information.
+    :param mapping_index:   (Optional) MappingIndex of the country mapping.
+    :return: None (prints to console).
+    """
+
+    operations.insert_divider_line(message=message, end=False)
+    missing_agencies, extra_agencies = operations.get_missing_agencies(country_map=country_map,
+                                                                       current_month_data=data,
+                                                                       mapping_index=mapping_index)
+    operations.print_info_about_agencies(missing_agency=missing_agencies, extra_agency=extra_agencies, date=date)
+    operations.insert_divider_line(message=message, end=True)
+
+    return None
+
+
+def get_profile_dir(output_dir, current_year, current_month):
+    """
+    :param output_dir:      Path to the output directory.
+    :param current_year:    Year of the current month file.
+    :param current_month:   Month of the current month file.
+    :return: The path to the directory of the cProfile dumps of the month
+    """
+
+    return os.path.join(output_dir, f'{current_year}_{current_month:02}_AG_profiles')
+
+
+def categorize_frames(country_map, df_grid, df_agency):
+    """
+    Converts the repeated text columns of the country mapping, the grid and the single agencies to categoricals
+    sharing the same categories, so that the merges and the groupbys downstream run on integer codes.
+
+    :param country_map:     A DataFrame with the country mapping. It is copied, the prepared mapping is shared.
+    :param df_grid:         The transformed grid DataFrame.
+    :param df_agency:       A dictionary with the single agency data, converted in place.
+    :return: The categorized country mapping and grid
+    """
+
+    categories = transforming.get_categories(frames=[country_map, df_grid] + [x['fte'] for x in df_agency.values()])
+
+    country_map = transforming.categorize(data=country_map.copy(), categories=categories)
+    df_grid = transforming.categorize(data=df_grid, categories=categories)
+    for value in df_agency.values():
+        value['fte'] = transforming.categorize(data=value['fte'], categories=categories)
+
+    return country_map, df_grid
+
+
+def load_grid(current_month_file, df_map, df_date, recorder, mapping_index=None):
+    """
+    Loads, cleans and transforms the grid of the current month.
+
+    :param current_month_file:      Path to the current month data.
+    :param df_map:                  A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param df_date:                 A dictionary with date information.
+    :param recorder:                StageRecorder measuring the stages of the run.
+    :param mapping_index:           (Optional) MappingIndex of the country mapping.
+    :return: The transformed grid DataFrame
+    """
+
+    # Loading data
+    with recorder.stage(name='load') as record:
+        df_grid = loading.load_data(input_file=current_month_file, sheet_name=None, columns=loading.GRID_COLUMNS)
+        record['rows_out'] = len(df_grid)
+
+    # ETL
+    with recorder.stage(name='clean', rows_in=len(df_grid)) as record:
+        df_grid = transforming.clean_up_data(data=df_grid)
+        record['rows_out'] = len(df_grid)
+    with recorder.stage(name='transform', rows_in=len(df_grid)) as record:
+        df_grid = transforming.transform_data(data=df_grid)
+        record['rows_out'] = len(df_grid)
+
+    print_info_about_agencies(message='INITIAL INFORMATION ABOUT AGENCIES', country_map=df_map['countries'],
+                              data=df_grid, date=df_date, mapping_index=mapping_index)
+
+    return df_grid
+
+
+def load_single_agencies(missing_agency_files, df_map, df_date, department_matcher, recorder, workers=1,
+                         mapping_index=None, keep_raw=True):
+    """
+    Loads, cleans and transforms the single agency files. Agencies unknown to the country mapping are reported, their
+    rows will be avoided.
+
+    :param missing_agency_files:    A list of paths to single agency files, or None.
+    :param df_map:                  A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param df_date:                 A dictionary with date information.
+    :param department_matcher:      DepartmentMatcher built from the department mapping.
+    :param recorder:                StageRecorder measuring the stages of the run.
+    :param workers:                 Number of worker processes for the single agency files.
+    :param mapping_index:           (Optional) MappingIndex of the country mapping.
+    :param keep_raw:                Whether to keep the cleaned-up DataFrame of every file ('raw').
+    :return: A dictionary with the agencies and their 'raw' (if kept), 'fte' and 'file'
+    """
+
+    df_agency = {}
+
+    # TODO:
+    # If missing agencies
+    operations.insert_divider_line(message='SINGLE AGENCIES', end=False)
+    if missing_agency_files is not None:
+        with recorder.stage(name='single agencies', rows_in=len(missing_agency_files)) as record:
+            df_agency = ingesting.ingest_single_agency_files(input_files=missing_agency_files,
+                                                             country_map=df_map['countries'],
+                                                             department_map=df_map['departments'], date=df_date,
+                                                             department_matcher=department_matcher, workers=workers,
+                                                             keep_raw=keep_raw)
+            record['rows_out'] = sum(len(value['fte']) for value in df_agency.values())
+
+    if mapping_index is not None:
+        for agency in df_agency:
+            if not mapping_index.has_agency(agency):
+                print(f'\t - {agency.capitalize()}: agency not found in the COUNTRIES mapping')
+
+    # operations.alerting_about_missing_agencies(single_agencies=df_agency, missing_agencies=missing_agencies)
+    operations.insert_divider_line(message='SINGLE AGENCIES', end=True)
+
+    return df_agency
+
+
+def merge_agency_grid(df_grid, df_agency, df_map, recorder, mapping_index=None):
+    """
+    Merges the grid with the single agencies and processes them with the country mapping.
+
+    :param df_grid:         The transformed grid DataFrame.
+    :param df_agency:       A dictionary with the single agency data.
+    :param df_map:          A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param recorder:        StageRecorder measuring the stages of the run.
+    :param mapping_index:   (Optional) MappingIndex of the country mapping.
+    :return: The processed Agency Grid DataFrame
+    """
+
+    operations.insert_divider_line(message='MERGING GRID WITH SINGLE AGENCIES', end=False)
+    rows_in = len(df_grid) + sum(len(value['fte']) for value in df_agency.values())
+    with recorder.stage(name='categorize', rows_in=rows_in) as record:
+        country_map, df_grid = categorize_frames(country_map=df_map['countries'], df_grid=df_grid, df_agency=df_agency)
+        record['rows_out'] = rows_in
+    with recorder.stage(name='merge', rows_in=rows_in) as record:
+        agency_grid = processing.merge_grid_with_single_agency(single_agencies=df_agency, agency_grid=df_grid)
+        record['rows_out'] = len(agency_grid)
+    # The grid and the single agencies are freed here unless the caller keeps them
+    del df_grid, df_agency
+    print('\n')
+    with recorder.stage(name='process', rows_in=len(agency_grid)) as record:
+        agency_grid = processing.process_data(data=agency_grid, country_map=country_map, mapping_index=mapping_index)
+        record['rows_out'] = len(agency_grid)
+    operations.insert_divider_line(message='MERGING GRID WITH SINGLE AGENCIES', end=True)
+
+    return agency_grid
+
+
+def build_agency_grid(current_month_file, missing_agency_files, df_map, df_date, department_matcher, workers=1,
+                      recorder=None, mapping_index=None):
+    """
+    Loads and transforms the grid and the single agency files, merges them and processes them with the country
+    mapping.
+
+    :param current_month_file:      Path to the current month data.
+    :param missing_agency_files:    A list of paths to single agency files, or None.
+    :param df_map:                  A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param df_date:                 A dictionary with date information.
+    :param department_matcher:      DepartmentMatcher built from the department mapping.
+    :param workers:                 Number of worker processes for the single agency files.
+    :param recorder:                (Optional) StageRecorder measuring the stages of the run.
+    :param mapping_index:           (Optional) MappingIndex of the country mapping. Built here when not given.
+    :return: The processed Agency Grid DataFrame
+    """
+
+    recorder = recorder or profiling.StageRecorder()
+    mapping_index = mapping_index or indexing.MappingIndex(country_map=df_map['countries'])
+
+    df_grid = load_grid(current_month_file=current_month_file, df_map=df_map, df_date=df_date, recorder=recorder,
+                        mapping_index=mapping_index)
+    df_agency = load_single_agencies(missing_agency_files=missing_agency_files, df_map=df_map, df_date=df_date,
+                                     department_matcher=department_matcher, recorder=recorder, workers=workers,
+                                     mapping_index=mapping_index)
+
+    return merge_agency_grid(df_grid=df_grid, df_agency=df_agency, df_map=df_map, recorder=recorder,
+                             mapping_index=mapping_index)
+
+
+def build_agency_grid_incremental(current_month_file, missing_agency_files, df_map, df_date, department_matcher,
+                                  agency_store, workers=1, recorder=None, mapping_index=None):
+    """
+    Builds the processed Agency Grid like build_agency_grid, but only recomputes the agencies whose inputs changed
+    since the previous run of the month. The fingerprint of an agency covers its rows in the grid, its single agency
+    files, its rows in the country mapping, the department mapping (for single agencies), the date and the code.
+    The processed rows of the other agencies are taken from the agency store.
+
+    :param current_month_file:      Path to the current month data.
+    :param missing_agency_files:    A list of paths to single agency files, or None.
+    :param df_map:                  A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param df_date:                 A dictionary with date information.
+    :param department_matcher:      DepartmentMatcher built from the department mapping.
+    :param agency_store:            AgencyStore of the month.
+    :param workers:                 Number of worker processes for the single agency files.
+    :param recorder:                (Optional) StageRecorder measuring the stages of the run.
+    :param mapping_index:           (Optional) MappingIndex of the country mapping. Built here when not given.
+    :return: The processed Agency Grid DataFrame
+    """
+
+    recorder = recorder or profiling.StageRecorder()
+    mapping_index = mapping_index or indexing.MappingIndex(country_map=df_map['countries'])
+
+    # Loading data
+    with recorder.stage(name='load') as record:
+        df_grid = loading.load_data(input_file=current_month_file, sheet_name=None, columns=loading.GRID_COLUMNS)
+        record['rows_out'] = len(df_grid)
+    with recorder.stage(name='clean', rows_in=len(df_grid)) as record:
+        df_grid = transforming.clean_up_data(data=df_grid)
+        record['rows_out'] = len(df_grid)
+
+    print_info_about_agencies(message='INITIAL INFORMATION ABOUT AGENCIES', country_map=df_map['countries'],
+                              data=df_grid, date=df_date, mapping_index=mapping_index)
+
+    # The agency of an unchanged single agency file is known from the previous run, the others are loaded now
+    operations.insert_divider_line(message='SINGLE AGENCIES', end=False)
+    single_agency_files = missing_agency_files or []
+    file_hashes = {file: caching.get_file_hash(input_file=file) for file in single_agency_files}
+    file_agencies = {file: agency_store.get_file_agency(input_file=file, file_hash=file_hashes[file])
+                     for file in single_agency_files}
+
+    def ingest(input_files):
+        if len(input_files) == 0:
+            return {}
+        with recorder.stage(name='single agencies', rows_in=len(input_files)) as ingest_record:
+            df_single = ingesting.ingest_single_agency_files(input_files=input_files,
+                                                             country_map=df_map['countries'],
+                                                             department_map=df_map['departments'], date=df_date,
+                                                             department_matcher=department_matcher, workers=workers)
+            ingest_record['rows_out'] = sum(len(value['fte']) for value in df_single.values())
+        for single_agency, value in df_single.items():
+            file_agencies[value['file']] = single_agency
+            agency_store.set_file_agency(input_file=value['file'], file_hash=file_hashes[value['file']],
+                                         agency=single_agency)
+        return df_single
+
+    df_agency = ingest(input_files=[file for file in single_agency_files if file_agencies[file] is None])
+
+    # Fingerprint of the inputs of every agency
+    with recorder.stage(name='fingerprint', rows_in=len(df_grid)) as record:
+        grid_hashes = caching.get_frame_hashes(data=df_grid, key='kpi agency')
+        country_hashes = caching.get_frame_hashes(data=df_map['countries'], key='kpi agency')
+        # Every module computing the cached rows of an agency
+        code_version = caching.get_code_version(modules=[loading, transforming, processing, matching, ingesting,
+                                                         indexing])
+        agency_file_hashes = {}
+        for file, single_agency in file_agencies.items():
+            if single_agency is not None:
+                agency_file_hashes.setdefault(single_agency, []).append(file_hashes[file])
+
+        fingerprints = {}
+        for agency in list(grid_hashes) + [x for x in agency_file_hashes if x not in grid_hashes]:
+            inputs = [grid_hashes.get(agency),
+                      agency_file_hashes.get(agency, []),
+                      country_hashes.get(agency),
+                      department_matcher.fingerprint if agency in agency_file_hashes else None,
+                      df_date['number'],
+                      code_version]
+            fingerprints[agency] = hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+        df_processed = {}
+        for agency, fingerprint in fingerprints.items():
+            data = agency_store.get(agency=agency, fingerprint=fingerprint)
+            if data is not None:
+                df_processed[agency] = data
+        changed_agencies = [agency for agency in fingerprints if agency not in df_processed]
+        record['rows_out'] = sum(len(data) for data in df_processed.values())
+    print(f'\t - {len(df_processed)} agencies unchanged since the previous run, {len(changed_agencies)} recomputed')
+
+    # Single agency files of changed agencies which were not loaded yet
+    df_agency.update(ingest(input_files=[file for file, single_agency in file_agencies.items()
+                                         if single_agency in changed_agencies and single_agency not in df_agency]))
+    operations.insert_divider_line(message='SINGLE AGENCIES', end=True)
+
+    operations.insert_divider_line(message='MERGING GRID WITH SINGLE AGENCIES', end=False)
+    if len(changed_agencies) > 0:
+        df_changed = df_grid[df_grid['kpi agency'].isin(changed_agencies)].reset_index(drop=True)
+        with recorder.stage(name='transform', rows_in=len(df_changed)) as record:
+            df_changed = transforming.transform_data(data=df_changed)
+            record['rows_out'] = len(df_changed)
+        df_changed_agency = {key: value for key, value in df_agency.items() if key in changed_agencies}
+        rows_in = len(df_changed) + sum(len(value['fte']) for value in df_changed_agency.values())
+        with recorder.stage(name='categorize', rows_in=rows_in) as record:
+            country_map, df_changed = categorize_frames(country_map=df_map['countries'], df_grid=df_changed,
+                                                        df_agency=df_changed_agency)
+            record['rows_out'] = rows_in
+        with recorder.stage(name='merge', rows_in=rows_in) as record:
+            agency_grid = processing.merge_grid_with_single_agency(single_agencies=df_changed_agency,
+                                                                   agency_grid=df_changed)
+            record['rows_out'] = len(agency_grid)
+        print('\n')
+        with recorder.stage(name='process', rows_in=len(agency_grid)) as record:
+            agency_grid = processing.process_data(data=agency_grid, country_map=country_map,
+                                                  mapping_index=mapping_index)
+            record['rows_out'] = len(agency_grid)
+
+        positions = agency_grid.groupby('kpi agency', observed=True, sort=False).indices
+        for agency in changed_agencies:
+            data = agency_grid.iloc[positions.get(agency, [])].reset_index(drop=True)
+            agency_store.put(agency=agency, fingerprint=fingerprints[agency], data=data)
+            df_processed[agency] = data
+    agency_store.save()
+
+    # The processed rows of every agency are sorted, putting the agencies in order gives the merged grid order
+    agency_grid = pd.concat([df_processed[agency] for agency in sorted(df_processed)], ignore_index=True)
+    # Agencies stored by different runs have different categories, the concatenation gives back text columns
+    agency_grid = transforming.categorize(data=agency_grid,
+                                          categories=transforming.get_categories(frames=[df_map['countries'],
+                                                                                         agency_grid]))
+    print(f'Processing Data: {len(agency_grid)} rows in the Agency Grid')
+    operations.insert_divider_line(message='MERGING GRID WITH SINGLE AGENCIES', end=True)
+
+    return agency_grid
+
+
+class AgencyGridPipeline:
+    """
+    The Agency Grid pipeline of one month as lazily evaluated stages: the mapping, the department matcher, the grid,
+    the single agencies, the full grid, the avoided and filtered grids and the FC file are computed the first time they
+    are needed and kept afterwards. Nothing is loaded when the pipeline is created.
+
+    The prepared mapping and the department matcher can be shared with the pipelines of other months (see for_month),
+    so that many months run in the same process without preparing them again.
+    """
+
+    # Stages recomputed when a stage is reset
+    DOWNSTREAM_STAGES = {'mapping': ['mapping_index', 'department_matcher', 'grid', 'single_agencies', 'full_grid',
+                                     'filtered', 'fc_file'],
+                         'mapping_index': ['grid', 'single_agencies', 'full_grid', 'filtered', 'fc_file'],
+                         'department_matcher': ['single_agencies', 'full_grid', 'filtered', 'fc_file'],
+                         'grid': ['full_grid', 'filtered', 'fc_file'],
+                         'single_agencies': ['full_grid', 'filtered', 'fc_file'],
+                         'full_grid': ['filtered', 'fc_file'],
+                         'filtered': ['fc_file'],
+                         'fc_file': []}
+
+    def __init__(self, current_month_file, current_year, current_month, mapping_file=None, missing_agency_files=None,
+                 df_map=None, department_matcher=None, mapping_index=None, cache_dir=None, workers=1,
+                 filter_sentinels=None, filter_rules=False, fc_sparse=False, incremental=False, trace_memory=False,
+                 profile_dir=None, recorder=None, engine='pandas', memory_budget=None):
+        """
+        :param current_month_file:      Path to the current month data.
+        :param current_year:            Year of the current month file.
+        :param current_month:           Month of the current month file.
+        :param mapping_file:            (Optional) Path to the mapping file, when df_map is not given.
+        :param missing_agency_files:    (Optional) A list of paths to single agency files.
+        :param df_map:                  (Optional) A dictionary with the prepared 'departments' and 'countries' mapping
+                                        DataFrames.
+        :param department_matcher:      (Optional) DepartmentMatcher built from the department mapping.
+        :param mapping_index:           (Optional) MappingIndex of the country mapping.
+        :param cache_dir:               (Optional) Path to the directory of the artifacts kept between runs.
+        :param workers:                 Number of worker processes for the single agency files.
+        :param filter_sentinels:        (Optional) Values avoiding a row of the Agency Grid.
+        :param filter_rules:            Whether to report in the avoided rows the rule that excluded them.
+        :param fc_sparse:               Whether to only give the existing combinations in the FC file.
+        :param incremental:             Whether to only recompute the agencies whose inputs changed since the previous
+                                        run of the month. Requires cache_dir.
+        :param trace_memory:            Whether to measure the peak of memory allocated by Python in every stage.
+        :param profile_dir:             (Optional) Path to the directory of the cProfile dumps of the stages.
+        :param recorder:                (Optional) StageRecorder measuring the stages, shared with the caller.
+        :param engine:                  The engine of the clean, transform, process, filter and FC stages: 'pandas'
+                                        (the reference) or 'polars' (multi-threaded query plans, not incremental).
+        :param memory_budget:           (Optional) The peak resident memory allowed to the run, in MB. It turns on the
+                                        low memory mode: the pipeline forgets the stages once they are consumed (see
+                                        release). The stages going over the budget are reported. pandas copy-on-write
+                                        is turned on by the command lines only, see transforming.copy_frame.
+        """
+
+        if mapping_file is None and df_map is None:
+            print('Either a mapping file or a prepared mapping is required')
+            exit()
+        querying.check_engine(engine=engine)
+
+        self.current_month_file = current_month_file
+        self.current_year = current_year
+        self.current_month = current_month
+        self.mapping_file = mapping_file
+        self.missing_agency_files = missing_agency_files
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.filter_sentinels = filter_sentinels
+        self.filter_rules = filter_rules
+        self.fc_sparse = fc_sparse
+        self.incremental = incremental
+        self.engine = engine
+        self.memory_budget = memory_budget
+        self.recorder = recorder or profiling.StageRecorder(trace_memory=trace_memory, profile_dir=profile_dir,
+                                                            memory_budget=memory_budget)
+        self.date = operations.get_dates(month=current_month, year=current_year)
+
+        if df_map is not None:
+            self.mapping = df_map
+        if department_matcher is not None:
+            self.department_matcher = department_matcher
+        if mapping_index is not None:
+            self.mapping_index = mapping_index
+
+    @functools.cached_property
+    def mapping(self):
+        """
+        :return: A dictionary with the prepared 'departments' and 'countries' mapping DataFrames
+        """
+
+        with self.recorder.stage(name='load mapping') as record:
+            df_map = caching.load_mapping(mapping_file=self.mapping_file, cache_dir=self.cache_dir)
+            record['rows_out'] = sum(len(data) for data in df_map.values())
+
+        return df_map
+
+    @functools.cached_property
+    def mapping_index(self):
+        """
+        :return: The MappingIndex of the country mapping
+        """
+
+        return indexing.MappingIndex(country_map=self.mapping['countries'])
+
+    @functools.cached_property
+    def department_matcher(self):
+        """
+        :return: The DepartmentMatcher of the department mapping, with the decisions kept in the cache directory
+        """
+
+        matches_file = None if self.cache_dir is None else os.path.join(self.cache_dir, 'department_matches.json')
+
+        return matching.DepartmentMatcher(department_map=self.mapping['departments'], cache_file=matches_file)
+
+    @functools.cached_property
+    def grid(self):
+        """
+        :return: The transformed grid of the current month
+        """
+
+        return load_grid(current_month_file=self.current_month_file, df_map=self.mapping, df_date=self.date,
+                         recorder=self.recorder, mapping_index=self.mapping_index)
+
+    @functools.cached_property
+    def single_agencies(self):
+        """
+        :return: A dictionary with the single agencies and their 'raw', 'fte' and 'file'
+        """
+
+        return load_single_agencies(missing_agency_files=self.missing_agency_files, df_map=self.mapping,
+                                    df_date=self.date, department_matcher=self.department_matcher,
+                                    recorder=self.recorder, workers=self.workers, mapping_index=self.mapping_index,
+                                    keep_raw=self.memory_budget is None)
+
+    @functools.cached_property
+    def full_grid(self):
+        """
+        :return: The processed Agency Grid. With the polars engine the grid is loaded by the query plan, and in
+        incremental mode by the incremental build, instead of the grid stage.
+        """
+
+        if self.engine == 'polars':
+            # The single agencies are a stage of their own, measured apart from the query plan
+            single_agencies = self.single_agencies
+            with self.recorder.stage(name='polars grid') as record:
+                full_grid = querying.build_agency_grid(current_month_file=self.current_month_file,
+                                                       single_agencies=single_agencies,
+                                                       country_map=self.mapping['countries'])
+                record['rows_out'] = len(full_grid)
+            return full_grid
+
+        if self.incremental and self.cache_dir is not None:
+            agency_store = caching.AgencyStore(cache_dir=self.cache_dir, current_year=self.current_year,
+                                               current_month=self.current_month)
+            return build_agency_grid_incremental(current_month_file=self.current_month_file,
+                                                 missing_agency_files=self.missing_agency_files, df_map=self.mapping,
+                                                 df_date=self.date, department_matcher=self.department_matcher,
+                                                 agency_store=agency_store, workers=self.workers,
+                                                 recorder=self.recorder, mapping_index=self.mapping_index)
+
+        return merge_agency_grid(df_grid=self.consume('grid'), df_agency=self.consume('single_agencies'),
+                                 df_map=self.mapping, recorder=self.recorder, mapping_index=self.mapping_index)
+
+    @functools.cached_property
+    def filtered(self):
+        """
+        :return: Two DataFrames: the avoided rows and the filtered rows of the Agency Grid
+        """
+
+        with self.recorder.stage(name='filter', rows_in=len(self.full_grid)) as record:
+            engine = querying if self.engine == 'polars' else processing
+            avoided_grid, filtered_grid = engine.filter_agency_grid(data=self.full_grid,
+                                                                    sentinels=self.filter_sentinels,
+                                                                    report_rules=self.filter_rules)
+            record['rows_out'] = len(filtered_grid)
+
+        return avoided_grid, filtered_grid
+
+    @property
+    def avoided_grid(self):
+        """
+        :return: The avoided rows of the Agency Grid
+        """
+
+        return self.filtered[0]
+
+    @property
+    def filtered_grid(self):
+        """
+        :return: The filtered rows of the Agency Grid
+        """
+
+        return self.filtered[1]
+
+    @functools.cached_property
+    def fc_file(self):
+        """
+        :return: The FC file DataFrame
+        """
+
+        with self.recorder.stage(name='fc', rows_in=len(self.filtered_grid)) as record:
+            engine = querying if self.engine == 'polars' else processing
+            fc_grid = engine.get_fc_file(data=self.filtered_grid, zero_fill=not self.fc_sparse)
+            record['rows_out'] = len(fc_grid)
+
+        return fc_grid
+
+    def reset(self, stage):
+        """
+        Forgets a computed stage and the stages depending on it, e.g. after changing current_month_file the 'grid'.
+
+        :param stage:   The name of the stage: 'mapping', 'mapping_index', 'department_matcher', 'grid',
+                        'single_agencies', 'full_grid', 'filtered' or 'fc_file'.
+        :return: None
+        """
+
+        for name in [stage] + self.DOWNSTREAM_STAGES[stage]:
+            self.__dict__.pop(name, None)
+
+        return None
+
+    def release(self, *stages):
+        """
+        Forgets computed stages which are not needed anymore, in low memory mode only, so that their DataFrames are
+        freed as soon as nothing else uses them. Unlike reset, the stages depending on them are kept. A stage which is
+        needed again afterwards is computed again.
+
+        :param stages:  The names of the stages.
+        :return: None
+        """
+
+        if self.memory_budget is None:
+            return None
+
+        for stage in stages:
+            self.__dict__.pop(stage, None)
+
+        return None
+
+    def consume(self, stage):
+        """
+        :param stage:   The name of the stage.
+        :return: The stage, forgotten by the pipeline in low memory mode (see release), so that it is freed once the
+        stage using it is done with it
+        """
+
+        value = getattr(self, stage)
+        self.release(stage)
+
+        return value
+
+    def for_month(self, current_month_file, current_year, current_month, missing_agency_files=None, **options):
+        """
+        Creates the pipeline of another month sharing the prepared mapping and the department matcher of this one.
+
+        :param current_month_file:      Path to the data of the month.
+        :param current_year:            Year of the month.
+        :param current_month:           Month of the month.
+        :param missing_agency_files:    (Optional) A list of paths to single agency files.
+        :param options:                 Options replacing the ones of this pipeline, e.g. fc_sparse=True.
+        :return: An AgencyGridPipeline
+        """
+
+        arguments = dict(cache_dir=self.cache_dir, workers=self.workers, filter_sentinels=self.filter_sentinels,
+                         filter_rules=self.filter_rules, fc_sparse=self.fc_sparse, incremental=self.incremental,
+                         trace_memory=self.recorder.trace_memory, engine=self.engine,
+                         memory_budget=self.memory_budget)
+        arguments.update(options)
+
+        return AgencyGridPipeline(current_month_file=current_month_file, current_year=current_year,
+                                  current_month=current_month, missing_agency_files=missing_agency_files,
+                                  mapping_file=self.mapping_file, df_map=self.mapping,
+                                  department_matcher=self.department_matcher, mapping_index=self.mapping_index,
+                                  **arguments)
+
+    def validate(self):
+        """
+        Checks the structure of the grid, the mapping and the single agency files before any of them is processed (see
+        validating.validate_inputs). The mapping file is not checked when the mapping is already prepared. The program
+        exits if any problem is found.
+
+        :return: None
+        """
+
+        mapping_file = None if 'mapping' in self.__dict__ else self.mapping_file
+        with self.recorder.stage(name='validate'):
+            validating.validate_inputs(current_month_files=[self.current_month_file], mapping_file=mapping_file,
+                                       missing_agency_files=self.missing_agency_files)
+
+        return None
+
+    def write(self, output_dir, output_format='xlsx', full_output_format=None, writer_workers=4, history_dir=None):
+        """
+        Computes the stages which are not computed yet and writes the full, avoided, filtered and FC files and the run
+        report. Every file is written in the background as soon as it is computed.
+
+        :param output_dir:              Path to the output directory.
+        :param output_format:           Format of the output files.
+        :param full_output_format:      (Optional) Format of the full Agency Grid output file.
+        :param writer_workers:          Number of output files written at the same time.
+        :param history_dir:             (Optional) Path to the history store the filtered and FC files of the month are
+                                        appended to (see archiving.HistoryStore).
+        :return: A dictionary with the artifact names and the paths to their output files, including the run report
+        """
+
+        writer = writing.OutputWriter(output_dir=output_dir, prefix=f'{self.current_year}_{self.current_month:02}',
+                                      output_format=output_format,
+                                      formats=None if full_output_format is None else {'AG_full': full_output_format},
+                                      workers=writer_workers)
+
+        writer.submit(name='AG_full', data=self.full_grid)
+
+        print_info_about_agencies(message='FINAL INFORMATION ABOUT AGENCIES', country_map=self.mapping['countries'],
+                                  data=self.full_grid, date=self.date, mapping_index=self.mapping_index)
+        rows_in = len(self.full_grid)
+
+        # The filter is the last stage using the full grid, in low memory mode it is then only kept until it is written
+        avoided_grid, filtered_grid = self.filtered
+        self.release('full_grid')
+
+        writer.submit(name='AG_avoided', data=avoided_grid)
+        writer.submit(name='AG_filtered', data=filtered_grid)
+        writer.submit(name='AG_FC', data=self.fc_file)
+
+        # The files are written in the background while the previous stages run, this stage waits for the last ones
+        operations.insert_divider_line(message='WRITING OUTPUT FILES', end=False)
+        rows_in += len(avoided_grid) + len(filtered_grid) + len(self.fc_file)
+        with self.recorder.stage(name='write', rows_in=rows_in) as record:
+            output_files = writer.close()
+            record['rows_out'] = rows_in
+        operations.insert_divider_line(message='WRITING OUTPUT FILES', end=True)
+
+        if history_dir is not None:
+            operations.insert_divider_line(message='HISTORY STORE', end=False)
+            tables = {'AG_filtered': self.filtered_grid, 'AG_FC': self.fc_file}
+            with self.recorder.stage(name='history', rows_in=len(self.filtered_grid) + len(self.fc_file)) as record:
+                partition_files = archiving.HistoryStore(history_dir=history_dir).append(
+                    year=self.current_year, month=self.current_month, tables=tables)
+                record['rows_out'] = record['rows_in']
+            for table, partition_file in partition_files.items():
+                print(f'\t - {table}: {len(tables[table])} rows stored in {partition_file}')
+            operations.insert_divider_line(message='HISTORY STORE', end=True)
+
+        operations.insert_divider_line(message='RUN REPORT', end=False)
+        self.recorder.print_summary()
+        report_file = os.path.join(output_dir, f'{writer.prefix}_AG_report.json')
+        output_files['AG_report'] = self.recorder.save(report_file=report_file, year=self.current_year,
+                                                       month=self.current_month, incremental=self.incremental)
+        print(f"\t - Run report written in {output_files['AG_report']}")
+        operations.insert_divider_line(message='RUN REPORT', end=True)
+
+        return output_files
+
+
+def run_month(current_month_file, missing_agency_files, current_year, current_month, output_dir, df_map,
+              department_matcher, workers=1, filter_sentinels=None, filter_rules=False, fc_sparse=False,
+              output_format='xlsx', full_output_format=None, writer_workers=4, cache_dir=None, incremental=False,
+              recorder=None, trace_memory=False, profile=False, history_dir=None, memory_budget=None):
+    """
+    Runs the Agency Grid pipeline for one month with an already prepared mapping: loads and transforms the grid and
+    the single agency files, merges them, and writes the full, avoided, filtered and FC files.
+
+    :param current_month_file:      Path to the current month data.
+    :param missing_agency_files:    A list of paths to single agency files, or None.
+    :param current_year:            Year of the current month file.
+    :param current_month:           Month of the current month file.
+    :param output_dir:              Path to the output directory.
+    :param df_map:                  A dictionary with the 'departments' and 'countries' mapping DataFrames.
+    :param department_matcher:      DepartmentMatcher built from the department mapping.
+    :param workers:                 Number of worker processes for the single agency files.
+    :param filter_sentinels:        (Optional) Values avoiding a row of the Agency Grid.
+    :param filter_rules:            Whether to report in the avoided rows the rule that excluded them.
+    :param fc_sparse:               Whether to only write the existing combinations in the FC file.
+    :param output_format:           Format of the output files.
+    :param full_output_format:      (Optional) Format of the full Agency Grid output file.
+    :param writer_workers:          Number of output files written at the same time.
+    :param cache_dir:               (Optional) Path to the directory of the artifacts kept between runs.
+    :param incremental:             Whether to only recompute the agencies whose inputs changed since the previous run
+                                    of the month. Requires cache_dir.
+    :param recorder:                (Optional) StageRecorder measuring the stages of the run, e.g. with the mapping
+                                    loading already recorded.
+    :param trace_memory:            Whether to measure the peak of memory allocated by Python in every stage.
+    :param profile:                 Whether to write a cProfile dump of every stage in the profiles output directory.
+    :param history_dir:             (Optional) Path to the history store the filtered and FC files are appended to.
+    :param memory_budget:           (Optional) The peak resident memory allowed to the run, in MB (low memory mode).
+    :return: A dictionary with the artifact names and the paths to their output files, including the run report
+    """
+
+    profile_dir = get_profile_dir(output_dir, current_year, current_month) if profile else None
+    agency_grid = AgencyGridPipeline(current_month_file=current_month_file, current_year=current_year,
+                                     current_month=current_month, missing_agency_files=missing_agency_files,
+                                     df_map=df_map, department_matcher=department_matcher, cache_dir=cache_dir,
+                                     workers=workers, filter_sentinels=filter_sentinels, filter_rules=filter_rules,
+                                     fc_sparse=fc_sparse, incremental=incremental, trace_memory=trace_memory,
+                                     profile_dir=profile_dir, recorder=recorder, memory_budget=memory_budget)
+
+    return agency_grid.write(output_dir=output_dir, output_format=output_format,
+                             full_output_format=full_output_format, writer_workers=writer_workers,
+                             history_dir=history_dir)
@@ -1,23 +1,41 @@
+import numpy as np
 import pandas as pd
-from itertools import product
 
+from . import indexing
+from . import transforming
 
-def process_data(data, country_map):
+FILTER_SENTINELS = ['', 'not assigned', 'not included']
+
+
+def process_data(data, country_map, mapping_index=None):
     """
-    Processes and merges data with the country mapping and reorders columns.
+    Processes and merges data with the country mapping and reorders columns. The join is validated first: every row
+    must have at most one mapping row (see MappingIndex.validate).
 
     :param data:            The input DataFrame.
     :param country_map:     A DataFrame with the country mapping.
+    :param mapping_index:   (Optional) MappingIndex of the country mapping. Built here when not given.
     :return: A processed and ordered DataFrame
     """
 
     print(f'Processing Data: {len(data)} rows BEFORE merging the COUNTRIES mapping')
 
-    data = pd.merge(left=data,
-                    right=country_map,
-                    how='left',
-                    left_on=['kpi agency', 'branch'],
-                    right_on=['kpi agency', 'branch'])
+    if mapping_index is None:
+        mapping_index = indexing.MappingIndex(country_map=country_map)
+    positions = mapping_index.validate(data=data)
+
+    keys = ['kpi agency', 'branch']
+    shared_columns = set(data.columns).intersection(country_map.columns).difference(keys)
+
+    # The mapping columns are looked up in the index, unless data already has some of them and the merge suffixes them
+    if len(shared_columns) == 0:
+        data = mapping_index.join(data=data, country_map=country_map, positions=positions)
+    else:
+        data = pd.merge(left=data,
+                        right=country_map,
+                        how='left',
+                        left_on=keys,
+                        right_on=keys)
 
     print(f'Processing Data: {len(data)} rows AFTER merging the COUNTRIES mapping')
 
@@ -31,39 +49,122 @@ def process_data(data, country_map):
     return data[column_order]
 
 
-def merge_grid_with_single_agency(single_agencies, agency_grid):
+def get_merge_order(data, run_lengths, keys, verify_sorted=True):
+    """
+    Computes the order of the rows of consecutive runs of data (the agency grid and the single agencies) sorted by
+    keys. The keys are encoded into one integer per row and the runs are merged by a stable sort that takes advantage
+    of the runs already being sorted, so the order is the same as the one of DataFrame.sort_values.
+
+    :param data:            The DataFrame with the runs one after the other.
+    :param run_lengths:     A list with the number of rows of every run.
+    :param keys:            A list with the names of the columns to sort by.
+    :param verify_sorted:   Whether to check that every run is sorted. Runs that are not sorted are then sorted on their
+                            own before the merge. Without the check the runs must already be sorted.
+    :return: An array with the positions of the rows in sorted order
+    """
+
+    # Encode the keys into one integer per row, missing values are sorted last as in sort_values
+    composite_key = np.zeros(len(data), dtype=np.int64)
+    for key in keys:
+        codes, uniques = pd.factorize(data[key], sort=True)
+        codes = np.where(codes < 0, len(uniques), codes)
+        composite_key = composite_key * (len(uniques) + 1) + codes
+
+    positions = np.arange(len(data))
+    start = 0
+    for length in run_lengths:
+        run = composite_key[start:start + length]
+        if verify_sorted and np.any(run[1:] < run[:-1]):
+            run_order = np.argsort(run, kind='stable')
+            positions[start:start + length] = start + run_order
+            composite_key[start:start + length] = run[run_order]
+        start += length
+
+    # The stable sort (timsort) detects the sorted runs and merges them
+    return positions[np.argsort(composite_key, kind='stable')]
+
+
+def merge_grid_with_single_agency(single_agencies, agency_grid, merge_sorted=True, verify_sorted=True):
     """
     Merges single agency data into the agency grid.
 
     :param single_agencies: A dictionary with single agency data.
     :param agency_grid:     The main agency grid DataFrame.
+    :param merge_sorted:    Whether to merge the sorted grid and single agencies instead of sorting all the rows.
+    :param verify_sorted:   Whether to check that the grid and single agencies are sorted before merging them. Those
+                            which are not sorted are sorted on their own first.
     :return: The merged DataFrame.
     """
 
-    data = agency_grid
+    keys = ['kpi agency', 'branch', 'department fc code']
 
+    frames = [agency_grid]
     for key, val in single_agencies.items():
-
-        data = pd.concat([data, val['fte']])
+        frames.append(val['fte'])
         print(f'{key.capitalize()}: data integrated to the Agency Grid set')
 
+    # One concatenation for all the agencies
+    data = pd.concat(frames)
     data['ftes'] = data['ftes'].fillna(0.0)
-    data.sort_values(by=['kpi agency', 'branch', 'department fc code'], axis=0, inplace=True, ignore_index=True)
+
+    if merge_sorted:
+        order = get_merge_order(data=data, run_lengths=[len(frame) for frame in frames], keys=keys,
+                                verify_sorted=verify_sorted)
+        data = data.take(order)
+    else:
+        data.sort_values(by=keys, axis=0, inplace=True, ignore_index=True)
     data.reset_index(drop=True, inplace=True)
 
     return data
 
 
-def filter_agency_grid(data):
+def get_filter_rules(data, sentinels):
+    """
+    Evaluates column by column the rules avoiding rows of the agency grid: a missing value in any column, or one of the
+    sentinel strings in a text column.
+
+    :param data:        The agency grid DataFrame.
+    :param sentinels:   A list with the strings avoiding a row, e.g. "not assigned".
+    :return: A boolean Series with the avoided rows, and a Series with the first rule avoiding each row (None for the
+    rows kept)
+    """
+
+    mask = pd.Series(False, index=data.index)
+    rules = pd.Series(None, index=data.index, dtype=object)
+
+    for column in data.columns:
+        values = data[column]
+        is_missing = values.isna().to_numpy()
+        rule = np.where(is_missing, f'{column} is missing', None)
+
+        # Sentinel strings can only be found in text columns
+        if not (pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values)):
+            is_sentinel = values.isin(sentinels).to_numpy() & ~is_missing
+            if is_sentinel.any():
+                rule[is_sentinel] = (f"{column} is '" + values[is_sentinel].astype(str) + "'").to_numpy()
+            is_missing = is_missing | is_sentinel
+
+        rules = rules.where(mask | ~is_missing, rule)
+        mask = mask | is_missing
+
+    return mask, rules
+
+
+def filter_agency_grid(data, sentinels=None, report_rules=False):
     """
     Select rows in the DataFrame where any cell has an empty value, NaN value, or the string "NOT ASSIGNED".
 
-    :param data: The agency grid DataFrame.
+    :param data:            The agency grid DataFrame.
+    :param sentinels:       (Optional) A list with the strings avoiding a row. By default FILTER_SENTINELS.
+    :param report_rules:    Whether to add to the avoided rows an 'excluded by' column with the rule avoiding them.
     :return: Two DataFrames: one with avoided rows, and one with filtered rows
     """
 
+    if sentinels is None:
+        sentinels = FILTER_SENTINELS
+
     # Create a mask for rows with empty values, NaN values, or "NOT ASSIGNED"
-    mask = data.map(lambda x: pd.isna(x) or x == "" or x == "not assigned" or x == "not included").any(axis=1)
+    mask, rules = get_filter_rules(data=data, sentinels=sentinels)
 
     # Select rows where any condition is met
     avoided_data = data[mask].reset_index(drop=True)
@@ -83,38 +184,83 @@ def filter_agency_grid(data):
     print(f'Processing Data: {len(avoided_data)} rows AVOIDED in the Agency Grid')
     print(f'Processing Data: {len(filtered_data)} rows INCLUDED in the Agency Grid')
 
+    if report_rules:
+        avoided_data.insert(loc=len(ordered_columns), column='excluded by', value=rules[mask].to_numpy())
+        for rule, count in avoided_data['excluded by'].value_counts().items():
+            print(f'\t - {count} rows AVOIDED because {rule}')
+
     return avoided_data, filtered_data
 
 
-def get_fc_file(data):
+def upper_column(column):
     """
-    Prepares a DataFrame for FC by transforming and structuring the data.
+    Converts the strings of a column to uppercase, each distinct string being converted only once. Other values are
+    left as they are.
+
+    :param column:  A pandas Series.
+    :return: The Series with uppercase strings
+    """
+
+    if pd.api.types.is_numeric_dtype(column):
+        return column
+
+    codes, uniques = pd.factorize(column, use_na_sentinel=False)
+    uniques = np.array([x.upper() if isinstance(x, str) else x for x in uniques], dtype=object)
+
+    return pd.Series(uniques[codes], index=column.index, name=column.name, dtype=object)
+
+
+def aggregate_fc_data(data):
+    """
+    Sums the FTEs by 'fc code' and 'department fc code', and lists the currencies and dates of every 'fc code'.
 
     :param data:    The input DataFrame.
-    :return: A structured DataFrame for FC use
+    :return: A Series with the FTEs sums indexed by 'fc code' and 'department fc code', and a DataFrame with the
+    distinct 'fc code', 'currency' and 'date' (formatted as year.month) rows
     """
 
-    print(f'Processing file for FC: {len(data)} rows BEFORE FC processing')
+    # Only the observed combinations of categorical codes, as with text columns
+    ftes = data.groupby(['fc code', 'department fc code'], sort=False, observed=True)['ftes'].sum()
+
+    entities = data[['fc code', 'currency', 'date']].drop_duplicates(ignore_index=True)
+    entities['date'] = entities['date'].dt.strftime('%Y.%m')
+    entities.drop_duplicates(inplace=True, ignore_index=True)
 
-    data['date'] = data['date'].dt.strftime('%Y.%m')
+    return ftes, entities
 
-    # Split the data into the required parts
-    df_right = data[['fc code', 'department fc code', 'ftes']].copy()
-    df_left = data[['fc code', 'currency', 'date']].copy()
 
-    # Create all possible combinations of 'fc code' and 'department fc code'
-    all_combinations = pd.DataFrame(list(product(data['fc code'].unique(), data['department fc code'].unique())),
-                                    columns=['fc code', 'department fc code'])
+def merge_fc_sums(ftes):
+    """
+    Merges partial FTEs sums of aggregate_fc_data, e.g. of consecutive chunks of the Agency Grid, into the sums of all
+    their rows.
+
+    :param ftes:    A list of Series with FTEs sums indexed by 'fc code' and 'department fc code'.
+    :return: A Series with the FTEs sums indexed by 'fc code' and 'department fc code'
+    """
+
+    return pd.concat(ftes).groupby(level=[0, 1], sort=False).sum()
+
+
+def build_fc_file(ftes, entities, zero_fill=True):
+    """
+    Builds the FC file from the FTEs sums and the entities given by aggregate_fc_data.
 
-    # Merge all combinations with df_right to include all possible groups
-    df_right = pd.merge(all_combinations, df_right, on=['fc code', 'department fc code'], how='left').fillna(0)
+    :param ftes:        A Series with the FTEs sums indexed by 'fc code' and 'department fc code'.
+    :param entities:    A DataFrame with the distinct 'fc code', 'currency' and 'date' rows.
+    :param zero_fill:   Whether every 'fc code' gets a row for every 'department fc code', with 0 FTEs when it has
+                        none. Otherwise only the existing combinations are given.
+    :return: A structured DataFrame for FC use
+    """
 
-    # Group by 'fc code' and 'department fc code', summing 'ftes'
-    df_right = df_right.groupby(['fc code', 'department fc code']).agg({'ftes': 'sum'}).reset_index()
+    # All possible combinations of 'fc code' and 'department fc code', only when they are required
+    if zero_fill:
+        all_combinations = pd.MultiIndex.from_product([ftes.index.unique(level=0), ftes.index.unique(level=1)],
+                                                      names=ftes.index.names)
+        ftes = ftes.reindex(all_combinations, fill_value=0.0)
+    df_right = ftes.reset_index()
 
-    # Drop duplicates and sort df_left
-    df_left.drop_duplicates(inplace=True, ignore_index=True)
-    df_left.sort_values(by=['fc code'], axis=0, inplace=True, ignore_index=True)
+    # Sort df_left
+    df_left = entities.sort_values(by=['fc code'], axis=0, ignore_index=True)
 
     # Merge df_left and df_right
     data = pd.merge(left=df_left,
@@ -136,16 +282,34 @@ def get_fc_file(data):
     data['D_FL'] = 'FTE01'
 
     # Select and reorder columns
-    data = data[['D_CA', 'D_AU', 'D_FL', 'D_DP', 'D_RU', 'D_CU', 'D_AC', 'P_AMOUNT']].copy()
+    data = transforming.copy_frame(data=data[['D_CA', 'D_AU', 'D_FL', 'D_DP', 'D_RU', 'D_CU', 'D_AC', 'P_AMOUNT']])
 
     # Convert all string data to uppercase
-    data = data.map(lambda x: x.upper() if isinstance(x, str) else x)
+    for column in data.columns:
+        data[column] = upper_column(column=data[column])
 
     # Sort values
     data.sort_values(by=['D_RU', 'D_AC'], axis=0, inplace=True, ignore_index=True)
     data.reset_index(drop=True, inplace=True)
 
+    return data
+
+
+def get_fc_file(data, zero_fill=True):
+    """
+    Prepares a DataFrame for FC by transforming and structuring the data.
+
+    :param data:        The input DataFrame.
+    :param zero_fill:   Whether every 'fc code' gets a row for every 'department fc code', with 0 FTEs when it has
+                        none. Otherwise only the existing combinations are given (sparse output).
+    :return: A structured DataFrame for FC use
+    """
+
+    print(f'Processing file for FC: {len(data)} rows BEFORE FC processing')
+
+    ftes, entities = aggregate_fc_data(data=data)
+    data = build_fc_file(ftes=ftes, entities=entities, zero_fill=zero_fill)
+
     print(f'Processing file for FC: {len(data)} rows AFTER FC processing')
 
     return data
-
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import contextlib
+import tracemalloc
+import importlib.util
+from datetime import datetime
+
+import pandas as pd
+
+if importlib.util.find_spec('resource') is not None:
+    import resource
+else:
+    resource = None
+
+
+def get_peak_rss():
+    """
+    :return: The peak resident set size of the process in MB, or None where it is not available (Windows)
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS gives bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class StageRecorder:
+    """
+    Records for every stage of a run its wall time, CPU time, peak resident memory and rows in/out, and optionally
+    the peak of memory allocated by Python (tracemalloc) and a cProfile dump of the stage. The records are written as
+    a JSON run report. With a memory budget, the stages raising the peak resident memory above it are reported.
+
+    A stage may open another one, e.g. when it computes a stage of the pipeline it needs. Only one profiler can run
+    at a time and resetting the tracemalloc peak would lose the one of the outer stage, so the stages opened inside
+    another one are timed but neither profiled nor traced.
+    """
+
+    def __init__(self, trace_memory=False, profile_dir=None, memory_budget=None):
+        """
+        :param trace_memory:    Whether to measure the peak of memory allocated by Python in every stage, which slows
+                                down the run.
+        :param profile_dir:     (Optional) Path to the directory of the cProfile dumps. Without it nothing is profiled.
+        :param memory_budget:   (Optional) The peak resident memory allowed to the run, in MB.
+        """
+
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.memory_budget = memory_budget
+        self.stages = []
+        self.depth = 0
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Measures a stage. The rows out of the stage are given by setting 'rows_out' in the yielded record.
+
+        :param name:        The name of the stage, e.g. 'load'.
+        :param rows_in:     (Optional) The number of rows given to the stage.
+        :return: The record of the stage
+        """
+
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        is_outer = self.depth == 0
+
+        if self.trace_memory and is_outer:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_before, _ = tracemalloc.get_traced_memory()
+
+        profiler = None
+        if self.profile_dir is not None and is_outer:
+            profiler = cProfile.Profile()
+
+        rss_before = get_peak_rss()
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+
+        self.depth += 1
+        try:
+            yield record
+        finally:
+            self.depth -= 1
+            if profiler is not None:
+                profiler.disable()
+            record['wall_seconds'] = round(time.perf_counter() - start, 4)
+            record['cpu_seconds'] = round(time.process_time() - start_cpu, 4)
+
+            rss_after = get_peak_rss()
+            if rss_after is not None:
+                record['peak_rss_mb'] = round(rss_after, 2)
+                record['rss_growth_mb'] = round(rss_after - rss_before, 2)
+                if self.memory_budget is not None and rss_after > self.memory_budget and rss_after > rss_before:
+                    record['over_budget'] = True
+                    print(f'Stage {name}: peak resident memory raised to {rss_after:.2f} MB, over the memory budget '
+                          f'of {self.memory_budget} MB')
+
+            if self.trace_memory and is_outer:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                record['traced_peak_mb'] = round((traced_peak - traced_before) / 2 ** 20, 2)
+
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profile_name = f"{len(self.stages):02}_{name.replace(' ', '_')}.prof"
+                record['profile_file'] = os.path.join(self.profile_dir, profile_name)
+                profiler.dump_stats(record['profile_file'])
+
+            self.stages.append(record)
+
+    def get_report(self, **info):
+        """
+        :param info:    Information about the run added to the report, e.g. the year and the month.
+        :return: A dictionary with the run information, the totals and the records of the stages
+        """
+
+        return {'created': datetime.now().isoformat(timespec='seconds'),
+                'python': sys.version.split()[0],
+                'pandas': pd.__version__,
+                **info,
+                'wall_seconds': round(time.perf_counter() - self.start, 4),
+                'cpu_seconds': round(time.process_time() - self.start_cpu, 4),
+                'peak_rss_mb': None if get_peak_rss() is None else round(get_peak_rss(), 2),
+                'memory_budget_mb': self.memory_budget,
+                'stages': self.stages}
+
+    def print_summary(self):
+        """
+        Prints the wall time, CPU time, peak memory and rows in/out of every stage, and the stages over the memory
+        budget.
+
+        :return: None (prints to console).
+        """
+
+        for record in self.stages:
+            rows_in = '-' if record['rows_in'] is None else record['rows_in']
+            rows_out = '-' if record['rows_out'] is None else record['rows_out']
+            print(f"\t - {record['stage']:<16}: {record['wall_seconds']:9.3f} s wall, "
+                  f"{record['cpu_seconds']:9.3f} s CPU, {record.get('peak_rss_mb', '-'):>10} MB peak RSS, "
+                  f"rows {rows_in:>10} -> {rows_out:<10}{' OVER BUDGET' if record.get('over_budget') else ''}")
+
+        if self.memory_budget is not None:
+            over_budget = [record['stage'] for record in self.stages if record.get('over_budget')]
+            if len(over_budget) > 0:
+                print(f"Memory budget of {self.memory_budget} MB exceeded by: {', '.join(over_budget)}")
+            elif get_peak_rss() is not None:
+                print(f'Memory budget of {self.memory_budget} MB kept, peak resident memory {get_peak_rss():.2f} MB')
+
+        return None
+
+    def save(self, report_file, **info):
+        """
+        Writes the run report in a JSON file.
+
+        :param report_file:     The path to the JSON file.
+        :param info:            Information about the run added to the report.
+        :return: The path to the JSON file
+        """
+
+        with open(report_file, 'w', encoding='utf-8') as file:
+            json.dump(self.get_report(**info), file, indent=4, default=str)
+
+        return report_file
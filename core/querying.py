@@ -0,0 +1,342 @@
+import os
+import importlib.util
+
+import pandas as pd
+
+from . import errors
+from . import loading
+from . import processing
+
+if importlib.util.find_spec('polars') is not None:
+    import polars as pl
+else:
+    pl = None
+
+# Execution engines of the clean, transform, process, filter and FC stages, pandas being the reference
+ENGINES = ['pandas', 'polars']
+
+# Columns the Agency Grid is sorted by and joined with the country mapping on
+SORT_KEYS = ['kpi agency', 'branch', 'department fc code']
+JOIN_KEYS = ['kpi agency', 'branch']
+
+# Columns of the processed Agency Grid, as given by processing.process_data
+COLUMN_ORDER = ['agency code', 'kpi agency', 'fc code',
+                'branch', 'ceo region', 'continent split',
+                'regional director', 'department fc code', 'ftes', 'currency',
+                'month', 'year', 'date']
+
+# Columns of the avoided and filtered rows, as given by processing.filter_agency_grid
+FILTER_COLUMNS = ['date', 'kpi agency', 'branch', 'fc code', 'department fc code', 'currency', 'ftes']
+
+
+def check_engine(engine):
+    """
+    Checks that the packages of an engine are installed. The polars engine needs polars, and pyarrow to give its
+    results as pandas DataFrames. The program exits otherwise.
+
+    :param engine:  The name of the engine, one of ENGINES.
+    :return: None
+    """
+
+    if engine not in ENGINES:
+        print(f'Unknown engine: {engine}')
+        exit()
+
+    if engine == 'polars':
+        missing = [package for package in ['polars', 'pyarrow'] if importlib.util.find_spec(package) is None]
+        if len(missing) > 0:
+            print(f"The polars engine requires {' and '.join(missing)}, use the pandas engine instead")
+            exit()
+
+    return None
+
+
+def scan_grid(input_file):
+    """
+    Plans the loading of the grid, with the same values as loading.load_data: every column as text, missing FTEs
+    when the value is one of loading.NA_VALUES.
+
+    :param input_file:  The path to the grid file. Other files than CSV are loaded by pandas.
+    :return: A LazyFrame with the columns of the grid as in the file
+    """
+
+    _, file_extension = os.path.splitext(input_file)
+    if file_extension.lower() != '.csv':
+        data = loading.load_data(input_file=input_file, sheet_name=0, columns=loading.GRID_COLUMNS)
+        return pl.from_pandas(data).lazy()
+
+    print("Data file loading - CSV file (polars)")
+    data = pl.scan_csv(input_file, infer_schema=False)
+    columns = [column for column in data.collect_schema().names()
+               if loading.get_column_name(column) in loading.GRID_COLUMNS]
+    data = data.select(columns)
+
+    # Empty text cells are empty strings, as read by pandas with keep_default_na=False
+    expressions = []
+    for column in columns:
+        if column == 'FTEs':
+            values = pl.col(column)
+            expressions.append(pl.when(values.is_in(loading.NA_VALUES)).then(None).otherwise(values)
+                               .cast(pl.Float64).alias(column))
+        else:
+            expressions.append(pl.col(column).fill_null(''))
+
+    return data.with_columns(expressions)
+
+
+def clean_up_data(data, numeric_columns=('ftes',)):
+    """
+    Plans the cleaning of transforming.clean_up_data on text columns: column names stripped and lowercased, asterisks
+    removed, spaces collapsed and stripped, values lowercased.
+
+    :param data:                A LazyFrame.
+    :param numeric_columns:     (Optional) Cleaned column names kept as they are when they hold numbers.
+    :return: The cleaned LazyFrame
+    """
+
+    schema = data.collect_schema()
+    data = data.rename({column: loading.get_column_name(column) for column in schema.names()})
+
+    expressions = []
+    for column, dtype in zip(data.collect_schema().names(), schema.dtypes()):
+        if column in numeric_columns and dtype.is_numeric():
+            continue
+        if dtype == pl.String:
+            expressions.append(pl.col(column).str.replace_all('*', '', literal=True).str.replace_all(r'\s+', ' ')
+                               .str.strip_chars().str.to_lowercase())
+        else:
+            expressions.append(pl.col(column).cast(pl.String))
+
+    return data.with_columns(expressions)
+
+
+def transform_data(data):
+    """
+    Plans the transformation of transforming.transform_data: FTEs as numbers, 'x' and '0' around the department fc
+    codes, and the date, year and month of the 'kpi year month' column.
+
+    :param data:    A cleaned LazyFrame of the grid.
+    :return: The transformed LazyFrame
+    """
+
+    data = data.rename({'kpi year month': 'date'})
+
+    return data.with_columns(pl.col('ftes').cast(pl.Float64),
+                             ('x' + pl.col('department fc code') + '0').alias('department fc code'),
+                             (pl.col('date') + '-01').str.strptime(pl.Datetime('ns'), '%Y-%m-%d')) \
+        .with_columns(pl.col('date').dt.year().cast(pl.Int64).alias('year'),
+                      pl.col('date').dt.month().cast(pl.Int64).alias('month'))
+
+
+def merge_grid_with_single_agency(single_agencies, agency_grid):
+    """
+    Plans the merge of processing.merge_grid_with_single_agency: the grid and the single agencies one after the other,
+    missing FTEs as 0, sorted by SORT_KEYS with missing values last, the rows with the same keys keeping their order.
+
+    :param single_agencies:     A dictionary with the single agencies and their 'fte' pandas DataFrame.
+    :param agency_grid:         The transformed LazyFrame of the grid.
+    :return: The merged LazyFrame
+    """
+
+    columns = ['kpi agency', 'branch', 'department fc code', 'ftes', 'date', 'year', 'month']
+    frames = [agency_grid.select(columns)]
+    for key, val in single_agencies.items():
+        fte = pl.from_pandas(val['fte'][columns].astype({'kpi agency': object, 'branch': object,
+                                                         'department fc code': object}))
+        frames.append(fte.lazy().with_columns(pl.col('date').cast(pl.Datetime('ns')), pl.col('year').cast(pl.Int64),
+                                              pl.col('month').cast(pl.Int64)))
+        print(f'{key.capitalize()}: data integrated to the Agency Grid set')
+
+    data = pl.concat(frames, how='vertical_relaxed')
+
+    return data.with_columns(pl.col('ftes').fill_nan(None).fill_null(0.0)) \
+        .sort(SORT_KEYS, nulls_last=True, maintain_order=True)
+
+
+def validate_join(data, country_map):
+    """
+    Checks the join of the merged grid with the country mapping as MappingIndex.validate does: the rows whose pair is
+    not in the mapping are reported, an InputError listing the pairs used by the grid and duplicated in the mapping is
+    raised.
+
+    :param data:            The merged DataFrame (polars).
+    :param country_map:     The country mapping DataFrame (polars).
+    :return: None
+    """
+
+    pairs = data.select(JOIN_KEYS)
+    unmatched = pairs.join(country_map.select(JOIN_KEYS).unique(), on=JOIN_KEYS, how='anti')
+    if len(unmatched) > 0:
+        print(f'Processing Data: {len(unmatched)} rows of {len(unmatched.unique())} (agency, branch) pairs not found '
+              f'in the COUNTRIES mapping')
+
+    duplicated = country_map.group_by(JOIN_KEYS).len().filter(pl.col('len') > 1).select(JOIN_KEYS)
+    used = pairs.unique(maintain_order=True).join(duplicated, on=JOIN_KEYS, how='semi')
+    if len(used) > 0:
+        raise errors.InputError('(agency, branch) pairs found more than once in the COUNTRIES mapping:\n'
+                                + ''.join(f'\t - {agency} / {branch}\n' for agency, branch in used.iter_rows())
+                                + 'Impossible to decide.')
+
+    return None
+
+
+def process_data(data, country_map):
+    """
+    Joins the merged grid with the country mapping as processing.process_data does, after validating the join. Every
+    row gets the first mapping row of its pair.
+
+    :param data:            The merged DataFrame (polars).
+    :param country_map:     The country mapping DataFrame (pandas).
+    :return: A LazyFrame with the columns of COLUMN_ORDER
+    """
+
+    print(f'Processing Data: {len(data)} rows BEFORE merging the COUNTRIES mapping')
+
+    country_map = pl.from_pandas(country_map.astype(object))
+    validate_join(data=data, country_map=country_map)
+
+    country_map = country_map.lazy().unique(subset=JOIN_KEYS, keep='first', maintain_order=True)
+
+    return data.lazy().join(country_map, on=JOIN_KEYS, how='left', maintain_order='left').select(COLUMN_ORDER)
+
+
+def build_agency_grid(current_month_file, single_agencies, country_map):
+    """
+    Loads, cleans and transforms the grid, merges it with the single agencies and joins the country mapping, as
+    pipeline.merge_agency_grid does with pandas. The stages run as two multi-threaded polars query plans, one before
+    and one after the validation of the join.
+
+    :param current_month_file:  Path to the current month data.
+    :param single_agencies:     A dictionary with the single agencies and their 'fte' pandas DataFrame.
+    :param country_map:         The country mapping DataFrame (pandas).
+    :return: The processed Agency Grid pandas DataFrame
+    """
+
+    data = transform_data(data=clean_up_data(data=scan_grid(input_file=current_month_file)))
+    data = merge_grid_with_single_agency(single_agencies=single_agencies, agency_grid=data).collect()
+    data = process_data(data=data, country_map=country_map).collect()
+    print(f'Processing Data: {len(data)} rows AFTER merging the COUNTRIES mapping')
+
+    return data.to_pandas()
+
+
+def filter_agency_grid(data, sentinels=None, report_rules=False):
+    """
+    Splits the Agency Grid into avoided and filtered rows as processing.filter_agency_grid does: a row is avoided when
+    one of its values is missing or, in a text column, one of the sentinels.
+
+    :param data:            The Agency Grid pandas DataFrame.
+    :param sentinels:       (Optional) A list with the strings avoiding a row. By default processing.FILTER_SENTINELS.
+    :param report_rules:    Whether to add to the avoided rows an 'excluded by' column with the rule avoiding them.
+    :return: Two pandas DataFrames: one with avoided rows, and one with filtered rows
+    """
+
+    if sentinels is None:
+        sentinels = processing.FILTER_SENTINELS
+
+    data = pl.from_pandas(data.astype({column: object for column in data.columns
+                                       if isinstance(data[column].dtype, pd.CategoricalDtype)})).lazy()
+
+    # The first rule avoiding a row, in the order of the columns
+    rules = []
+    for column, dtype in data.collect_schema().items():
+        values = pl.col(column)
+        is_missing = values.is_null() | values.is_nan() if dtype.is_float() else values.is_null()
+        rules.append(pl.when(is_missing).then(pl.lit(f'{column} is missing')))
+        if dtype == pl.String:
+            rules.append(pl.when(values.is_in(sentinels)).then(pl.lit(f"{column} is '") + values + pl.lit("'")))
+    data = data.with_columns(pl.coalesce(rules).alias('excluded by'))
+
+    avoided_columns = FILTER_COLUMNS + (['excluded by'] if report_rules else [])
+    avoided_data, filtered_data = pl.collect_all([
+        data.filter(pl.col('excluded by').is_not_null()).select(avoided_columns),
+        data.filter(pl.col('excluded by').is_null()).select(FILTER_COLUMNS)])
+
+    print(f'Processing Data: {len(avoided_data)} rows AVOIDED in the Agency Grid')
+    print(f'Processing Data: {len(filtered_data)} rows INCLUDED in the Agency Grid')
+
+    if report_rules:
+        for rule, count in avoided_data['excluded by'].value_counts(sort=True).iter_rows():
+            print(f'\t - {count} rows AVOIDED because {rule}')
+
+    return avoided_data.to_pandas(), filtered_data.to_pandas()
+
+
+def get_fc_file(data, zero_fill=True):
+    """
+    Prepares the FC file as processing.get_fc_file does. The FTEs sums and the distinct entities are computed by
+    polars, the FC file is built from them by processing.build_fc_file.
+
+    :param data:        The filtered rows of the Agency Grid (pandas).
+    :param zero_fill:   Whether every 'fc code' gets a row for every 'department fc code', with 0 FTEs when it has
+                        none. Otherwise only the existing combinations are given (sparse output).
+    :return: A structured DataFrame for FC use
+    """
+
+    print(f'Processing file for FC: {len(data)} rows BEFORE FC processing')
+
+    keys = ['fc code', 'department fc code']
+    data = pl.from_pandas(data.astype({column: object for column in data.columns
+                                       if isinstance(data[column].dtype, pd.CategoricalDtype)})).lazy()
+    ftes, entities = pl.collect_all([
+        data.group_by(keys, maintain_order=True).agg(pl.col('ftes').sum()),
+        data.select('fc code', 'currency', pl.col('date').dt.strftime('%Y.%m')).unique(keep='first',
+                                                                                          maintain_order=True)])
+
+    ftes = ftes.to_pandas().set_index(keys)['ftes']
+    data = processing.build_fc_file(ftes=ftes, entities=entities.to_pandas(), zero_fill=zero_fill)
+
+    print(f'Processing file for FC: {len(data)} rows AFTER FC processing')
+
+    return data
+
+
+def compare_frames(reference, data, name, rtol=1e-9):
+    """
+    Compares a DataFrame of an engine with the one of the pandas engine: same columns, same rows in the same order,
+    same values, the numbers up to rtol. Categorical columns are compared by their values, and the missing values of
+    text columns as None whether they are NaN (pandas) or None (polars).
+
+    :param reference:   The DataFrame of the pandas engine.
+    :param data:        The DataFrame of the other engine.
+    :param name:        The name of the DataFrame, for the report.
+    :param rtol:        The relative tolerance of the numbers.
+    :return: Whether the DataFrames are equivalent
+    """
+
+    def get_values(frame):
+        frame = frame.reset_index(drop=True)
+        text_columns = [column for column in frame.columns if isinstance(frame[column].dtype, pd.CategoricalDtype)
+                        or pd.api.types.is_string_dtype(frame[column].dtype)]
+        frame = frame.astype({column: object for column in text_columns})
+        for column in text_columns:
+            frame[column] = frame[column].where(frame[column].notna(), None)
+        return frame
+
+    try:
+        pd.testing.assert_frame_equal(get_values(reference), get_values(data), check_dtype=False, rtol=rtol)
+    except AssertionError as error:
+        print(f'\t - {name}: DIFFERENT from the pandas engine')
+        print('\t   ' + str(error).replace('\n', '\n\t   '))
+        return False
+
+    print(f'\t - {name}: same as the pandas engine ({len(data)} rows)')
+
+    return True
+
+
+def check_equivalence(agency_grid, reference):
+    """
+    Compares the stages of a pipeline run by an engine with the ones of the same pipeline run by pandas.
+
+    :param agency_grid:     AgencyGridPipeline run by the engine.
+    :param reference:       AgencyGridPipeline of the same month run by pandas.
+    :return: Whether all the stages are equivalent
+    """
+
+    equivalent = True
+    for name in ['full_grid', 'avoided_grid', 'filtered_grid', 'fc_file']:
+        equivalent = compare_frames(reference=getattr(reference, name), data=getattr(agency_grid, name),
+                                    name=name) and equivalent
+
+    return equivalent
@@ -0,0 +1,254 @@
+import os
+import json
+import argparse
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import caching
+from . import indexing
+from . import matching
+from . import operations
+from . import pipeline
+
+
+class AgencyGridService:
+    """
+    Keeps the prepared mapping and the department matcher in memory and runs the Agency Grid jobs submitted to it. At
+    most max_running jobs run at the same time and at most max_queued jobs wait for their turn, further jobs are
+    refused.
+    """
+
+    def __init__(self, mapping_file, cache_dir=None, workers=1, max_running=1, max_queued=8):
+        """
+        :param mapping_file:    Path to the mapping file provided by the Finance Department.
+        :param cache_dir:       (Optional) Path to the directory of the artifacts kept between runs.
+        :param workers:         Number of worker processes for the single agency files of a job.
+        :param max_running:     The number of jobs running at the same time.
+        :param max_queued:      The number of jobs waiting for a running slot.
+        """
+
+        self.mapping_file = mapping_file
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_running = max_running
+        self.max_queued = max_queued
+
+        self.running = threading.BoundedSemaphore(max_running)
+        self.slots = threading.BoundedSemaphore(max_running + max_queued)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        self.df_map = caching.load_mapping(mapping_file=mapping_file, cache_dir=cache_dir)
+        matches_file = None if cache_dir is None else os.path.join(cache_dir, 'department_matches.json')
+        self.department_matcher = matching.DepartmentMatcher(department_map=self.df_map['departments'],
+                                                             cache_file=matches_file)
+        self.mapping_index = indexing.MappingIndex(country_map=self.df_map['countries'])
+
+    def get_status(self):
+        """
+        :return: A dictionary with the number of jobs running or waiting and the limits
+        """
+
+        return {'status': 'ok', 'pending': self.pending, 'max_running': self.max_running,
+                'max_queued': self.max_queued}
+
+    def run_job(self, job):
+        """
+        Runs the pipeline for one month with the prepared mapping.
+
+        :param job:     A dictionary with 'input_file', 'year', 'month' and optionally 'missing_agency_files',
+                        'output_dir' (to also write the output files), 'fc_sparse' and 'filter_sentinels'.
+        :return: A dictionary with the FC file rows, the missing and extra agencies, and the output files if written
+        """
+
+        # Every job takes its decisions in its own matcher, the shared one is only changed under the lock
+        with self.lock:
+            department_matcher = self.department_matcher.copy()
+
+        agency_grid = pipeline.AgencyGridPipeline(current_month_file=job['input_file'],
+                                                  current_year=int(job['year']), current_month=int(job['month']),
+                                                  missing_agency_files=job.get('missing_agency_files') or None,
+                                                  df_map=self.df_map, department_matcher=department_matcher,
+                                                  mapping_index=self.mapping_index,
+                                                  cache_dir=self.cache_dir, workers=self.workers,
+                                                  filter_sentinels=job.get('filter_sentinels'),
+                                                  fc_sparse=bool(job.get('fc_sparse', False)))
+
+        output_files = None
+        if job.get('output_dir') is not None:
+            output_files = agency_grid.write(output_dir=job['output_dir'],
+                                             output_format=job.get('output_format', 'xlsx'))
+
+        missing_agencies, extra_agencies = operations.get_missing_agencies(country_map=self.df_map['countries'],
+                                                                           current_month_data=agency_grid.full_grid,
+                                                                           mapping_index=self.mapping_index)
+
+        # The decisions of the fuzzy matching are kept for the next jobs and the next service
+        with self.lock:
+            self.department_matcher.update(decisions=department_matcher.decisions)
+            self.department_matcher.save()
+
+        return {'year': int(job['year']),
+                'month': int(job['month']),
+                'missing_agencies': sorted(str(x) for x in missing_agencies),
+                'extra_agencies': sorted(str(x) for x in extra_agencies),
+                'fc_file': json.loads(agency_grid.fc_file.to_json(orient='records')),
+                'output_files': output_files}
+
+    def submit(self, job):
+        """
+        Runs a job when a running slot is free, after waiting if needed. The job is refused when the queue is full.
+
+        :param job:     A dictionary with the job arguments, see run_job.
+        :return: A tuple with the HTTP status and the response dictionary
+        """
+
+        missing_arguments = [key for key in ['input_file', 'year', 'month'] if key not in job]
+        if len(missing_arguments) > 0:
+            return 400, {'error': f'missing job arguments: {missing_arguments}'}
+
+        if not self.slots.acquire(blocking=False):
+            return 503, {'error': f'{self.max_running + self.max_queued} jobs already pending, try again later'}
+
+        with self.lock:
+            self.pending += 1
+        try:
+            with self.running:
+                return 200, self.run_job(job=job)
+        except ValueError as error:
+            # Inconsistent inputs (errors.InputError) or values of the input files fail the job, not the service
+            return 422, {'error': f'job failed: {type(error).__name__} {error}'}
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+
+class AgencyGridRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /status gives the state of the service, POST /jobs runs a job given as a JSON body.
+    """
+
+    def send_json(self, status, response):
+        body = json.dumps(response, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+
+        return self.send_json(200, self.server.service.get_status())
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self.send_json(404, {'error': f'unknown path {self.path}'})
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except json.JSONDecodeError as error:
+            return self.send_json(400, {'error': f'invalid JSON body: {error}'})
+
+        return self.send_json(*self.server.service.submit(job=job))
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    """
+    Serves the jobs of the service over HTTP until interrupted.
+
+    :param service:     AgencyGridService with the prepared mapping.
+    :param host:        The address to listen on. Only local connections by default.
+    :param port:        The port to listen on.
+    :return: None
+    """
+
+    server = ThreadingHTTPServer((host, port), AgencyGridRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+
+    print(f'Agency Grid service listening on http://{host}:{port} (POST /jobs, GET /status)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Agency Grid service stopped')
+    finally:
+        server.server_close()
+
+    return None
+
+
+def get_parser():
+    """
+    :return: The parser of the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Agency Grid - resident service with the mapping kept in memory")
+
+    parser.add_argument('--mapping_file', '-mf',
+                        type=Path,
+                        dest='mapping_file',
+                        help='Path to the mapping file provided by the Finance Department',
+                        default=None, required=True)
+
+    parser.add_argument('--cache_dir', '-cd',
+                        type=Path,
+                        dest='cache_dir',
+                        help='Path to the directory of the compiled mapping and the decisions kept between runs',
+                        default=None, required=False)
+
+    parser.add_argument('--host',
+                        type=str,
+                        dest='host',
+                        help='Address to listen on',
+                        default='127.0.0.1', required=False)
+
+    parser.add_argument('--port', '-p',
+                        type=int,
+                        dest='port',
+                        help='Port to listen on',
+                        default=8765, required=False)
+
+    parser.add_argument('--workers', '-w',
+                        type=int,
+                        dest='workers',
+                        help='Number of worker processes for the single agency files of a job',
+                        default=1, required=False)
+
+    parser.add_argument('--max_running', '-mr',
+                        type=int,
+                        dest='max_running',
+                        help='Number of jobs running at the same time',
+                        default=1, required=False)
+
+    parser.add_argument('--max_queued', '-mq',
+                        type=int,
+                        dest='max_queued',
+                        help='Number of jobs waiting for their turn, further jobs are refused',
+                        default=8, required=False)
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Serves the Agency Grid jobs with the mapping given in the command line arguments until interrupted.
+
+    :param argv:    (Optional) The command line arguments. By default sys.argv.
+    :return: None
+    """
+
+    args = get_parser().parse_args(argv)
+
+    serve(service=AgencyGridService(mapping_file=args.mapping_file, cache_dir=args.cache_dir, workers=args.workers,
+                                    max_running=args.max_running, max_queued=args.max_queued),
+          host=args.host, port=args.port)
+
+    return None
+
+
+if __name__ == '__main__':
+    main()
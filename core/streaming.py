@@ -0,0 +1,176 @@
+import os
+
+import pandas as pd
+
+from . import loading
+from . import operations
+from . import pipeline
+from . import processing
+from . import transforming
+from . import writing
+
+# Rows of the grid read at once by default in streaming mode
+CHUNK_SIZE = 200000
+
+# Columns the Agency Grid is sorted by (see processing.merge_grid_with_single_agency) and columns of the FC entities
+SORT_KEYS = ['kpi agency', 'branch', 'department fc code']
+ENTITY_COLUMNS = ['fc code', 'currency', 'date']
+
+
+def iter_agency_grid_chunks(current_month_file, df_agency, chunk_size=CHUNK_SIZE):
+    """
+    Reads, cleans and transforms the grid chunk by chunk, then gives the single agencies as a last chunk.
+
+    :param current_month_file:  Path to the current month data, a CSV file.
+    :param df_agency:           A dictionary with the single agencies and their 'fte' DataFrame.
+    :param chunk_size:          The number of rows of the grid chunks.
+    :return: An iterator of transformed DataFrames
+    """
+
+    for data in loading.load_data_chunks(input_file=current_month_file, chunk_size=chunk_size,
+                                         columns=loading.GRID_COLUMNS):
+        data = transforming.clean_up_data(data=data)
+        yield transforming.transform_data(data=data)
+
+    if len(df_agency) > 0:
+        yield pd.concat([value['fte'] for value in df_agency.values()])
+
+
+def process_chunk(data, country_map, mapping_index, sentinels=None, report_rules=False):
+    """
+    Processes a chunk of the Agency Grid as the whole grid is processed: sorted, joined with the country mapping and
+    filtered.
+
+    :param data:            A transformed chunk of the grid or of the single agencies.
+    :param country_map:     A DataFrame with the country mapping.
+    :param mapping_index:   MappingIndex of the country mapping.
+    :param sentinels:       (Optional) Values avoiding a row of the Agency Grid.
+    :param report_rules:    Whether to report in the avoided rows the rule that excluded them.
+    :return: Three DataFrames: the processed chunk, its avoided rows and its filtered rows
+    """
+
+    data = processing.merge_grid_with_single_agency(single_agencies={}, agency_grid=data)
+    data = processing.process_data(data=data, country_map=country_map, mapping_index=mapping_index)
+    avoided_data, filtered_data = processing.filter_agency_grid(data=data, sentinels=sentinels,
+                                                                report_rules=report_rules)
+
+    return data, avoided_data, filtered_data
+
+
+def merge_entities(entities, data):
+    """
+    Adds the distinct FC entities of a chunk to the ones of the previous chunks. Every entity keeps the sort keys of its
+    first row, so that the entities are in the order they have in a grid sorted as a whole, as given by
+    processing.aggregate_fc_data.
+
+    :param entities:    A DataFrame with the entities of the previous chunks and their sort keys, or None.
+    :param data:        The filtered rows of a chunk.
+    :return: A DataFrame with the distinct entities and their sort keys
+    """
+
+    entities = pd.concat([entities, data[ENTITY_COLUMNS + SORT_KEYS]], ignore_index=True)
+    entities.sort_values(by=SORT_KEYS, kind='stable', inplace=True)
+
+    return entities.drop_duplicates(subset=ENTITY_COLUMNS, ignore_index=True)
+
+
+def get_fc_entities(entities):
+    """
+    :param entities:    A DataFrame with the distinct entities and their sort keys, as given by merge_entities.
+    :return: A DataFrame with the distinct 'fc code', 'currency' and 'date' rows, as given by
+    processing.aggregate_fc_data
+    """
+
+    entities = entities[ENTITY_COLUMNS].copy()
+    entities['date'] = entities['date'].dt.strftime('%Y.%m')
+
+    return entities.drop_duplicates(ignore_index=True)
+
+
+def stream_agency_grid(agency_grid, output_dir, chunk_size=CHUNK_SIZE, output_format='xlsx', full_output_format=None):
+    """
+    Runs the pipeline of a month chunk by chunk, for grids too large to be held in memory. Every chunk of the grid is
+    cleaned, transformed, joined with the mapping and filtered, and its full, avoided and filtered rows are appended to
+    the output files. The FC file sums are kept as a running aggregate merged after every chunk, so that the memory
+    used depends on the chunk size and not on the size of the grid.
+
+    The rows of the output files are sorted within every chunk and the single agencies come last, while the Agency
+    Grid of a run in memory is sorted as a whole. The FC file is the same, up to the rounding of the sums.
+
+    :param agency_grid:             AgencyGridPipeline of the month, with its mapping and options. Its grid is not
+                                    loaded, its single agencies are.
+    :param output_dir:              Path to the output directory.
+    :param chunk_size:              The number of rows of the grid chunks.
+    :param output_format:           Format of the output files.
+    :param full_output_format:      (Optional) Format of the full Agency Grid output file.
+    :return: A dictionary with the artifact names and the paths to their output files, including the run report
+    """
+
+    recorder = agency_grid.recorder
+    prefix = f'{agency_grid.current_year}_{agency_grid.current_month:02}'
+    formats = {'AG_full': full_output_format or output_format, 'AG_avoided': output_format,
+               'AG_filtered': output_format}
+    writers = {}
+    for name, artifact_format in formats.items():
+        output_file = os.path.join(output_dir, f'{prefix}_{name}{writing.OUTPUT_FORMATS[artifact_format]}')
+        writers[name] = writing.ChunkWriter(output_file=output_file, output_format=artifact_format)
+
+    country_map = agency_grid.mapping['countries']
+    mapping_index = agency_grid.mapping_index
+    df_agency = agency_grid.single_agencies
+
+    operations.insert_divider_line(message=f'STREAMING GRID IN CHUNKS OF {chunk_size} ROWS', end=False)
+    agencies = set()
+    ftes, entities = None, None
+    rows_in = 0
+    with recorder.stage(name='stream') as record:
+        for number, data in enumerate(iter_agency_grid_chunks(current_month_file=agency_grid.current_month_file,
+                                                              df_agency=df_agency, chunk_size=chunk_size)):
+            print(f'Chunk {number}: {len(data)} rows')
+            rows_in += len(data)
+            chunks = process_chunk(data=data, country_map=country_map, mapping_index=mapping_index,
+                                   sentinels=agency_grid.filter_sentinels, report_rules=agency_grid.filter_rules)
+            for name, chunk in zip(['AG_full', 'AG_avoided', 'AG_filtered'], chunks):
+                writers[name].write(data=chunk)
+            agencies.update(chunks[0]['kpi agency'].dropna().unique())
+
+            # The running aggregate only holds the distinct combinations, not the rows
+            chunk_ftes = chunks[2].groupby(['fc code', 'department fc code'], sort=False)['ftes'].sum()
+            ftes = chunk_ftes if ftes is None else processing.merge_fc_sums(ftes=[ftes, chunk_ftes])
+            entities = merge_entities(entities=entities, data=chunks[2])
+            del data, chunks
+        record['rows_in'] = rows_in
+        record['rows_out'] = writers['AG_full'].rows
+    operations.insert_divider_line(message=f'STREAMING GRID IN CHUNKS OF {chunk_size} ROWS', end=True)
+
+    pipeline.print_info_about_agencies(message='FINAL INFORMATION ABOUT AGENCIES', country_map=country_map,
+                                       data=pd.DataFrame({'kpi agency': sorted(agencies)}), date=agency_grid.date,
+                                       mapping_index=mapping_index)
+
+    operations.insert_divider_line(message='WRITING OUTPUT FILES', end=False)
+    output_files = {}
+    for name, writer in writers.items():
+        output_files[name] = writer.close()
+        print(f'\t - {name}: {writer.rows} rows written in {output_files[name]}')
+
+    if ftes is None:
+        print('No rows in the grid and the single agencies, no FC file written')
+    else:
+        with recorder.stage(name='fc', rows_in=len(ftes)) as record:
+            fc_grid = processing.build_fc_file(ftes=ftes, entities=get_fc_entities(entities=entities),
+                                               zero_fill=not agency_grid.fc_sparse)
+            record['rows_out'] = len(fc_grid)
+        output_file = os.path.join(output_dir, f'{prefix}_AG_FC{writing.OUTPUT_FORMATS[output_format]}')
+        output_files['AG_FC'] = writing.write_data(data=fc_grid, output_file=output_file, output_format=output_format)
+        print(f"\t - AG_FC: {len(fc_grid)} rows written in {output_files['AG_FC']}")
+    operations.insert_divider_line(message='WRITING OUTPUT FILES', end=True)
+
+    operations.insert_divider_line(message='RUN REPORT', end=False)
+    recorder.print_summary()
+    report_file = os.path.join(output_dir, f'{prefix}_AG_report.json')
+    output_files['AG_report'] = recorder.save(report_file=report_file, year=agency_grid.current_year,
+                                              month=agency_grid.current_month, chunk_size=chunk_size)
+    print(f"\t - Run report written in {output_files['AG_report']}")
+    operations.insert_divider_line(message='RUN REPORT', end=True)
+
+    return output_files
@@ -1,6 +1,22 @@
 import numpy as np
 import pandas as pd
-import difflib
+
+from . import matching
+
+
+# Columns repeating a few values many times, carried as categoricals sharing the same categories in every DataFrame
+CATEGORICAL_COLUMNS = ['kpi agency',
+                       'branch',
+                       'ceo region',
+                       'continent split',
+                       'regional director',
+                       'department fc code',
+                       'fc code',
+                       'currency',
+                       ]
+
+# Strings standing for missing values in the single agency files
+NAN_STRINGS = ['nan', 'none', 'null', '', 'n/a', 'na']
 
 
 def get_data_columns():
@@ -40,25 +56,62 @@ def clean_cell(x):
     return x
 
 
-def clean_up_data(data):
+def clean_column(column):
+    """
+    Cleans a whole column at once with the same rules as clean_cell, using pandas string operations instead of a
+    Python call per cell. Values that were strings are lowercased, any other value is only converted to a string.
+
+    :param column:  A pandas Series to be cleaned.
+    :return: A Series of cleaned strings with the same index as the input.
+    """
+
+    values = column.astype(object)
+    inferred_type = pd.api.types.infer_dtype(values, skipna=False)
+
+    # Only strings: the columns repeat a few values many times, so every distinct value is cleaned only once
+    if inferred_type == 'string':
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Series(uniques, dtype=object)
+        uniques = uniques.str.replace('*', '', regex=False)
+        uniques = uniques.str.replace(r'\s+', ' ', regex=True).str.strip().str.lower()
+        return pd.Series(uniques.to_numpy()[codes], index=column.index, name=column.name, dtype=object)
+
+    cleaned = values.astype(str)
+
+    # Numbers never contain asterisks or whitespace, their string version is already clean
+    if not pd.api.types.is_numeric_dtype(column):
+        cleaned = cleaned.str.replace('*', '', regex=False)
+        cleaned = cleaned.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+    if inferred_type not in ['integer', 'floating', 'mixed-integer-float', 'boolean']:
+        is_text = np.fromiter((isinstance(x, str) for x in values), dtype=bool, count=len(values))
+        cleaned = cleaned.where(~is_text, cleaned.str.lower())
+
+    return cleaned
+
+
+def clean_up_data(data, numeric_columns=('ftes',)):
     """
     Cleans up the DataFrame by:
     - Stripping and lowercasing column names
-    - Converting all data to strings
+    - Converting all data to strings, except the numeric columns listed in numeric_columns
     - Removing asterisks (*)
     - Removing multiple spaces but not single spaces
     - Removing leading and trailing spaces
     - Converting 'cognos code' column to integers
 
-    :param data:    A pandas DataFrame that contains the input data.
+    :param data:                A pandas DataFrame that contains the input data.
+    :param numeric_columns:     (Optional) Cleaned column names kept as they are when they hold numbers.
     :return: A cleaned DataFrame with the applied transformations.
     """
 
     # Clean column names
     data.columns = data.columns.str.strip().str.lower().str.replace(r'\s\s+', ' ', regex=True)
-    # Convert all data to strings and apply cleaning operations
+    # Convert all data to strings and apply cleaning operations column by column
     for col in data.columns:
-        data[col] = data[col].apply(lambda x: clean_cell(x).lower() if isinstance(x, str) else clean_cell(x))
+        if col in numeric_columns and pd.api.types.is_numeric_dtype(data[col]):
+            continue
+        data[col] = clean_column(column=data[col])
 
     return data
 
@@ -88,13 +141,13 @@ def transform_mapping(data, key):
     return data
 
 
-def transform_data(data, country_map):
+def transform_data(data):
     """
-    Transforms a DataFrame by renaming columns, adjusting data types, and merging with the country_map DataFrame.
+    Transforms a DataFrame by renaming columns and adjusting data types. The country mapping is joined later, once, by
+    processing.process_data.
 
-    :param data:            The input DataFrame for transformation.
-    :param country_map:     A DataFrame containing the country mapping information for merging.
-    :return: The transformed DataFrame after merging and restructuring.
+    :param data:    The input DataFrame for transformation.
+    :return: The transformed DataFrame.
     """
 
     data.rename(columns={'kpi year month': 'date'}, inplace=True)
@@ -110,41 +163,107 @@ def transform_data(data, country_map):
     data['year'] = data['period'].dt.year
     data['month'] = data['period'].dt.month
 
-    df_merged = pd.merge(left=data, right=country_map,
-                         left_on=['kpi agency', 'branch'],
-                         right_on=['kpi agency', 'branch'],
-                         how='left')
+    return data
 
-    if len(data) == len(df_merged):
-        print(f'Data were not lost in the transformation, still {len(data)} rows')
-    else:
-        print(f'Raw data rows: {len(data)}')
-        print(f'Processed data rows: {len(df_merged)}')
-        print('Data decreased after processing')
-        exit()
+
+def get_categories(frames, columns=None):
+    """
+    Builds the category dictionary shared by the DataFrames of a run: for every categorical column, the distinct
+    values of the mapping and of the data, sorted as strings are sorted. Merges and groupbys between DataFrames with
+    the same categories run on the integer codes, and the sorted categories keep the sort order of the strings.
+
+    :param frames:      A list of DataFrames, the country mapping first, then the grid and the single agencies.
+    :param columns:     (Optional) The categorical columns. By default CATEGORICAL_COLUMNS.
+    :return: A dictionary with the column names and their CategoricalDtype
+    """
+
+    if columns is None:
+        columns = CATEGORICAL_COLUMNS
+
+    categories = {}
+    for column in columns:
+        values = [pd.Series(frame[column].unique()) for frame in frames if column in frame.columns]
+        if len(values) == 0:
+            continue
+        values = pd.concat(values, ignore_index=True).astype(object).dropna().unique()
+        # Columns mixing strings with other values are left as they are
+        if pd.api.types.infer_dtype(values, skipna=False) != 'string':
+            continue
+        categories[column] = pd.CategoricalDtype(categories=pd.Index(values).sort_values(), ordered=False)
+
+    return categories
+
+
+def categorize(data, categories):
+    """
+    Converts the categorical columns of a DataFrame to the shared categories. Missing values stay missing.
+
+    :param data:        The DataFrame.
+    :param categories:  A dictionary with column names and their CategoricalDtype, as given by get_categories.
+    :return: The DataFrame with categorical columns
+    """
+
+    for column, dtype in categories.items():
+        if column in data.columns:
+            data[column] = data[column].astype(dtype)
 
     return data
 
 
-def transform_single_data(data, agency, country_map, department_map, date):
+def copy_frame(data):
     """
-    Processes data for a single agency, transforming it to match the general structure by applying several cleaning,
-    renaming, and formatting steps.
+    Copies a DataFrame which is modified afterwards, so that the original is left as it is. With copy-on-write (the
+    low memory mode of the command lines) the copy is shallow: the columns are only copied when they are modified.
 
-    :param agency:          The DataFrame containing the agency data.
-    :param data:            The name of the agency.
-    :param country_map:     DataFrame with the country mapping.
-    :param department_map:  DataFrame with the department mapping.
-    :param date:            A dictionary with date information.
-    :return: The transformed DataFrame ready for further integration.
+    :param data:    The DataFrame.
+    :return: A copy of the DataFrame
+    """
+
+    return data.copy(deep=pd.options.mode.copy_on_write is not True)
+
+
+def replace_nan_strings(data, nan_values=None):
+    """
+    Replaces the strings standing for missing values (e.g. 'n/a', 'none') by NaN, whatever their case and surrounding
+    spaces. Every distinct value of a column is checked once instead of every cell.
+
+    :param data:        The input DataFrame.
+    :param nan_values:  (Optional) The lowercase strings standing for missing values. By default NAN_STRINGS.
+    :return: A DataFrame with NaN instead of those strings
+    """
+
+    if nan_values is None:
+        nan_values = NAN_STRINGS
+
+    data = copy_frame(data=data)
+    for column in data.columns:
+        values = data[column]
+        # Numbers and dates are never written as one of the strings
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+            continue
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        is_nan = np.array([str(x).strip().lower() in nan_values for x in uniques], dtype=bool)
+        if is_nan.any():
+            data[column] = values.mask(is_nan[codes], np.nan)
+
+    return data
+
+
+def split_single_data(data):
+    """
+    Splits the data of a single agency into the FTEs of its departments and the grand total rows, keeping only the
+    branch columns. The department fc codes of the grand total rows are set, the ones of the departments are left
+    missing.
+
+    :param data:    The cleaned-up DataFrame of a single agency file.
+    :return: Two DataFrames: the FTEs of the departments and the grand total rows
     """
 
     data.rename(columns={data.columns[0]: 'department name'}, inplace=True)
     data.rename(columns={data.columns[1]: 'fte type'}, inplace=True)
 
     # Convert common string NaNs to actual NaNs
-    nan_values = ['nan', 'none', 'null', '', 'n/a', 'na']
-    data = data.map(lambda x: np.nan if str(x).strip().lower() in nan_values else x)
+    data = replace_nan_strings(data=data)
 
     # Look for branches of the entity (agency)
     target_column = "total for all branches"
@@ -158,14 +277,6 @@ def transform_single_data(data, agency, country_map, department_map, date):
     data_fte.insert(loc=0, column='department fc code', value=pd.NA)
 
     data_grand_total = data.loc[target_row_index:, :].reset_index(drop=True)
-
-    # Fill the department fc code: Stage 1
-    for name in data_fte['department name'].unique():
-        matches = difflib.get_close_matches(name, department_map['department'], n=1, cutoff=0.6)
-        match = matches[0]
-        result = department_map[department_map['department'] == match]['department fc code'].values[0]
-        data_fte.loc[data_fte['department name'] == name, 'department fc code'] = result
-
     data_grand_total.insert(loc=0, column='department fc code', value=pd.NA)
 
     # TODO: This part is unluckily hardcoded but if should be fixed once the labels in fte type is amended
@@ -177,18 +288,43 @@ def transform_single_data(data, agency, country_map, department_map, date):
         condition = data_grand_total['fte type'] == meaning
         data_grand_total.loc[condition, 'department fc code'] = code
 
-    # TODO: this is linked to the upper TODO block
+    return data_fte, data_grand_total
+
+
+def melt_branches(data_fte, data_grand_total, codes):
+    """
+    Reshapes the FTEs of a single agency from one column per branch to one row per branch and department, the
+    branches one after the other.
+
+    :param data_fte:            The FTEs of the departments, as given by split_single_data.
+    :param data_grand_total:    The grand total rows, as given by split_single_data.
+    :param codes:               A dictionary with the department names and their department fc code.
+    :return: A DataFrame with the 'branch', 'department fc code' and 'ftes' columns
+    """
+
+    data_fte['department fc code'] = data_fte['department name'].map(codes)
+
+    # TODO: this is linked to the TODO block of split_single_data
     data_fte = data_fte.loc[data_fte['fte type'] == 'nb of ftes', :]
     data_grand_total = data_grand_total.loc[~data_grand_total['department fc code'].isna(), :]
     data = pd.concat([data_fte, data_grand_total])
 
-    data_temp = []
-    for branch in data.columns[3:]:
-        df_temp = data[['department fc code', branch]].copy()
-        df_temp.rename(columns={branch: 'ftes'}, inplace=True)
-        df_temp.insert(loc=0, column='branch', value=branch)
-        data_temp.append(df_temp)
-    data = pd.concat(data_temp)
+    # One melt for all the branches, the rows keep their index as with one copy per branch
+    data = pd.melt(data, id_vars=['department fc code'], value_vars=list(data.columns[3:]), var_name='branch',
+                   value_name='ftes', ignore_index=False)
+
+    return data[['branch', 'department fc code', 'ftes']]
+
+
+def add_single_columns(data, agency, date):
+    """
+    Adds the agency and the date columns to the reshaped FTEs of a single agency.
+
+    :param data:    The reshaped FTEs, as given by melt_branches.
+    :param agency:  The name of the agency.
+    :param date:    A dictionary with date information.
+    :return: The DataFrame with the 'kpi agency', 'date', 'period', 'year' and 'month' columns
+    """
 
     data['ftes'] = data['ftes'].astype(float)
     data['ftes'] = data['ftes'].fillna(0)
@@ -200,3 +336,29 @@ def transform_single_data(data, agency, country_map, department_map, date):
     data.insert(loc=7, column='month', value=data['period'].dt.month)
 
     return data
+
+
+def transform_single_data(data, agency, country_map, department_map, date, department_matcher=None):
+    """
+    Processes data for a single agency, transforming it to match the general structure by applying several cleaning,
+    renaming, and formatting steps.
+
+    :param agency:              The DataFrame containing the agency data.
+    :param data:                The name of the agency.
+    :param country_map:         DataFrame with the country mapping.
+    :param department_map:      DataFrame with the department mapping.
+    :param date:                A dictionary with date information.
+    :param department_matcher:  (Optional) DepartmentMatcher built from department_map, shared between agencies.
+    :return: The transformed DataFrame ready for further integration.
+    """
+
+    data_fte, data_grand_total = split_single_data(data=data)
+
+    # Fill the department fc code: Stage 1
+    if department_matcher is None:
+        department_matcher = matching.DepartmentMatcher(department_map=department_map)
+    codes = department_matcher.get_codes(names=data_fte['department name'].unique())
+
+    data = melt_branches(data_fte=data_fte, data_grand_total=data_grand_total, codes=codes)
+
+    return add_single_columns(data=data, agency=agency, date=date)
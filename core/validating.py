@@ -0,0 +1,243 @@
+import os
+
+import pandas as pd
+
+from . import caching
+from . import loading
+from . import operations
+from . import transforming
+
+# Columns of every sheet of the mapping file, named as after cleaning
+MAPPING_SHEET_COLUMNS = {'departments': ['kpi department', 'department fc code'],
+                         'countries': ['agency code', 'kpi agency', 'fc code', 'branch', 'ceo region',
+                                       'continent split', 'regional director', 'currency']}
+
+# Rows of the grid whose dates and FTEs are checked
+GRID_SAMPLE_ROWS = 1000
+
+# Column and row splitting a single agency file (see transforming.split_single_data)
+SINGLE_AGENCY_TOTAL_COLUMN = 'total for all branches'
+SINGLE_AGENCY_TOTAL_ROW = 'service/documentation center'
+
+
+def get_file_problems(input_file, extensions):
+    """
+    :param input_file:  The path to an input file.
+    :param extensions:  A list with the extensions the file may have, e.g. ['.csv', '.xlsx'].
+    :return: A list with the problems of the file path: the file does not exist or has an unknown extension
+    """
+
+    if not os.path.isfile(input_file):
+        return [f'{input_file}: file not found']
+
+    _, file_extension = os.path.splitext(input_file)
+    if file_extension.lower() not in extensions:
+        return [f"{input_file}: unknown file extension '{file_extension}', expected one of {', '.join(extensions)}"]
+
+    return []
+
+
+def get_missing_columns(columns, required_columns):
+    """
+    :param columns:             The column names of a file, as they are in the file.
+    :param required_columns:    The names of the required columns, as after cleaning.
+    :return: A list with the required columns not found in the file
+    """
+
+    columns = {loading.get_column_name(column) for column in columns}
+
+    return [column for column in required_columns if column not in columns]
+
+
+def validate_grid(current_month_file):
+    """
+    Checks the grid file: the columns used by the pipeline, then the dates and the FTEs of its first rows. Only the
+    header and GRID_SAMPLE_ROWS rows are read, every column as text so that any value can be reported. The
+    (agency, branch) pairs are then read from all the rows, see get_grid_keys.
+
+    :param current_month_file:  Path to the current month data.
+    :return: A tuple with the list of the problems found and the set of the (agency, branch) pairs of the grid
+    """
+
+    problems = get_file_problems(input_file=current_month_file, extensions=['.csv', '.xlsx', '.xls'])
+    if len(problems) > 0:
+        return problems, set()
+
+    _, file_extension = os.path.splitext(current_month_file)
+    usecols = loading.get_usecols(columns=loading.GRID_COLUMNS)
+    if file_extension.lower() == '.csv':
+        data = pd.read_csv(filepath_or_buffer=current_month_file, usecols=usecols, dtype=str, keep_default_na=False,
+                           nrows=GRID_SAMPLE_ROWS)
+    else:
+        data = pd.read_excel(io=current_month_file, sheet_name=0, usecols=usecols, dtype=object,
+                             nrows=GRID_SAMPLE_ROWS, engine=loading.EXCEL_ENGINE)
+
+    missing_columns = get_missing_columns(columns=data.columns, required_columns=loading.GRID_COLUMNS)
+    if len(missing_columns) > 0:
+        return [f"{current_month_file}: missing columns {', '.join(missing_columns)}"], set()
+
+    data.columns = [loading.get_column_name(column) for column in data.columns]
+
+    # Empty dates are allowed, their rows are avoided by the filter
+    dates = data['kpi year month'].astype(str).str.strip()
+    is_bad_date = (dates != '') & pd.to_datetime(dates, format='%Y-%m', errors='coerce').isna()
+    if is_bad_date.any():
+        problems.append(f"{current_month_file}: 'kpi year month' values not as YYYY-MM, e.g. "
+                        f"{', '.join(repr(x) for x in dates[is_bad_date].unique()[:5])}")
+
+    # Missing FTEs are the values loading.read_csv reads as missing, the other ones must be numbers
+    ftes = data['ftes'].astype(str)
+    is_missing = data['ftes'].isna() | ftes.isin(loading.NA_VALUES)
+    is_bad_fte = ~is_missing & pd.to_numeric(ftes.str.strip(), errors='coerce').isna()
+    if is_bad_fte.any():
+        problems.append(f"{current_month_file}: 'ftes' values are not numbers, e.g. "
+                        f"{', '.join(repr(x) for x in ftes[is_bad_fte].unique()[:5])}")
+
+    return problems, get_grid_keys(current_month_file=current_month_file)
+
+
+def get_grid_keys(current_month_file):
+    """
+    Reads the (agency, branch) pairs used by the grid, to only refuse the duplicated pairs of the mapping that are used.
+    This is a full read of the two key columns of the grid, only their distinct pairs are cleaned.
+
+    :param current_month_file:  Path to the current month data.
+    :return: A set with the cleaned (agency, branch) pairs of the grid
+    """
+
+    _, file_extension = os.path.splitext(current_month_file)
+    usecols = loading.get_usecols(columns=['kpi agency', 'branch'])
+    if file_extension.lower() == '.csv':
+        keys = loading.read_csv(input_file=current_month_file, usecols=usecols)
+    else:
+        keys = pd.read_excel(io=current_month_file, sheet_name=0, usecols=usecols, engine=loading.EXCEL_ENGINE)
+    keys = transforming.clean_up_data(data=transforming.copy_frame(data=keys.drop_duplicates()))
+
+    return set(keys[['kpi agency', 'branch']].drop_duplicates().itertuples(index=False, name=None))
+
+
+def validate_mapping(mapping_file, used_keys=None):
+    """
+    Checks the mapping file: its sheets and their columns, and the (agency, branch) pairs found more than once in the
+    country mapping. As when the mapping is joined (see indexing.MappingIndex.validate), a duplicated pair is only a
+    problem when the inputs use it, the other ones are printed as warnings. Only the key columns of the country
+    mapping are read.
+
+    :param mapping_file:    The path to the Agency Grid mapping file.
+    :param used_keys:       (Optional) A set with the (agency, branch) pairs of the inputs. By default no pair is used.
+    :return: A list with the problems found
+    """
+
+    problems = get_file_problems(input_file=mapping_file, extensions=['.xlsx', '.xls'])
+    if len(problems) > 0:
+        return problems
+
+    with pd.ExcelFile(mapping_file, engine=loading.EXCEL_ENGINE) as workbook:
+        for key, sheet_name in caching.MAPPING_SHEETS.items():
+            if sheet_name not in workbook.sheet_names:
+                problems.append(f"{mapping_file}: missing sheet '{sheet_name}'")
+                continue
+            columns = workbook.parse(sheet_name=sheet_name, nrows=0).columns
+            missing_columns = get_missing_columns(columns=columns, required_columns=MAPPING_SHEET_COLUMNS[key])
+            if len(missing_columns) > 0:
+                problems.append(f"{mapping_file}: missing columns {', '.join(missing_columns)} in sheet '{sheet_name}'")
+                continue
+
+            if key == 'countries':
+                keys = workbook.parse(sheet_name=sheet_name,
+                                      usecols=loading.get_usecols(columns=['kpi agency', 'branch']))
+                keys = transforming.clean_up_data(data=keys.dropna(how='all'))
+                duplicates = keys.loc[keys.duplicated(keep='first'), ['kpi agency', 'branch']].drop_duplicates()
+                for agency, branch in duplicates.itertuples(index=False):
+                    message = f"(agency, branch) pair {agency} / {branch} found more than once in sheet '{sheet_name}'"
+                    if (agency, branch) in (used_keys or set()):
+                        problems.append(f'{mapping_file}: {message}')
+                    else:
+                        print(f'Warning: {mapping_file}: {message}, not used by the inputs')
+
+    return problems
+
+
+def validate_single_agency_file(input_file):
+    """
+    Checks a single agency file: the agency name in its first cell, the columns of the department names and the FTE
+    types followed by the branches and a 'total for all branches' column, and a 'service/documentation center' row.
+    The sheet is read as loading.load_single_agency_data reads it.
+
+    :param input_file:  The path to a single agency file.
+    :return: A tuple with the list of the problems found and the set of the (agency, branch) pairs of the file
+    """
+
+    problems = get_file_problems(input_file=input_file, extensions=['.xlsx', '.xls'])
+    if len(problems) > 0:
+        return problems, set()
+
+    with loading.WorkbookReader(input_file=input_file) as workbook:
+        data = workbook.read_cells()
+    if len(data) < 3:
+        return [f'{input_file}: less than 3 rows, no agency name, header and body'], set()
+
+    agency = None
+    if not isinstance(data.iloc[0, 0], str) or data.iloc[0, 0].strip() == '':
+        problems.append(f'{input_file}: no agency name in the first cell')
+    else:
+        agency = data.iloc[0, 0].lower()
+
+    # The branches are the columns after the department names and the FTE types, up to the total column
+    header = [loading.get_column_name(column) for column in data.iloc[1].tolist()]
+    branches = []
+    if SINGLE_AGENCY_TOTAL_COLUMN not in header:
+        problems.append(f"{input_file}: no '{SINGLE_AGENCY_TOTAL_COLUMN}' column in the second row")
+    elif header.index(SINGLE_AGENCY_TOTAL_COLUMN) < 3:
+        problems.append(f"{input_file}: no branch column before the '{SINGLE_AGENCY_TOTAL_COLUMN}' column")
+    else:
+        branches = header[2:header.index(SINGLE_AGENCY_TOTAL_COLUMN)]
+
+    # The row after the header is skipped by the loading
+    department_names = transforming.clean_column(column=data.iloc[3:, 0])
+    if SINGLE_AGENCY_TOTAL_ROW not in department_names.to_numpy():
+        problems.append(f"{input_file}: no '{SINGLE_AGENCY_TOTAL_ROW}' row in the first column")
+
+    keys = set() if agency is None else {(agency, branch) for branch in branches}
+
+    return problems, keys
+
+
+def validate_inputs(current_month_files=None, mapping_file=None, missing_agency_files=None):
+    """
+    Checks the structure of the input files in one pass, before any of them is processed, and reports all the
+    problems at once. The program exits if any problem is found.
+
+    :param current_month_files:     (Optional) A list of paths to grid files.
+    :param mapping_file:            (Optional) The path to the Agency Grid mapping file.
+    :param missing_agency_files:    (Optional) A list of paths to single agency files.
+    :return: None
+    """
+
+    operations.insert_divider_line(message='INPUT VALIDATION', end=False)
+
+    problems = []
+    used_keys = set()
+    for current_month_file in current_month_files or []:
+        file_problems, file_keys = validate_grid(current_month_file=current_month_file)
+        problems.extend(file_problems)
+        used_keys.update(file_keys)
+    for input_file in missing_agency_files or []:
+        file_problems, file_keys = validate_single_agency_file(input_file=input_file)
+        problems.extend(file_problems)
+        used_keys.update(file_keys)
+    if mapping_file is not None:
+        problems = validate_mapping(mapping_file=mapping_file, used_keys=used_keys) + problems
+
+    checked_files = len(current_month_files or []) + len(missing_agency_files or []) + (mapping_file is not None)
+    if len(problems) > 0:
+        print(f'{len(problems)} problems found in {checked_files} input files:')
+        for problem in problems:
+            print('\t', '-', problem)
+        print('Impossible to process the inputs.')
+        exit(1)
+
+    print(f'No problem found in {checked_files} input files')
+    operations.insert_divider_line(message='INPUT VALIDATION', end=True)
+
+    return None
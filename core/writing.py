@@ -0,0 +1,332 @@
+import os
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import errors
+
+OUTPUT_FORMATS = {'xlsx': '.xlsx',
+                  'csv': '.csv',
+                  'parquet': '.parquet'}
+
+# Rows of a worksheet, the header included
+XLSX_MAX_ROWS = 1048576
+
+
+def get_cell_values(column):
+    """
+    Converts a column into a list of Python values that can be written in a worksheet, missing values being None.
+
+    :param column:  A pandas Series.
+    :return: A list with the values of the column
+    """
+
+    values = column.to_numpy(dtype=object).tolist()
+
+    return [None if x is None or x is pd.NaT or (isinstance(x, float) and np.isnan(x)) else x for x in values]
+
+
+def add_xlsx_formats(workbook):
+    """
+    :param workbook:    An xlsxwriter Workbook.
+    :return: The header and date formats of the workbook, the same as the ones of DataFrame.to_excel
+    """
+
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+
+    return header_format, date_format
+
+
+def write_xlsx_rows(worksheet, data, first_row, date_format):
+    """
+    Writes the rows of a DataFrame in an xlsxwriter worksheet, row by row as required by the constant memory mode.
+
+    :param worksheet:       An xlsxwriter Worksheet.
+    :param data:            The DataFrame to be written.
+    :param first_row:       The number of the worksheet row of the first row of data.
+    :param date_format:     The format of the date cells.
+    :return: None
+    """
+
+    def write_datetime(row, col, value):
+        worksheet.write_datetime(row, col, value, date_format)
+
+    def write_value(row, col, value):
+        # Text columns may hold dates among other values
+        worksheet.write(row, col, value, date_format if hasattr(value, 'timetuple') else None)
+
+    # The writing method is chosen once per column instead of once per cell
+    columns = [get_cell_values(column=data[column]) for column in data.columns]
+    writers = []
+    for column, values in zip(data.columns, columns):
+        if pd.api.types.is_datetime64_any_dtype(data[column]):
+            writers.append(write_datetime)
+        elif pd.api.types.is_numeric_dtype(data[column]) and not pd.api.types.is_bool_dtype(data[column]):
+            writers.append(worksheet.write_number)
+        elif pd.api.types.infer_dtype(values, skipna=True) in ['string', 'empty']:
+            writers.append(worksheet.write_string)
+        else:
+            writers.append(write_value)
+
+    for row_number, row in enumerate(zip(*columns), start=first_row):
+        for column_number, value in enumerate(row):
+            if value is not None:
+                writers[column_number](row_number, column_number, value)
+
+    return None
+
+
+def write_xlsx(data, output_file):
+    """
+    Writes a DataFrame in an Excel file. When xlsxwriter is installed the rows are streamed to the file in constant
+    memory, otherwise DataFrame.to_excel is used.
+
+    :param data:            The DataFrame to be written.
+    :param output_file:     The path to the Excel file.
+    :return: None
+    """
+
+    # xlsxwriter would silently drop the rows after the last one of the worksheet
+    if len(data) >= XLSX_MAX_ROWS:
+        print(f'{output_file}: more than {XLSX_MAX_ROWS - 1} rows, use the csv or parquet format instead')
+        exit(1)
+
+    if importlib.util.find_spec('xlsxwriter') is None:
+        data.to_excel(excel_writer=output_file, index=False)
+        return None
+
+    import xlsxwriter
+
+    with xlsxwriter.Workbook(output_file, {'constant_memory': True, 'nan_inf_to_errors': True}) as workbook:
+        worksheet = workbook.add_worksheet('Sheet1')
+        header_format, date_format = add_xlsx_formats(workbook=workbook)
+        worksheet.write_row(0, 0, [str(column) for column in data.columns], header_format)
+        write_xlsx_rows(worksheet=worksheet, data=data, first_row=1, date_format=date_format)
+
+    return None
+
+
+def write_data(data, output_file, output_format='xlsx'):
+    """
+    Writes a DataFrame in a file of the given format.
+
+    :param data:            The DataFrame to be written.
+    :param output_file:     The path to the output file.
+    :param output_format:   The format of the output file: 'xlsx', 'csv' or 'parquet'.
+    :return: The path to the output file
+    """
+
+    if output_format == 'xlsx':
+        write_xlsx(data=data, output_file=output_file)
+    elif output_format == 'csv':
+        data.to_csv(path_or_buf=output_file, index=False)
+    elif output_format == 'parquet':
+        data.to_parquet(path=output_file, index=False)
+    else:
+        raise errors.InputError(f'Unknown output format: {output_format}')
+
+    return output_file
+
+
+class OutputWriter:
+    """
+    Writes the artifacts of a run (full, avoided, filtered and FC grids) in background threads, so that an artifact is
+    written while the next ones are computed and independent artifacts are written at the same time. The DataFrames
+    submitted must not be modified afterwards.
+    """
+
+    def __init__(self, output_dir, prefix, output_format='xlsx', formats=None, workers=4):
+        """
+        :param output_dir:      Path to the output directory.
+        :param prefix:          The prefix of the file names, e.g. '2024_03'.
+        :param output_format:   The default format of the artifacts: 'xlsx', 'csv' or 'parquet'.
+        :param formats:         (Optional) A dictionary with the format of given artifacts, e.g. {'AG_full': 'csv'}.
+        :param workers:         The number of artifacts written at the same time.
+        """
+
+        for name, artifact_format in [('default', output_format)] + list((formats or {}).items()):
+            if artifact_format not in OUTPUT_FORMATS:
+                raise errors.InputError(f'Unknown output format for {name}: {artifact_format}')
+
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.output_format = output_format
+        self.formats = formats or {}
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='writer')
+        self.futures = {}
+
+    def get_output_file(self, name):
+        """
+        :param name:    The name of the artifact, e.g. 'AG_full'.
+        :return: The path to the output file of the artifact
+        """
+
+        output_format = self.formats.get(name, self.output_format)
+        return os.path.join(self.output_dir, f'{self.prefix}_{name}{OUTPUT_FORMATS[output_format]}')
+
+    def write(self, name, data):
+        """
+        Writes an artifact, meant to run in a writer thread.
+
+        :param name:    The name of the artifact.
+        :param data:    The DataFrame of the artifact.
+        :return: The path to the output file
+        """
+
+        output_file = write_data(data=data, output_file=self.get_output_file(name=name),
+                                 output_format=self.formats.get(name, self.output_format))
+        print(f'\t - {name}: {len(data)} rows written in {output_file}')
+
+        return output_file
+
+    def submit(self, name, data):
+        """
+        Schedules the writing of an artifact and returns immediately.
+
+        :param name:    The name of the artifact, e.g. 'AG_full'.
+        :param data:    The DataFrame of the artifact.
+        :return: A future with the path to the output file
+        """
+
+        self.futures[name] = self.executor.submit(self.write, name, data)
+
+        return self.futures[name]
+
+    def close(self):
+        """
+        Waits until all the artifacts are written. Errors raised while writing are raised here.
+
+        :return: A dictionary with the artifact names and the paths to their output files
+        """
+
+        self.executor.shutdown(wait=True)
+
+        return {name: future.result() for name, future in self.futures.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        return False
+
+
+class ChunkWriter:
+    """
+    Writes a DataFrame given chunk after chunk in one file, so that the whole DataFrame is never in memory. The chunks
+    must have the same columns. The file is created with the first chunk.
+    """
+
+    def __init__(self, output_file, output_format='xlsx'):
+        """
+        :param output_file:     The path to the output file.
+        :param output_format:   The format of the output file: 'xlsx' (requires xlsxwriter), 'csv' or 'parquet'
+                                (requires pyarrow).
+        """
+
+        if output_format not in OUTPUT_FORMATS:
+            print(f'Unknown output format: {output_format}')
+            exit()
+        if output_format == 'xlsx' and importlib.util.find_spec('xlsxwriter') is None:
+            print('Writing an Excel file chunk by chunk requires xlsxwriter, use the csv or parquet format instead')
+            exit()
+
+        self.output_file = output_file
+        self.output_format = output_format
+        self.rows = 0
+        self.columns = None
+        self.file = None
+        self.worksheet = None
+        self.date_format = None
+        self.schema = None
+
+    def open(self, data):
+        """
+        Creates the file with the columns of the first chunk.
+
+        :param data:    The first chunk.
+        :return: None
+        """
+
+        self.columns = list(data.columns)
+
+        if self.output_format == 'xlsx':
+            import xlsxwriter
+            self.file = xlsxwriter.Workbook(self.output_file, {'constant_memory': True, 'nan_inf_to_errors': True})
+            self.worksheet = self.file.add_worksheet('Sheet1')
+            header_format, self.date_format = add_xlsx_formats(workbook=self.file)
+            self.worksheet.write_row(0, 0, [str(column) for column in self.columns], header_format)
+        elif self.output_format == 'csv':
+            self.file = open(self.output_file, 'w', newline='', encoding='utf-8')
+            data.iloc[:0].to_csv(path_or_buf=self.file, index=False)
+        elif self.output_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # The types of the first chunk are kept for the next ones. A column with only missing values in the first
+            # chunk has no type, its values are text in the output files
+            schema = pa.Schema.from_pandas(data, preserve_index=False)
+            for position, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(position, field.with_type(pa.string()))
+                elif pa.types.is_dictionary(field.type) and pa.types.is_null(field.type.value_type):
+                    schema = schema.set(position, field.with_type(pa.dictionary(pa.int32(), pa.string())))
+            self.schema = schema
+            self.file = pq.ParquetWriter(self.output_file, schema=self.schema)
+
+        return None
+
+    def write(self, data):
+        """
+        Appends a chunk to the file.
+
+        :param data:    The DataFrame of the chunk.
+        :return: The number of rows written so far
+        """
+
+        if self.file is None:
+            self.open(data=data)
+        data = data[self.columns]
+
+        if self.output_format == 'xlsx':
+            if self.rows + len(data) >= XLSX_MAX_ROWS:
+                print(f'{self.output_file}: more than {XLSX_MAX_ROWS - 1} rows, use the csv or parquet format instead')
+                exit()
+            write_xlsx_rows(worksheet=self.worksheet, data=data, first_row=self.rows + 1, date_format=self.date_format)
+        elif self.output_format == 'csv':
+            data.to_csv(path_or_buf=self.file, index=False, header=False)
+        elif self.output_format == 'parquet':
+            import pyarrow as pa
+            self.file.write_table(pa.Table.from_pandas(data, schema=self.schema, preserve_index=False))
+
+        self.rows += len(data)
+
+        return self.rows
+
+    def close(self, data=None):
+        """
+        Closes the file.
+
+        :param data:    (Optional) An empty DataFrame with the columns, to create the file when no chunk was written.
+        :return: The path to the output file
+        """
+
+        if self.file is None and data is not None:
+            self.open(data=data)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        return self.output_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False